@@ -0,0 +1,124 @@
+""" Running one parser per transit agency (AGENCIES_CONFIG).
+
+The config is a JSON list of agencies, each a u.GTFSConf plus the namespace its Redis keys & channels are
+put under, e.g.
+    [
+        {"name": "MTA_subway", "namespace": "", "static_url": "...", "realtime_urls": {"": "...", "-ace": "..."}},
+        {"name": "MTA_LIRR", "namespace": "lirr", "static_url": "...", "realtime_urls": {"": "..."}}
+    ]
+An agency with the empty namespace writes the same keys a single-agency parser does (realtime:data_full,
+the realtime_updates channel...); the others' are prefixed, e.g. lirr:realtime:data_full.
+
+main.py runs each agency's pipeline in its own process (see main.multi_agency_main), so agencies are
+parsed in parallel on separate cores rather than one after another in a single loop. configure() points
+the process' module-level config (u.GTFS_CONF, the data directories...) at its agency.
+"""
+import json
+import logging
+import os
+from typing import Any, Callable, List, NamedTuple, Union
+import redis
+import util as u  # type: ignore
+
+
+class Agency(NamedTuple):
+    namespace: str  # prefixed to its Redis keys & channels, "" for none
+    conf: u.GTFSConf
+
+
+def load(path: str) -> List[Agency]:
+    """ Reads the agencies in the config file at path, raising ValueError if it's invalid
+    """
+    with open(path) as in_stream:
+        entries = json.load(in_stream)
+
+    agencies = []
+    for entry in entries:
+        try:
+            conf = u.GTFSConf(
+                name=entry["name"],
+                static_url=entry["static_url"],
+                additional_static_urls=entry.get("additional_static_urls", []),
+                realtime_urls=entry["realtime_urls"],
+            )
+        except (KeyError, TypeError) as err:
+            raise ValueError(f"invalid agency in {path}: {entry!r} ({err!r})")
+        agencies.append(Agency(namespace=entry.get("namespace", conf.name), conf=conf))
+
+    names = [agency.conf.name for agency in agencies]
+    namespaces = [agency.namespace for agency in agencies]
+    if len(set(names)) < len(names) or len(set(namespaces)) < len(namespaces):
+        raise ValueError(f"agency names & namespaces in {path} must be unique")
+    return agencies
+
+
+def configure(agency: Agency, index: int) -> None:
+    """ Points this process' config at agency, the index-th in the config: its GTFSConf, its own data
+    directories & files, and its own metrics port
+    """
+    u.GTFS_CONF = agency.conf
+    u.REDIS_NAMESPACE = agency.namespace
+    u.STATIC_PATH = f"{u.STATIC_PATH}/{agency.conf.name}"
+    u.REALTIME_PATH = f"{u.REALTIME_PATH}/{agency.conf.name}"
+    checkpoint_dir, checkpoint_file = os.path.split(u.REALTIME_CHECKPOINT_PATH)
+    u.REALTIME_CHECKPOINT_PATH = os.path.join(checkpoint_dir, agency.conf.name, checkpoint_file)
+    os.makedirs(os.path.dirname(u.REALTIME_CHECKPOINT_PATH), exist_ok=True)
+    if u.REALTIME_SHM_PATH:
+        u.REALTIME_SHM_PATH = f"{u.REALTIME_SHM_PATH}-{agency.conf.name}"
+    if u.METRICS_PORT:
+        u.METRICS_PORT += index
+
+    formatter = logging.Formatter(
+        f"%(levelname)s %(asctime)s.%(msecs)03d {agency.conf.name} %(module)s %(message)s", "%Y-%m-%d %H:%M:%S"
+    )
+    for handler in u.log.handlers:
+        handler.setFormatter(formatter)
+
+
+class NamespacedRedis:
+    """ Wraps a redis.Redis (or a pipeline of one), prefixing the keys & channels of the commands the parser
+    uses with "namespace:"
+    """
+
+    def __init__(self, server: Any, namespace: str) -> None:
+        self.server = server
+        self.prefix = namespace + ":"
+
+    def key(self, name: Union[str, bytes]) -> Union[str, bytes]:
+        return self.prefix.encode("utf-8") + name if isinstance(name, bytes) else self.prefix + str(name)
+
+    def __getattr__(self, command: str) -> Any:
+        method = getattr(self.server, command)
+        if not callable(method) or command in ("execute", "close", "reset"):
+            return method
+
+        def run(*args: Any, **kwargs: Any) -> Any:
+            if command in ("delete", "exists"):
+                args = tuple(self.key(name) for name in args)
+            elif command == "blpop":
+                keys = args[0] if isinstance(args[0], (list, tuple)) else [args[0]]
+                args = ([self.key(name) for name in keys],) + args[1:]
+            elif command == "xread":
+                args = ({self.key(name): last_id for name, last_id in args[0].items()},) + args[1:]
+            elif args:
+                args = (self.key(args[0]),) + args[1:]  # the key, or publish's channel
+            result = method(*args, **kwargs)
+            return self if result is self.server else result  # pipelines queue commands & return themselves
+
+        return run
+
+    def register_script(self, script: str) -> Callable[..., Any]:
+        run_script = self.server.register_script(script)
+
+        def run(keys: List[Any] = [], args: List[Any] = []) -> Any:
+            return run_script(keys=[self.key(name) for name in keys], args=args)
+
+        return run
+
+    def pipeline(self, transaction: bool = True) -> "NamespacedRedis":
+        return NamespacedRedis(self.server.pipeline(transaction=transaction), self.prefix[:-1])
+
+
+def namespaced(server: redis.Redis, namespace: str) -> Union[redis.Redis, NamespacedRedis]:
+    return NamespacedRedis(server, namespace) if namespace else server
+
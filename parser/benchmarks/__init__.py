@@ -0,0 +1,12 @@
+""" Benchmarks for the parser. Run them from the parser directory, e.g.:
+    python -m benchmarks.compression /path/to/snapshots
+    python -m benchmarks.hot_paths --save baseline.json
+    python -m benchmarks.allocations
+    python -m benchmarks.startup
+"""
+import os
+
+# util.py refuses to import without these; the benchmarks never talk to Redis or the MTA.
+for _var, _default in [("REDIS_HOSTNAME", "localhost"), ("REDIS_PORT", "6379"), ("MTA_API_KEY", "")]:
+    os.environ.setdefault(_var, _default)
+os.environ.setdefault("LOG_LEVEL", "WARNING")  # keep the pipeline's info logs out of the results
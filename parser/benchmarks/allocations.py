@@ -0,0 +1,113 @@
+""" Measures the memory allocated by merge_feeds + parse, against the previous approach of copying
+every feed into one merged FeedMessage (FeedMessage.MergeFrom) before parsing it, and the memory each
+snapshot kept in RealtimeManager.snapshots retains.
+
+Allocations are traced with tracemalloc, so only Python-level allocations are counted: with the
+pure-Python protobuf runtime that includes the merged message, with the C++ runtime it mostly doesn't.
+
+Usage:
+    python -m benchmarks.allocations [--scale 1] [--repeat 5] [--snapshots 10]
+"""
+import argparse
+import gc
+import sys
+import time
+import types
+import tracemalloc
+from typing import Any, Callable, NamedTuple, Set
+from google.transit.gtfs_realtime_pb2 import FeedMessage  # type: ignore
+import realtime  # type: ignore
+import synthetic  # type: ignore
+from benchmarks.hot_paths import Fixture  # type: ignore
+
+
+class AllocationResult(NamedTuple):
+    name: str
+    peak_kb: float
+    allocated_kb: float  # still allocated when the run finished, e.g. the parsed data
+    ms: float
+
+
+def merge_by_copy(manager: realtime.RealtimeManager) -> None:
+    """ The previous merge_feeds: MergeFrom each feed into a new FeedMessage, then parse that
+    """
+    full_feed = FeedMessage()
+    for fh in manager.feed_handlers:
+        try:
+            full_feed.MergeFrom(fh.latest_feed)
+        except (ValueError, TypeError):
+            full_feed.MergeFrom(fh.prev_feed)
+    manager.feeds = [full_feed]
+
+
+def measure(
+    name: str, fixture: Fixture, merge: Callable[[realtime.RealtimeManager], None], repeat: int
+) -> AllocationResult:
+    manager = fixture.manager
+    peaks, allocated, timings = [], [], []
+    for _ in range(repeat):
+        fixture.fresh_data()
+        tracemalloc.start()
+        start = time.perf_counter()
+        merge(manager)
+        manager.parse()
+        timings.append(time.perf_counter() - start)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peaks.append(peak)
+        allocated.append(current)
+    return AllocationResult(
+        name=name, peak_kb=min(peaks) / 1024, allocated_kb=min(allocated) / 1024, ms=min(timings) * 1000
+    )
+
+
+def reachable(root: Any, seen: Set[int]) -> int:
+    """ Adds the ids of the objects reachable from root that aren't in seen yet to it, returning their total size
+    """
+    size, stack = 0, [root]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, (type, types.ModuleType, types.FunctionType)):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        stack.extend(gc.get_referents(obj))
+    return size
+
+
+def snapshot_kb(fixture: Fixture, snapshots: int) -> float:
+    """ Replays snapshots more cycles, then sizes the objects each older retained snapshot holds
+    that the latest one doesn't share
+    """
+    manager = fixture.manager
+    for _ in range(snapshots):
+        fixture.next_cycle()
+        manager.update()
+    older = [snapshot.data for snapshot in manager.snapshots if snapshot.data is not manager.current_data]
+    seen: Set[int] = set()
+    reachable(manager.current_data, seen)
+    return sum(reachable(data, seen) for data in older) / len(older) / 1024
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--snapshots", type=int, default=10)
+    args = parser.parse_args()
+
+    fixture = Fixture(synthetic.SyntheticConf().scaled(args.scale), repeat=args.snapshots)
+    try:
+        print(f"{'merge + parse':<20}{'peak KB':>12}{'retained KB':>14}{'ms':>10}")
+        merges = [("MergeFrom copy", merge_by_copy), ("chained feeds", realtime.RealtimeManager.merge_feeds)]
+        for name, merge in merges:
+            result = measure(name, fixture, merge, args.repeat)
+            print(f"{result.name:<20}{result.peak_kb:>12.0f}{result.allocated_kb:>14.0f}{result.ms:>10.1f}")
+        trips = len(fixture.manager.current_data.trips)
+        print(f"\nretained per snapshot: {snapshot_kb(fixture, args.snapshots):.0f} KB ({trips} trips)")
+    finally:
+        fixture.close()
+
+
+if __name__ == "__main__":
+    main()
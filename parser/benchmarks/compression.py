@@ -0,0 +1,105 @@
+""" Compares compression codecs & levels on recorded full/diff payloads.
+
+Snapshots are files in a directory, either raw serialized protobuf or payloads as
+stored in Redis under realtime:data_full / realtime:data_diffs (codec-framed or legacy zlib).
+
+Usage:
+    python -m benchmarks.compression SNAPSHOT_DIR [--codecs zlib:1,zlib:6,deflate:6,zstd:3] [--repeat N]
+"""
+import argparse
+import os
+import time
+import zlib
+from typing import List, NamedTuple
+import codec  # type: ignore
+
+DEFAULT_CODECS = "zlib:1,zlib:3,zlib:6,zlib:9,deflate:6,deflate:9,zstd:1,zstd:3,zstd:9"
+
+
+class CodecResult(NamedTuple):
+    codec: str
+    raw_bytes: int
+    compressed_bytes: int
+    encode_ms: float
+    decode_ms: float
+
+    @property
+    def ratio(self) -> float:
+        return self.raw_bytes / self.compressed_bytes if self.compressed_bytes else 0.0
+
+
+def load_snapshots(snapshot_dir: str) -> List[bytes]:
+    """ Returns the uncompressed protobuf bytes of every snapshot in snapshot_dir
+    """
+    snapshots = []
+    for fname in sorted(os.listdir(snapshot_dir)):
+        with open(os.path.join(snapshot_dir, fname), "rb") as in_stream:
+            payload = in_stream.read()
+        try:
+            snapshots.append(codec.decode(payload))
+        except (zlib.error, ValueError):
+            snapshots.append(payload)
+    return snapshots
+
+
+def bench_codec(codec_: codec.Codec, snapshots: List[bytes], repeat: int) -> CodecResult:
+    raw_bytes = compressed_bytes = 0
+    encode_time = decode_time = 0.0
+    for snapshot in snapshots:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            payload = codec_.encode(snapshot)
+            encode_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            decoded = codec.decode(payload)
+            decode_time += time.perf_counter() - start
+        assert decoded == snapshot, f"{codec_} round trip failed"
+        raw_bytes += len(snapshot)
+        compressed_bytes += len(payload)
+
+    n = len(snapshots) * repeat
+    return CodecResult(
+        codec=repr(codec_),
+        raw_bytes=raw_bytes,
+        compressed_bytes=compressed_bytes,
+        encode_ms=encode_time / n * 1000,
+        decode_ms=decode_time / n * 1000,
+    )
+
+
+def parse_codec_specs(specs: str) -> List[codec.Codec]:
+    codecs = []
+    for spec in specs.split(","):
+        name, _, level = spec.partition(":")
+        if name == "zstd" and codec.zstandard is None:
+            print(f"skipping {spec}: zstandard is not installed")
+            continue
+        codecs.append(codec.CODECS[name](int(level) if level else None))
+    return codecs
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("snapshot_dir")
+    parser.add_argument("--codecs", default=DEFAULT_CODECS)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    codecs = parse_codec_specs(args.codecs)
+    snapshots = load_snapshots(args.snapshot_dir)
+    if not snapshots:
+        raise SystemExit(f"no snapshots found in {args.snapshot_dir}")
+    print(f"{len(snapshots)} snapshots, {sum(map(len, snapshots)) / 1024:.1f}KB uncompressed\n")
+
+    print(f"{'codec':<12}{'ratio':>8}{'avg KB':>10}{'encode ms':>12}{'decode ms':>12}")
+    for codec_ in codecs:
+        result = bench_codec(codec_, snapshots, args.repeat)
+        print(
+            f"{result.codec:<12}{result.ratio:>8.2f}{result.compressed_bytes / len(snapshots) / 1024:>10.1f}"
+            f"{result.encode_ms:>12.2f}{result.decode_ms:>12.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
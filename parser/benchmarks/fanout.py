@@ -0,0 +1,202 @@
+""" Load tests the websocket fan-out server (fanout.py) with thousands of simulated clients.
+
+The server runs in a child process and publishes --updates synthetic updates, --interval seconds apart,
+each with diffs from the 1, 2, 4 & 8 updates before it. The clients run in this process and behave like
+web_client: each requests the full data on connecting and acknowledges every payload it receives, except for
+the --slow fraction, which never read anything and should be dropped without holding up the others.
+
+Reports the latency from publishing an update to each client having received it, how many clients got a diff
+rather than the full payload, and the server's CPU time & bytes sent per update.
+
+Usage:
+    python -m benchmarks.fanout [--clients 2000] [--updates 20] [--interval 1] [--full-kb 200] [--diff-kb 8]
+                                [--slow 0.01] [--send-timeout 2] [--save BASELINE.json] [--compare BASELINE.json]
+                                [--threshold 0.1]
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+PARSER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DIFF_DISTANCES = [1, 2, 4, 8]
+CONNECT_BATCH = 100
+
+
+def serve(updates: int, interval: float, full_kb: int, diff_kb: int, send_timeout: float) -> None:
+    """ Runs in the child process: prints the server's port, publishes the first update, and the others once
+    a line is read from stdin; prints its stats when stdin is closed
+    """
+    import fanout  # type: ignore
+
+    server = fanout.FanoutServer(host="127.0.0.1", port=0, send_timeout=send_timeout)
+    server.start_in_thread()
+    print(server.port, flush=True)
+
+    published: Dict[int, float] = {}
+
+    def publish(timestamp: int) -> None:
+        data_diffs = {
+            timestamp - distance: os.urandom(diff_kb * 1024) for distance in DIFF_DISTANCES if timestamp > distance
+        }
+        published[timestamp] = time.time()
+        server.publish(timestamp, os.urandom(full_kb * 1024), data_diffs)
+
+    publish(1)
+    sys.stdin.readline()
+    cpu_start = time.process_time()
+    sent_start = server.sent_bytes
+    for timestamp in range(2, updates + 2):
+        publish(timestamp)
+        time.sleep(interval)
+    cpu_seconds = time.process_time() - cpu_start
+    sent_bytes = server.sent_bytes - sent_start
+    sys.stdin.read()
+    print(
+        json.dumps(
+            {"published": published, "cpu_seconds": cpu_seconds, "sent_bytes": sent_bytes, "dropped": server.dropped}
+        ),
+        flush=True,
+    )
+
+
+class SimulatedClient:
+    def __init__(self, index: int, slow: bool) -> None:
+        self.client_id = f"load-{index}"
+        self.slow = slow
+        self.received: Dict[int, float] = {}  # update timestamp -> when its payload arrived
+        self.diffs = 0
+        self.fulls = 0
+        self.ready = asyncio.Event()  # has its first full payload
+
+    async def run(self, port: int) -> None:
+        import websockets  # type: ignore
+
+        async with websockets.connect(
+            f"ws://127.0.0.1:{port}/?unique_id={self.client_id}", compression=None, max_size=None
+        ) as ws:
+            await ws.send('{"type": "request_full", "error": ""}')
+            if self.slow:
+                # never reads, so its socket fills up and the server's sends to it stall
+                ws.transport.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+                ws.transport.pause_reading()
+                self.ready.set()
+                await asyncio.sleep(3600)
+            upcoming_timestamp, upcoming_type = 0, ""
+            async for message in ws:
+                if isinstance(message, str):
+                    parsed = json.loads(message)
+                    if parsed["type"] in ("data_full", "data_update"):
+                        upcoming_type = parsed["type"]
+                        upcoming_timestamp = int(parsed.get("timestamp") or parsed["timestamp_to"])
+                    continue
+                self.received[upcoming_timestamp] = time.time()
+                if upcoming_type == "data_update":
+                    self.diffs += 1
+                else:
+                    self.fulls += 1
+                await ws.send(json.dumps({"type": "data_received", "last_successful_timestamp": upcoming_timestamp}))
+                self.ready.set()
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0.0
+
+
+async def load_test(args: argparse.Namespace, child: subprocess.Popen, port: int) -> List[SimulatedClient]:
+    slow_every = int(1 / args.slow) if args.slow else 0
+    clients = [SimulatedClient(i, slow=bool(slow_every) and i % slow_every == 0) for i in range(args.clients)]
+    tasks = []
+    for start in range(0, len(clients), CONNECT_BATCH):
+        batch = clients[start:start + CONNECT_BATCH]
+        tasks += [asyncio.ensure_future(client.run(port)) for client in batch]
+        await asyncio.wait_for(asyncio.gather(*[client.ready.wait() for client in batch]), 60)
+    print(f"{len(clients)} clients connected", file=sys.stderr)
+
+    child.stdin.write(b"start\n")
+    child.stdin.flush()
+    last_timestamp = args.updates + 1
+    deadline = time.time() + args.updates * args.interval + 30
+    fast = [client for client in clients if not client.slow]
+    while time.time() < deadline and not all(last_timestamp in client.received for client in fast):
+        await asyncio.sleep(0.1)
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return clients
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--clients", type=int, default=2000)
+    parser.add_argument("--updates", type=int, default=20)
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between updates")
+    parser.add_argument("--full-kb", type=int, default=200)
+    parser.add_argument("--diff-kb", type=int, default=8)
+    parser.add_argument("--slow", type=float, default=0.01, help="fraction of clients that never read")
+    parser.add_argument("--send-timeout", type=float, default=2.0)
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="flag regressions against this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        serve(args.updates, args.interval, args.full_kb, args.diff_kb, args.send_timeout)
+        return
+
+    from benchmarks import hot_paths  # type: ignore
+
+    child = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.fanout", "--child"] + sys.argv[1:],
+        cwd=PARSER_DIR,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+    )
+    port = int(child.stdout.readline())
+    clients = asyncio.get_event_loop().run_until_complete(load_test(args, child, port))
+    child.stdin.close()
+    server_stats = json.loads(child.stdout.read().decode("utf-8").strip().splitlines()[-1])
+    child.wait()
+
+    published = {int(timestamp): at for timestamp, at in server_stats["published"].items()}
+    fast = [client for client in clients if not client.slow]
+    latencies = [
+        at - published[timestamp] for client in fast for timestamp, at in client.received.items() if timestamp > 1
+    ]
+    missed = sum(args.updates + 1 not in client.received for client in fast)
+    updates_received = sum(len(client.received) - 1 for client in fast)
+    diffs = sum(client.diffs for client in fast)
+
+    print(f"{len(fast)} clients ({len(clients) - len(fast)} slow, {server_stats['dropped']} dropped), {args.updates} updates")
+    print(f"latency ms      p50 {percentile(latencies, 0.5) * 1000:8.1f}   p95 {percentile(latencies, 0.95) * 1000:8.1f}"
+          f"   p99 {percentile(latencies, 0.99) * 1000:8.1f}   max {max(latencies, default=0) * 1000:8.1f}")
+    print(f"diffs           {diffs} of {updates_received} updates received ({diffs / max(1, updates_received):.0%})")
+    print(f"missed the last {missed}")
+    cpu_ms = server_stats["cpu_seconds"] / args.updates * 1000
+    print(f"per update      {cpu_ms:.1f}ms server CPU, {server_stats['sent_bytes'] / args.updates / 1024 / 1024:.1f}MB sent")
+
+    results = [
+        hot_paths.CaseResult(name=name, runs=len(latencies), items=len(fast), median_ms=ms, min_ms=ms)
+        for name, ms in [
+            ("latency_p50", percentile(latencies, 0.5) * 1000),
+            ("latency_p99", percentile(latencies, 0.99) * 1000),
+            ("server_cpu_per_update", cpu_ms),
+        ]
+    ]
+    if args.save:
+        with open(args.save, "w") as out_stream:
+            json.dump({"results": [r._asdict() for r in results]}, out_stream, indent=1)
+    if args.compare and hot_paths.compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+""" Runs RealtimeFeedHandler.fetch() for all nine feeds against fake_mta.py under fault scenarios,
+for a sweep of REALTIME_TIMEOUT, REALTIME_MAX_ATTEMPTS & REALTIME_HEDGE_PERCENTILE values, so they can be
+tuned with data. Each feed's attempts get REALTIME_TIMEOUT * REALTIME_MAX_ATTEMPTS seconds.
+
+For each scenario and setting it reports the median & max time to fetch all feeds, how many requests
+each fetch took (retries), and the fetch results. Scenarios with an expected result (e.g. stale feeds
+should be OLD_FEED) print how many fetches didn't get it.
+
+Usage:
+    python -m benchmarks.fetch [FEEDS_DIR] [--scenarios clean,slow,...] [--timeouts 1,2,3.2]
+                               [--attempts 1,2,3] [--hedges 0,90] [--rounds 5]
+Without FEEDS_DIR, a synthetic system (synthetic.py) is served.
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import statistics
+import tempfile
+import time
+from collections import Counter
+from typing import Dict, List, NamedTuple, Optional
+import fake_mta  # type: ignore
+import fake_redis  # type: ignore
+import realtime  # type: ignore
+import replay  # type: ignore
+import synthetic  # type: ignore
+import util as u  # type: ignore
+
+STATUS_NAMES = {
+    realtime.NONE: "NONE",
+    realtime.NEW_FEED: "NEW_FEED",
+    realtime.OLD_FEED: "OLD_FEED",
+    realtime.FETCH_FAILED: "FETCH_FAILED",
+    realtime.DECODE_FAILED: "DECODE_FAILED",
+    realtime.RUNTIME_WARNING: "RUNTIME_WARNING",
+    realtime.BREAKER_OPEN: "BREAKER_OPEN",
+    realtime.NOT_DUE: "NOT_DUE",
+}
+
+
+class Scenario(NamedTuple):
+    faults: fake_mta.Faults
+    expect: Optional[realtime.FetchStatus] = None  # the result every fetch should get, if there is one
+
+
+SCENARIOS: Dict[str, Scenario] = {
+    "clean": Scenario(fake_mta.Faults(), expect=realtime.NEW_FEED),
+    "slow": Scenario(fake_mta.Faults(latency=0.5, jitter=1.0)),
+    "straggler": Scenario(fake_mta.Faults(jitter=2.0)),
+    "hung": Scenario(fake_mta.Faults(latency=30.0), expect=realtime.FETCH_FAILED),
+    "errors": Scenario(fake_mta.Faults(error_rate=1.0), expect=realtime.FETCH_FAILED),
+    "flaky": Scenario(fake_mta.Faults(error_rate=0.3, jitter=0.5)),
+    "truncated": Scenario(fake_mta.Faults(truncate_rate=1.0), expect=realtime.DECODE_FAILED),
+    "stale": Scenario(fake_mta.Faults(stale_rate=1.0), expect=realtime.OLD_FEED),
+}
+
+
+class ScenarioResult(NamedTuple):
+    scenario: str
+    timeout: float
+    attempts: int
+    hedge: float
+    median_s: float
+    max_s: float
+    requests_per_fetch: float
+    statuses: Dict[str, int]
+    unexpected: int
+
+
+async def fetch_round(handlers: List[realtime.RealtimeFeedHandler]) -> float:
+    """ Fetches every feed once, like RealtimeManager.fetch_all; returns how long it took
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(handlers)) as executor:
+        start = time.perf_counter()
+        await asyncio.gather(*[fh.fetch(thread_pool_excecutor=executor) for fh in handlers])
+        return time.perf_counter() - start
+
+
+async def run_scenario(
+    name: str,
+    scenario: Scenario,
+    cycles: List[replay.Cycle],
+    timeout: float,
+    attempts: int,
+    hedge: float,
+    rounds: int,
+) -> ScenarioResult:
+    # the handlers' FetchPolicy is read from these
+    u.REALTIME_TIMEOUT, u.REALTIME_MAX_ATTEMPTS, u.REALTIME_HEDGE_PERCENTILE = timeout, attempts, hedge
+    u.REALTIME_FETCH_DEADLINE = timeout * attempts
+    server = fake_mta.FakeMTAServer(cycles)
+    base_url = await server.start()
+    try:
+        redis_server = fake_redis.FakeRedis()
+        handlers = [
+            realtime.RealtimeFeedHandler(base_url + feed_id, feed_id, redis_server)
+            for feed_id in u.GTFS_CONF.realtime_urls
+        ]
+        # clean rounds first, so stale feeds are older than what the handlers have & there are latencies to hedge with
+        for _ in range(realtime.HEDGE_MIN_SAMPLES):
+            await fetch_round(handlers)
+
+        server.default_faults = scenario.faults
+        durations: List[float] = []
+        statuses: Counter = Counter()
+        requests_before = sum(server.requests.values())
+        for _ in range(rounds):
+            server.advance()
+            durations.append(await fetch_round(handlers))
+            statuses.update(fh.result.status for fh in handlers)
+    finally:
+        await server.stop()
+
+    fetches = rounds * len(handlers)
+    return ScenarioResult(
+        scenario=name,
+        timeout=timeout,
+        attempts=attempts,
+        hedge=hedge,
+        median_s=statistics.median(durations),
+        max_s=max(durations),
+        requests_per_fetch=(sum(server.requests.values()) - requests_before) / fetches,
+        statuses={STATUS_NAMES[status]: count for status, count in sorted(statuses.items())},
+        # an open circuit breaker is the expected outcome for a feed that keeps failing
+        unexpected=(
+            fetches - statuses[scenario.expect] - statuses[realtime.BREAKER_OPEN] if scenario.expect is not None else 0
+        ),
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("feeds_dir", nargs="?")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--timeouts", default=str(u.REALTIME_TIMEOUT))
+    parser.add_argument("--attempts", default=str(u.REALTIME_MAX_ATTEMPTS))
+    parser.add_argument("--hedges", default=str(u.REALTIME_HEDGE_PERCENTILE), help="hedge percentiles, 0 to not hedge")
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="fetch") as tmp_dir:
+        if args.feeds_dir:
+            cycles = replay.load_cycles(args.feeds_dir)
+        else:
+            _, feeds_dir = synthetic.generate(tmp_dir, synthetic.SyntheticConf(cycles=args.rounds + 1))
+            cycles = replay.load_cycles(feeds_dir)
+
+    print(f"{'scenario':<12}{'timeout':>8}{'attempts':>9}{'hedge':>6}{'median s':>10}{'max s':>8}{'req/fetch':>11}  results")
+    loop = asyncio.get_event_loop()
+    for name in args.scenarios.split(","):
+        for timeout in map(float, args.timeouts.split(",")):
+            for attempts in map(int, args.attempts.split(",")):
+                for hedge in map(float, args.hedges.split(",")):
+                    result = loop.run_until_complete(
+                        run_scenario(name, SCENARIOS[name], cycles, timeout, attempts, hedge, args.rounds)
+                    )
+                    statuses = " ".join(f"{status}={count}" for status, count in result.statuses.items())
+                    unexpected = f"  ({result.unexpected} unexpected)" if result.unexpected else ""
+                    print(
+                        f"{name:<12}{timeout:>8.1f}{attempts:>9}{hedge:>6.0f}{result.median_s:>10.2f}"
+                        f"{result.max_s:>8.2f}{result.requests_per_fetch:>11.2f}  {statuses}{unexpected}"
+                    )
+
+
+if __name__ == "__main__":
+    main()
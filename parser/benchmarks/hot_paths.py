@@ -0,0 +1,182 @@
+""" Times each hot path of the parser on a synthetic system (see synthetic.py), so changes can be
+checked against a saved baseline.
+
+The cases are short_hash, StaticJSONDecoder decoding, merge_trips_and_stops, and RealtimeManager's
+merge_feeds, parse, diff, full_to_protobuf_zlib, diff_to_protobuf_zlib and a full update() cycle. Each case runs
+--repeat times after a warmup run, and its median & min are reported in ms.
+
+Usage:
+    python -m benchmarks.hot_paths [--scale 1] [--repeat 10] [--cases parse,diff]
+                                   [--save BASELINE.json] [--compare BASELINE.json] [--threshold 0.1]
+--compare exits with 1 if any case's median is more than --threshold (a fraction) slower than in the baseline.
+"""
+import argparse
+import json
+import statistics
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, NamedTuple
+import replay  # type: ignore
+import static  # type: ignore
+import synthetic  # type: ignore
+import util as u  # type: ignore
+
+WARMUP_CYCLES = 4  # replayed before timing, so the manager has snapshots & diffs to work with
+
+
+class Case(NamedTuple):
+    name: str
+    run: Callable[[Any], Any]
+    setup: Callable[[], Any] = lambda: None  # runs untimed before each run; its result is passed to run
+    items: int = 1  # work items per run, for throughput
+
+
+class CaseResult(NamedTuple):
+    name: str
+    runs: int
+    items: int
+    median_ms: float
+    min_ms: float
+
+    @property
+    def items_per_second(self) -> float:
+        return self.items / self.median_ms * 1000 if self.median_ms else 0.0
+
+
+def time_case(case: Case, repeat: int) -> CaseResult:
+    timings = []
+    for i in range(repeat + 1):
+        arg = case.setup()
+        start = time.perf_counter()
+        case.run(arg)
+        if i:  # the first run is a warmup
+            timings.append(time.perf_counter() - start)
+    return CaseResult(
+        name=case.name,
+        runs=repeat,
+        items=case.items,
+        median_ms=statistics.median(timings) * 1000,
+        min_ms=min(timings) * 1000,
+    )
+
+
+class Fixture:
+    """ A synthetic system replayed through a ReplayManager for WARMUP_CYCLES cycles, with enough
+    further cycles left over for the update case
+    """
+
+    def __init__(self, conf: synthetic.SyntheticConf, repeat: int) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory(prefix="hot_paths")
+        static_zip, feeds_dir = synthetic.generate(
+            self.tmp_dir.name, conf._replace(cycles=WARMUP_CYCLES + repeat + 1)
+        )
+        cycles = replay.load_cycles(feeds_dir)
+        self.clock = replay.FakeClock(cycles[0][0])
+        self.manager, self.redis_server = replay.set_up(static_zip, self.clock)
+        for cycle in cycles[:WARMUP_CYCLES]:
+            replay.run_cycle(self.manager, self.clock, cycle)
+        self.update_cycles = iter(cycles[WARMUP_CYCLES:])
+
+        self.static_json_str: str = self.redis_server.get("static:json_full").decode("utf-8")
+        self.ids: List[str] = []  # the trip & stop ids in the latest feeds, as the parser hashes them
+        for entity in self.manager.entities():
+            self.ids.append(entity.trip_update.trip.trip_id)
+            self.ids.extend(stop_time_update.stop_id for stop_time_update in entity.trip_update.stop_time_update)
+
+    def close(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def fresh_data(self) -> None:
+        """ Resets the manager's current_data to the static data, as at the start of a cycle
+        """
+        self.manager.load_static()
+
+    def next_cycle(self) -> None:
+        timestamp, feeds = next(self.update_cycles)
+        self.clock.now = timestamp
+        for fh in self.manager.feed_handlers:
+            fh.recorded = feeds.get(fh.id_)
+
+    def cases(self) -> List[Case]:
+        manager = self.manager
+        timestamps = manager.snapshots.timestamps()
+        old_data, new_data = manager.snapshots[timestamps[-2]], manager.snapshots[timestamps[-1]]
+        data_diff = manager.snapshots.diffs()[timestamps[-2]]
+
+        def hash_ids(_) -> None:
+            for id_ in self.ids:
+                u.short_hash(id_, u.StationHash)
+
+        return [
+            Case("short_hash", hash_ids, items=len(self.ids)),
+            Case("static_json_decode", lambda _: json.loads(self.static_json_str, cls=u.StaticJSONDecoder)),
+            Case("merge_trips_and_stops", lambda _: static.StaticHandler(self.redis_server).merge_trips_and_stops()),
+            Case("merge_feeds", lambda _: manager.merge_feeds()),
+            Case("parse", lambda _: manager.parse(), setup=self.fresh_data, items=len(list(manager.entities()))),
+            Case("diff", lambda _: manager.diff(old_data, new_data)),
+            Case("full_to_protobuf_zlib", lambda _: manager.full_to_protobuf_zlib()),
+            Case("diff_to_protobuf_zlib", lambda _: manager.diff_to_protobuf_zlib(data_diff)),
+            Case("update", lambda _: manager.update(), setup=self.next_cycle),
+        ]
+
+
+def compare(results: List[CaseResult], baseline_path: str, threshold: float) -> int:
+    """ Prints the cases whose median is more than threshold slower than the baseline's; returns how many were
+    """
+    with open(baseline_path) as in_stream:
+        baseline = {r["name"]: r for r in json.load(in_stream)["results"]}
+
+    regressions = 0
+    for result in results:
+        expected = baseline.get(result.name)
+        if expected is None:
+            print(f"{result.name}: not in baseline")
+            continue
+        change = result.median_ms / expected["median_ms"] - 1 if expected["median_ms"] else 0.0
+        if change > threshold:
+            print(f"REGRESSION {result.name}: {expected['median_ms']:.2f}ms -> {result.median_ms:.2f}ms ({change:+.0%})")
+            regressions += 1
+        else:
+            print(f"ok {result.name}: {expected['median_ms']:.2f}ms -> {result.median_ms:.2f}ms ({change:+.0%})")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--cases", help="comma separated case names, all by default")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="flag regressions against this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args()
+
+    conf = synthetic.SyntheticConf(seed=args.seed).scaled(args.scale)
+    fixture = Fixture(conf, args.repeat)
+    try:
+        cases = fixture.cases()
+        if args.cases:
+            names = args.cases.split(",")
+            cases = [case for case in cases if case.name in names]
+
+        results = []
+        print(f"{'case':<24}{'median ms':>12}{'min ms':>12}{'items/s':>14}")
+        for case in cases:
+            result = time_case(case, args.repeat)
+            results.append(result)
+            print(f"{result.name:<24}{result.median_ms:>12.2f}{result.min_ms:>12.2f}{result.items_per_second:>14.0f}")
+    finally:
+        fixture.close()
+
+    if args.save:
+        report: Dict[str, Any] = {"conf": conf._asdict(), "results": [r._asdict() for r in results]}
+        with open(args.save, "w") as out_stream:
+            json.dump(report, out_stream, indent=1)
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+""" Times the journey planner (planner.py) on a synthetic system (see synthetic.py): rebuilding its index from
+scratch, updating it incrementally from one cycle's diff, and answering queries between random pairs of stations,
+leaving at the data's timestamp.
+
+The synthetic feeds re-time nearly every trip each cycle, so "update" rebuilds nearly every pattern and is no
+faster than "build"; "update1" applies a diff re-timing a single trip, where only its branch's patterns are
+rebuilt.
+
+Query latency is reported as percentiles over --queries queries, with how many found a journey and their average
+number of legs.
+
+Usage:
+    python -m benchmarks.planner [--scale 1] [--queries 1000] [--repeat 10] [--max-transfers 3]
+                                 [--save BASELINE.json] [--compare BASELINE.json] [--threshold 0.1]
+"""
+import argparse
+import json
+import random
+import sys
+import time
+from dataclasses import replace
+from typing import List
+import planner  # type: ignore
+import synthetic  # type: ignore
+from benchmarks import hot_paths  # type: ignore
+from benchmarks.fanout import percentile  # type: ignore
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=10, help="runs of the build & update cases")
+    parser.add_argument("--max-transfers", type=int, default=3)
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="flag regressions against this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args()
+
+    fixture = hot_paths.Fixture(synthetic.SyntheticConf(seed=args.seed).scaled(args.scale), repeat=0)
+    try:
+        snapshots = fixture.manager.snapshots
+        timestamps = snapshots.timestamps()
+        old_data, new_data = snapshots[timestamps[-2]], snapshots[timestamps[-1]]
+        data_diff = snapshots.diffs()[timestamps[-2]]
+
+        # the second-to-last snapshot, with one trip running a minute later
+        late_trip = next(iter(old_data.trips.values()))
+        late_trips = dict(old_data.trips)
+        late_trips[late_trip.id_] = replace(
+            late_trip, arrivals={station: arrival_time + 60 for station, arrival_time in late_trip.arrivals.items()}
+        )
+        late_data = replace(old_data, realtime_timestamp=old_data.realtime_timestamp + 1, trips=late_trips)
+        late_diff = fixture.manager.diff(old_data, late_data)
+
+        def fresh_index() -> planner.Planner:
+            index = planner.Planner()
+            index.update(None, old_data, None)
+            return index
+
+        results = [
+            hot_paths.time_case(hot_paths.Case("build", lambda _: planner.Planner().build(new_data)), args.repeat),
+            hot_paths.time_case(
+                hot_paths.Case("update", lambda index: index.update(old_data, new_data, data_diff), setup=fresh_index),
+                args.repeat,
+            ),
+            hot_paths.time_case(
+                hot_paths.Case(
+                    "update1", lambda index: index.update(old_data, late_data, late_diff), setup=fresh_index
+                ),
+                args.repeat,
+            ),
+        ]
+
+        index = planner.Planner()
+        index.build(new_data)
+        rng = random.Random(args.seed)
+        stations = sorted(new_data.stations)
+        latencies: List[float] = []
+        legs: List[int] = []
+        for _ in range(args.queries):
+            origin, destination = rng.sample(stations, 2)
+            start = time.perf_counter()
+            journey = index.plan(origin, destination, new_data.realtime_timestamp, args.max_transfers)
+            latencies.append(time.perf_counter() - start)
+            if journey is not None:
+                legs.append(len(journey.legs))
+    finally:
+        fixture.close()
+
+    patterns = sum(len(patterns) for patterns in index.patterns.values())
+    print(f"{len(new_data.trips)} trips, {len(stations)} stations, {patterns} patterns")
+    for result in results:
+        print(f"{result.name:<8} median {result.median_ms:8.2f}ms   min {result.min_ms:8.2f}ms")
+    print(f"query    p50 {percentile(latencies, 0.5) * 1000:8.2f}ms   p95 {percentile(latencies, 0.95) * 1000:8.2f}ms"
+          f"   p99 {percentile(latencies, 0.99) * 1000:8.2f}ms   max {max(latencies) * 1000:8.2f}ms")
+    print(f"found    {len(legs)} of {args.queries} journeys, {sum(legs) / max(1, len(legs)):.1f} legs on average")
+
+    results += [
+        hot_paths.CaseResult(name=name, runs=args.queries, items=1, median_ms=ms, min_ms=ms)
+        for name, ms in [
+            ("query_p50", percentile(latencies, 0.5) * 1000),
+            ("query_p99", percentile(latencies, 0.99) * 1000),
+        ]
+    ]
+    if args.save:
+        with open(args.save, "w") as out_stream:
+            json.dump({"results": [r._asdict() for r in results]}, out_stream, indent=1)
+    if args.compare and hot_paths.compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+""" Measures parser startup: the time from launching a fresh process to its first publish, split into
+interpreter start, imports, setting up the RealtimeManager and the first publish.
+
+Each run is a new process starting against fake_redis with the static data already parsed, as when the
+parser restarts, after --cycles cycles of a synthetic system (see synthetic.py). A cold start publishes
+after its first update(); a warm start restores the checkpoint written by the previous run (see
+checkpoint.py) and publishes it. It also checks that pandas wasn't imported along the way.
+
+Usage:
+    python -m benchmarks.startup [--repeat 5] [--cycles 8] [--save BASELINE.json] [--compare BASELINE.json]
+                                 [--threshold 0.1]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+# only the standard library is imported up here, since child processes import this module too
+PARSER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+MODES = ["cold", "warm"]
+STAGES = ["interpreter", "imports", "setup", "first_publish", "total"]
+
+
+def first_publish(mode: str, static_json_path: str, feeds_dir: str) -> Dict[str, float]:
+    """ Runs in the child process: imports the parser, then either replays the last cycle (cold) or
+    restores the checkpoint & publishes it (warm)
+    """
+    start = time.perf_counter()
+    import fake_redis  # type: ignore
+    import main  # type: ignore
+    import replay  # type: ignore
+    import util as u  # type: ignore
+
+    imported = time.perf_counter()
+    redis_server = fake_redis.FakeRedis()
+    with open(static_json_path) as in_stream:
+        redis_server.set("static:json_full", in_stream.read())
+    cycles = replay.load_cycles(feeds_dir)
+    clock = replay.FakeClock(cycles[-1][0] + u.REALTIME_FREQ)
+    manager = replay.ReplayManager(main.RedisHandler(redis_server), clock=clock)
+
+    set_up = time.perf_counter()
+    if mode == "warm":
+        if not manager.publish_checkpoint():
+            raise SystemExit("the checkpoint wasn't restored")
+    else:
+        report = replay.run_cycle(manager, clock, cycles[-1])
+        if report.result != "published":
+            raise SystemExit(f"the first cycle wasn't published: {report.result}")
+    published = time.perf_counter()
+
+    return {
+        "imports": imported - start,
+        "setup": set_up - imported,
+        "first_publish": published - set_up,
+        "pandas_imported": float("pandas" in sys.modules),
+    }
+
+
+def prepare(tmp_dir: str, cycles: int) -> List[str]:
+    """ Writes a synthetic system & its parsed static JSON to tmp_dir, and replays it to write a checkpoint
+    there; returns the child's arguments
+    """
+    import replay  # type: ignore
+    import synthetic  # type: ignore
+    import util as u  # type: ignore
+
+    static_zip, feeds_dir = synthetic.generate(tmp_dir, synthetic.SyntheticConf(cycles=cycles))
+    u.REALTIME_CHECKPOINT_EVERY, u.REALTIME_CHECKPOINT_PATH = cycles, os.path.join(tmp_dir, "checkpoint.bin")
+    replayed = replay.load_cycles(feeds_dir)
+    clock = replay.FakeClock(replayed[0][0])
+    manager, redis_server = replay.set_up(static_zip, clock)
+    for cycle in replayed:
+        replay.run_cycle(manager, clock, cycle)
+    if not os.path.exists(u.REALTIME_CHECKPOINT_PATH):
+        raise SystemExit("no checkpoint was written")
+
+    static_json_path = os.path.join(tmp_dir, "static.json")
+    with open(static_json_path, "wb") as out_stream:
+        out_stream.write(redis_server.get("static:json_full"))
+    return [static_json_path, feeds_dir, u.REALTIME_CHECKPOINT_PATH]
+
+
+def run_child(mode: str, args: List[str]) -> Dict[str, float]:
+    static_json_path, feeds_dir, checkpoint_path = args
+    env = dict(
+        os.environ,
+        REALTIME_CHECKPOINT_EVERY="1" if mode == "warm" else "0",
+        REALTIME_CHECKPOINT_PATH=checkpoint_path,
+    )
+    start = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, "-m", "benchmarks.startup", "--child", mode, static_json_path, feeds_dir],
+        cwd=PARSER_DIR,
+        env=env,
+        check=True,
+        stdout=subprocess.PIPE,
+    ).stdout
+    timings = json.loads(output.decode("utf-8").strip().splitlines()[-1])
+    timings["total"] = time.perf_counter() - start
+    timings["interpreter"] = timings["total"] - timings["imports"] - timings["setup"] - timings["first_publish"]
+    return timings
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--cycles", type=int, default=8, help="replayed before the restart")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="flag regressions against this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    parser.add_argument("--child", nargs=3, metavar=("MODE", "STATIC_JSON", "FEEDS_DIR"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(first_publish(*args.child)))
+        return
+
+    from benchmarks import hot_paths  # type: ignore
+
+    with tempfile.TemporaryDirectory(prefix="startup") as tmp_dir:
+        child_args = prepare(tmp_dir, args.cycles)
+        runs = {mode: [run_child(mode, child_args) for _ in range(args.repeat)] for mode in MODES}
+
+    if any(run["pandas_imported"] for mode_runs in runs.values() for run in mode_runs):
+        print("WARNING: pandas was imported before the first publish")
+
+    results = []
+    print(f"{'start':<6}{'stage':<16}{'median ms':>12}{'min ms':>12}")
+    for mode in MODES:
+        for stage in STAGES:
+            timings = [run[stage] for run in runs[mode]]
+            result = hot_paths.CaseResult(
+                name=f"{mode}_{stage}",
+                runs=len(timings),
+                items=1,
+                median_ms=statistics.median(timings) * 1000,
+                min_ms=min(timings) * 1000,
+            )
+            results.append(result)
+            print(f"{mode:<6}{stage:<16}{result.median_ms:>12.1f}{result.min_ms:>12.1f}")
+
+    if args.save:
+        with open(args.save, "w") as out_stream:
+            json.dump({"results": [r._asdict() for r in results]}, out_stream, indent=1)
+    if args.compare and hot_paths.compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+""" The optional station departure boards (REALTIME_BOARDS): an index of the upcoming arrivals at each station,
+by direction and route, for answering "what's arriving at station X" without scanning every trip.
+
+BoardIndex is updated incrementally from each published cycle's diff from the previous one (rebuilt from
+scratch when there isn't one), and reports which stations' boards changed. Only those are re-encoded and
+pushed, each as a small compressed JSON blob in the realtime:boards hash (see RealtimeManager.push_boards):
+    {"station": STATION_HASH, "timestamp": REALTIME_TIMESTAMP,
+     "n": {ROUTE_HASH: [[ARRIVAL_TIME, TRIP_HASH, FINAL_STATION_HASH, STATUS], ...]}, "s": {...}}
+with at most REALTIME_BOARD_DEPTH arrivals per route & direction, soonest first.
+"""
+import heapq
+import itertools
+import json
+from bisect import bisect_left, insort
+from typing import Dict, Iterable, List, Mapping, Optional, Set
+import util as u  # type: ignore
+
+DIRECTION_KEYS = {True: "n", False: "s"}
+
+Board = Dict[bool, Dict[u.RouteHash, List[u.StationArrival]]]  # by direction, then route; sorted by time
+
+
+class BoardIndex:
+    def __init__(self) -> None:
+        self.boards: Dict[u.StationHash, Board] = {}
+        self.timestamp = 0  # of the data the index reflects
+
+    def __contains__(self, station: u.StationHash) -> bool:
+        return station in self.boards
+
+    def update(
+        self, old_data: Optional[u.RealtimeData], new_data: u.RealtimeData, data_diff: Optional[u.DataDiff]
+    ) -> Set[u.StationHash]:
+        """ Brings the index from old_data to new_data, applying data_diff (from old_data to new_data) if the
+        index reflects old_data, or rebuilding it otherwise. Returns the stations whose boards changed.
+        """
+        if old_data is not None and data_diff is not None and old_data.realtime_timestamp == self.timestamp:
+            changed = self.apply(data_diff, old_data.trips, new_data.trips)
+        else:
+            changed = self.build(new_data.trips)
+        self.timestamp = new_data.realtime_timestamp
+        return changed
+
+    def build(self, trips: Mapping[u.TripHash, u.Trip]) -> Set[u.StationHash]:
+        changed = set(self.boards)
+        self.boards = {}
+        for trip in trips.values():
+            self.add_arrivals(trip, trip.arrivals, changed)
+        return changed
+
+    def apply(
+        self, data_diff: u.DataDiff, old_trips: Mapping[u.TripHash, u.Trip], new_trips: Mapping[u.TripHash, u.Trip]
+    ) -> Set[u.StationHash]:
+        changed: Set[u.StationHash] = set()
+        for trip_hash in data_diff.trips.deleted:
+            self.remove_arrivals(old_trips[trip_hash], old_trips[trip_hash].arrivals, changed)
+        for trip in data_diff.trips.added:
+            self.add_arrivals(trip, trip.arrivals, changed)
+
+        # a trip that changed branch may have changed route, so all its arrivals move
+        moved = set(data_diff.branch.modified)
+        for trip_hash in moved:
+            self.remove_arrivals(old_trips[trip_hash], old_trips[trip_hash].arrivals, changed)
+            self.add_arrivals(new_trips[trip_hash], new_trips[trip_hash].arrivals, changed)
+
+        for trip_hash, stations in data_diff.arrivals.deleted.items():
+            if trip_hash not in moved:
+                self.remove_arrivals(old_trips[trip_hash], pick(old_trips[trip_hash].arrivals, stations), changed)
+        for trip_hash, arrivals in data_diff.arrivals.added.items():
+            if trip_hash not in moved:
+                self.add_arrivals(new_trips[trip_hash], arrivals, changed)
+        for trip_stations in data_diff.arrivals.modified.values():
+            for trip_hash, stations in trip_stations.items():
+                if trip_hash not in moved:
+                    old_trip, new_trip = old_trips[trip_hash], new_trips[trip_hash]
+                    self.remove_arrivals(old_trip, pick(old_trip.arrivals, stations), changed)
+                    self.add_arrivals(new_trip, pick(new_trip.arrivals, stations), changed)
+
+        for trip_hash in data_diff.status.modified:
+            changed.update(new_trips[trip_hash].arrivals)  # the blobs include each trip's status
+        return changed
+
+    def add_arrivals(
+        self, trip: u.Trip, arrivals: Mapping[u.StationHash, u.ArrivalTime], changed: Set[u.StationHash]
+    ) -> None:
+        for station, arrival_time in arrivals.items():
+            board = self.boards.setdefault(station, {})
+            insort(board.setdefault(trip.direction, {}).setdefault(trip.branch.route, []),
+                   u.StationArrival(arrival_time, trip.id_))
+            changed.add(station)
+
+    def remove_arrivals(
+        self, trip: u.Trip, arrivals: Mapping[u.StationHash, u.ArrivalTime], changed: Set[u.StationHash]
+    ) -> None:
+        for station, arrival_time in arrivals.items():
+            by_route = self.boards[station][trip.direction]
+            entries = by_route[trip.branch.route]
+            del entries[bisect_left(entries, u.StationArrival(arrival_time, trip.id_))]
+            if not entries:
+                del by_route[trip.branch.route]
+                if not by_route:
+                    del self.boards[station][trip.direction]
+                    if not self.boards[station]:
+                        del self.boards[station]
+            changed.add(station)
+
+    def next_arrivals(
+        self,
+        station: u.StationHash,
+        direction: Optional[bool] = None,
+        route: Optional[u.RouteHash] = None,
+        limit: Optional[int] = None,
+    ) -> List[u.StationArrival]:
+        """ The upcoming arrivals at station, soonest first, optionally only in one direction or on one route
+        """
+        board = self.boards.get(station, {})
+        lists: Iterable[List[u.StationArrival]] = (
+            entries
+            for dir_, by_route in board.items()
+            if direction is None or dir_ == direction
+            for route_, entries in by_route.items()
+            if route is None or route_ == route
+        )
+        return list(itertools.islice(heapq.merge(*lists), limit))
+
+    def encode(self, station: u.StationHash, trips: Mapping[u.TripHash, u.Trip], depth: int) -> bytes:
+        """ station's board as JSON, with at most depth arrivals per route & direction
+        """
+        board = {
+            DIRECTION_KEYS[direction]: {
+                str(route): [
+                    [arrival_time, trip_hash, trips[trip_hash].branch.final_station, trips[trip_hash].status]
+                    for arrival_time, trip_hash in entries[:depth]
+                ]
+                for route, entries in by_route.items()
+            }
+            for direction, by_route in self.boards.get(station, {}).items()
+        }
+        return json.dumps(
+            dict(station=station, timestamp=self.timestamp, **board), separators=(",", ":")
+        ).encode("utf-8")
+
+
+def pick(arrivals: Mapping[u.StationHash, u.ArrivalTime], stations: Iterable[u.StationHash]) -> Dict[u.StationHash, u.ArrivalTime]:
+    return {station: arrivals[station] for station in stations}
@@ -0,0 +1,69 @@
+""" Checkpoints of RealtimeManager's in-memory state, for warm restarts.
+
+A checkpoint holds the retained snapshots (with their compressed diffs), the last full payload, the
+decoded static data and each feed's latest message, pickled into one file after a short header. On
+boot, RealtimeManager restores it instead of re-parsing realtime:feeds and rebuilding its snapshots,
+and can publish the restored payload right away (see RealtimeManager.publish_checkpoint).
+
+The file is only ever read by the parser that wrote it, and is replaced atomically.
+"""
+import os
+import pickle
+from typing import Dict, List, NamedTuple, Optional, Tuple
+import util as u  # type: ignore
+
+MAGIC = b"MTACKPT"
+VERSION = 1  # bump when the pickled classes change in ways older checkpoints can't be loaded into
+
+
+class FeedState(NamedTuple):
+    raw: bytes  # the serialized latest FeedMessage
+    latest_timestamp: int
+    header_timestamps: List[int]
+
+
+class Checkpoint(NamedTuple):
+    written_at: float
+    current_timestamp: int
+    current_fingerprint: str
+    current_data_zlib: bytes
+    current_data_size: int
+    static_json_str: str
+    static_data: u.StaticData
+    snapshots: List[Tuple[int, u.RealtimeData, Optional[bytes]]]  # (timestamp, data, diff_zlib), oldest first
+    feeds: Dict[str, FeedState]  # by feed id
+
+
+def write(path: str, checkpoint: Checkpoint) -> int:
+    """ Writes checkpoint to path, returning its size in bytes
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as out_stream:
+        out_stream.write(MAGIC + bytes([VERSION]))
+        pickle.dump(checkpoint, out_stream, protocol=pickle.HIGHEST_PROTOCOL)
+        size = out_stream.tell()
+    os.replace(tmp_path, path)
+    return size
+
+
+def read(path: str) -> Optional[Checkpoint]:
+    """ Returns the checkpoint at path, or None if there isn't one or it can't be loaded
+    """
+    try:
+        with open(path, "rb") as in_stream:
+            blob = in_stream.read()
+    except FileNotFoundError:
+        return None
+    except OSError as err:
+        u.log.error("parser: could not read checkpoint %s: %s", path, err)
+        return None
+
+    header = MAGIC + bytes([VERSION])
+    if not blob.startswith(header):
+        u.log.warning("parser: ignoring checkpoint %s from another version", path)
+        return None
+    try:
+        return pickle.loads(memoryview(blob)[len(header):])
+    except (pickle.UnpicklingError, EOFError, AttributeError, ImportError, TypeError, ValueError) as err:
+        u.log.error("parser: could not load checkpoint %s: %s", path, err)
+        return None
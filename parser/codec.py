@@ -0,0 +1,131 @@
+""" Compression codecs for the full & diff payloads pushed to clients.
+
+Every payload starts with a two byte header -- CODEC_MAGIC, then the codec id -- so that
+readers know how to decompress it. Payloads without the header are legacy zlib streams.
+"""
+import zlib
+from typing import Dict, NewType, Optional, Type
+import util as u  # type: ignore
+
+try:
+    import zstandard  # type: ignore
+except ImportError:
+    zstandard = None
+
+CODEC_MAGIC = 0xDA  # never a valid zlib CMF byte, so legacy payloads can't be mistaken for it
+HEADER_LEN = 2
+
+CodecId = NewType("CodecId", int)
+ZLIB, DEFLATE, ZSTD = list(map(CodecId, range(3)))
+
+
+class Codec:
+    """ Base class for payload codecs. Subclasses implement compress() & decompress().
+    """
+
+    id_: CodecId
+    name: str
+    default_level: int
+
+    def __init__(self, level: Optional[int] = None) -> None:
+        self.level = self.default_level if level is None else level
+        self.header = bytes([CODEC_MAGIC, self.id_])
+
+    def __repr__(self) -> str:
+        return f"{self.name}:{self.level}"
+
+    def compress(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+    def decompress(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+    def encode(self, data: bytes) -> bytes:
+        """ Compresses data and prepends the codec header
+        """
+        return self.header + self.compress(data)
+
+
+class ZlibCodec(Codec):
+    id_ = ZLIB
+    name = "zlib"
+    default_level = 9
+
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+
+class DeflateCodec(Codec):
+    """ Raw deflate: zlib without the 2 byte header and the adler32 trailer
+    """
+
+    id_ = DEFLATE
+    name = "deflate"
+    default_level = 9
+
+    def compress(self, data: bytes) -> bytes:
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data, -zlib.MAX_WBITS)
+
+
+class ZstdCodec(Codec):
+    """ Requires the optional 'zstandard' package
+    """
+
+    id_ = ZSTD
+    name = "zstd"
+    default_level = 3
+
+    def __init__(self, level: Optional[int] = None) -> None:
+        if zstandard is None:
+            raise ImportError("zstandard is not installed")
+        super().__init__(level)
+        self.compressor = zstandard.ZstdCompressor(level=self.level)
+        self.decompressor = zstandard.ZstdDecompressor()
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return self.decompressor.decompress(data)
+
+
+CODECS: Dict[str, Type[Codec]] = {c.name: c for c in [ZlibCodec, DeflateCodec, ZstdCodec]}
+CODECS_BY_ID: Dict[CodecId, Type[Codec]] = {c.id_: c for c in CODECS.values()}
+
+
+def get_codec(name: str = u.COMPRESSION_CODEC, level: Optional[int] = u.COMPRESSION_LEVEL) -> Codec:
+    """ Returns a codec instance for the given name & level (the codec's default if None), falling back to zlib
+    if the codec is unknown or its library isn't installed.
+    """
+    if name not in CODECS:
+        u.log.warning("Unknown compression codec %s, using zlib", name)
+        name = "zlib"
+    if name == "zstd" and zstandard is None:
+        u.log.warning("zstandard is not installed, using zlib")
+        name = "zlib"
+    return CODECS[name](level)
+
+
+_decoders: Dict[CodecId, Codec] = {}
+
+
+def decode(payload: bytes) -> bytes:
+    """ Decompresses a payload produced by Codec.encode() (or a legacy, headerless zlib payload)
+    """
+    if not payload or payload[0] != CODEC_MAGIC:
+        return zlib.decompress(payload)
+
+    codec_id = CodecId(payload[1])
+    if codec_id not in _decoders:
+        try:
+            _decoders[codec_id] = CODECS_BY_ID[codec_id]()
+        except (KeyError, ImportError) as err:
+            raise ValueError(f"Cannot decode codec id {codec_id}: {err}")
+    return _decoders[codec_id].decompress(payload[HEADER_LEN:])
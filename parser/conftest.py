@@ -0,0 +1,8 @@
+""" pytest setup for the parser's tests, which run from this directory (the modules import each other flat)
+"""
+import os
+
+# util exits without these; the tests only talk to fake_redis & local servers
+os.environ.setdefault("REDIS_HOSTNAME", "localhost")
+os.environ.setdefault("REDIS_PORT", "6379")
+os.environ.setdefault("MTA_API_KEY", "test")
@@ -0,0 +1,158 @@
+""" A local stand-in for the MTA realtime API, for exercising RealtimeFeedHandler.fetch() (timeouts,
+retries, OLD_FEED handling) without the network.
+
+It serves recorded or synthetic feeds (a directory in the replay.py layout, <timestamp><feed_id>.pb) at
+/gtfs<feed_id> for each of the nine feed ids, moving on to the next recorded cycle on advance(). Faults
+can be injected per feed: latency (with jitter), HTTP errors, truncated bodies, and stale feeds (the
+feed last served again, so its header timestamp doesn't move).
+
+Usage:
+    python fake_mta.py FEEDS_DIR [--port 8765] [--cycle-seconds 15] [--latency 0] [--error-rate 0] ...
+then run the parser with MTA_REALTIME_BASE_URL=http://localhost:8765/gtfs
+"""
+import argparse
+import asyncio
+import random
+from collections import Counter
+from typing import Dict, List, NamedTuple, Optional, Set
+from aiohttp import web  # type: ignore
+import replay  # type: ignore
+import util as u  # type: ignore
+
+PATH_PREFIX = "/gtfs"
+
+
+class Faults(NamedTuple):
+    latency: float = 0.0  # seconds before responding
+    jitter: float = 0.0  # up to this many extra seconds, uniformly distributed
+    error_rate: float = 0.0  # fraction of requests answered with error_status
+    error_status: int = 503
+    truncate_rate: float = 0.0  # fraction of responses cut to half their length
+    stale_rate: float = 0.0  # fraction of responses repeating the feed last served
+
+
+class FakeMTAServer:
+    def __init__(
+        self,
+        cycles: List[replay.Cycle],
+        faults: Optional[Dict[str, Faults]] = None,
+        default_faults: Faults = Faults(),
+        api_key: Optional[str] = None,
+        seed: int = 0,
+    ) -> None:
+        if not cycles:
+            raise ValueError("no feeds to serve")
+        self.cycles = cycles
+        self.faults: Dict[str, Faults] = faults or {}
+        self.default_faults = default_faults
+        self.api_key = api_key  # if set, requests without a matching x-api-key header get a 401
+        self.rng = random.Random(seed)
+        self.cycle = 0
+        self.requests: Counter = Counter()  # feed_id -> requests served
+        self.served: Dict[str, bytes] = {}  # feed_id -> the feed last served
+        self.delays: Set[asyncio.Future] = set()
+        self.runner: Optional[web.AppRunner] = None
+
+    def advance(self) -> bool:
+        """ Moves on to the next recorded cycle; returns False (and stays put) after the last one
+        """
+        if self.cycle + 1 >= len(self.cycles):
+            return False
+        self.cycle += 1
+        return True
+
+    def feed_at(self, cycle: int, feed_id: str) -> Optional[bytes]:
+        """ The feed as of the given cycle, i.e. from the latest cycle up to it that recorded the feed
+        """
+        for _, feeds in reversed(self.cycles[: cycle + 1]):
+            if feed_id in feeds:
+                return feeds[feed_id]
+        return None
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        feed_id = request.path[len(PATH_PREFIX):]
+        if feed_id not in u.GTFS_CONF.realtime_urls:
+            raise web.HTTPNotFound()
+        if self.api_key is not None and request.headers.get("x-api-key") != self.api_key:
+            raise web.HTTPUnauthorized()
+
+        self.requests[feed_id] += 1
+        faults = self.faults.get(feed_id, self.default_faults)
+        delay = faults.latency + self.rng.random() * faults.jitter
+        if delay:
+            # cancelled by stop(), so hung responses don't hold up shutdown
+            sleep = asyncio.ensure_future(asyncio.sleep(delay))
+            self.delays.add(sleep)
+            try:
+                await sleep
+            except asyncio.CancelledError:
+                raise web.HTTPServiceUnavailable()
+            finally:
+                self.delays.discard(sleep)
+
+        if self.rng.random() < faults.error_rate:
+            return web.Response(status=faults.error_status, text="fake_mta: injected error")
+
+        if self.rng.random() < faults.stale_rate and feed_id in self.served:
+            body = self.served[feed_id]
+        else:
+            body = self.feed_at(self.cycle, feed_id)
+            if body is None:
+                raise web.HTTPNotFound()
+            self.served[feed_id] = body
+        if self.rng.random() < faults.truncate_rate:
+            body = body[: len(body) // 2]
+        return web.Response(body=body, content_type="application/octet-stream")
+
+    async def start(self, host: str = "localhost", port: int = 0) -> str:
+        """ Starts serving, returning the base url to use as MTA_REALTIME_BASE_URL
+        """
+        app = web.Application()
+        app.router.add_get(PATH_PREFIX + "{feed_id:.*}", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = self.runner.addresses[0][1]
+        return f"http://{host}:{port}{PATH_PREFIX}"
+
+    async def stop(self) -> None:
+        for sleep in list(self.delays):
+            sleep.cancel()
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+async def serve(server: FakeMTAServer, port: int, cycle_seconds: float) -> None:
+    base_url = await server.start(host="0.0.0.0", port=port)
+    print(f"serving {len(server.cycles)} cycles; set MTA_REALTIME_BASE_URL={base_url.replace('0.0.0.0', 'localhost')}")
+    while True:
+        await asyncio.sleep(cycle_seconds)
+        if not server.advance():
+            break
+    print("reached the last cycle, serving it from now on")
+    while True:
+        await asyncio.sleep(3600)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("feeds_dir")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--cycle-seconds", type=float, default=u.REALTIME_FREQ)
+    parser.add_argument("--api-key", help="require this x-api-key header")
+    parser.add_argument("--seed", type=int, default=0)
+    for field, default in Faults()._asdict().items():
+        parser.add_argument(f"--{field.replace('_', '-')}", type=type(default), default=default)
+    args = parser.parse_args()
+
+    faults = Faults(**{field: getattr(args, field) for field in Faults._fields})
+    server = FakeMTAServer(
+        replay.load_cycles(args.feeds_dir), default_faults=faults, api_key=args.api_key, seed=args.seed
+    )
+    asyncio.get_event_loop().run_until_complete(serve(server, args.port, args.cycle_seconds))
+
+
+if __name__ == "__main__":
+    main()
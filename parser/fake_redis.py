@@ -0,0 +1,326 @@
+""" A small in-memory stand-in for redis.Redis, for running the parser offline (replays, benchmarks,
+trying out the stream backend) without a Redis server.
+
+Only the commands the parser uses are implemented. Like redis-py, values are stored and returned as bytes.
+"""
+import time
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import redis
+import leader  # type: ignore
+
+Fields = Dict[bytes, bytes]
+
+
+class _Stream(list):
+    """ A stream is a list of (entry id, fields) tuples, kept apart from plain lists for type checks
+    """
+
+
+def _encode(value: Any) -> bytes:
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, str):
+        return value.encode("utf-8")
+    if isinstance(value, (int, float)):
+        return repr(value).encode("utf-8")
+    raise TypeError(f"Invalid input of type {type(value).__name__}")
+
+
+def _parse_stream_id(id_: Any) -> Tuple[int, int]:
+    ms, _, seq = _encode(id_).decode("utf-8").partition("-")
+    return int(ms), int(seq or 0)
+
+
+class FakeRedis:
+    def __init__(self) -> None:
+        self.lock = threading.RLock()
+        self.data: Dict[bytes, Any] = {}
+        self.expires: Dict[bytes, float] = {}
+        self.published: List[Tuple[bytes, bytes]] = []
+
+    def _expire_keys(self) -> None:
+        now = time.time()
+        for key in [k for k, t in self.expires.items() if t <= now]:
+            self.data.pop(key, None)
+            del self.expires[key]
+
+    def _get(self, name: Any, type_: type, create: bool = False) -> Any:
+        self._expire_keys()
+        key = _encode(name)
+        value = self.data.get(key)
+        if value is None:
+            if not create:
+                return None
+            value = self.data[key] = type_()
+        elif not isinstance(value, type_):
+            raise TypeError("WRONGTYPE Operation against a key holding the wrong kind of value")
+        return value
+
+    # keys
+    def exists(self, *names: Any) -> int:
+        with self.lock:
+            self._expire_keys()
+            return sum(_encode(name) in self.data for name in names)
+
+    def delete(self, *names: Any) -> int:
+        with self.lock:
+            deleted = 0
+            for name in names:
+                deleted += self.data.pop(_encode(name), None) is not None
+                self.expires.pop(_encode(name), None)
+            return deleted
+
+    def pexpire(self, name: Any, time_ms: int) -> bool:
+        with self.lock:
+            if not self.exists(name):
+                return False
+            self.expires[_encode(name)] = time.time() + time_ms / 1000
+            return True
+
+    def expire(self, name: Any, time_s: int) -> bool:
+        return self.pexpire(name, time_s * 1000)
+
+    # strings
+    def get(self, name: Any) -> Optional[bytes]:
+        with self.lock:
+            return self._get(name, bytes)
+
+    def set(self, name: Any, value: Any, ex=None, px=None, nx=False, xx=False) -> Optional[bool]:
+        with self.lock:
+            exists = bool(self.exists(name))
+            if (nx and exists) or (xx and not exists):
+                return None
+            key = _encode(name)
+            self.data[key] = _encode(value)
+            self.expires.pop(key, None)
+            if ex is not None:
+                self.expire(name, ex)
+            if px is not None:
+                self.pexpire(name, px)
+            return True
+
+    def incr(self, name: Any, amount: int = 1) -> int:
+        with self.lock:
+            value = int(self._get(name, bytes) or 0) + amount
+            self.data[_encode(name)] = _encode(value)
+            return value
+
+    # hashes
+    def hset(self, name: Any, key: Any, value: Any) -> int:
+        with self.lock:
+            hash_ = self._get(name, dict, create=True)
+            added = _encode(key) not in hash_
+            hash_[_encode(key)] = _encode(value)
+            return int(added)
+
+    def hmset(self, name: Any, mapping: Dict[Any, Any]) -> bool:
+        with self.lock:
+            for key, value in mapping.items():
+                self.hset(name, key, value)
+            return True
+
+    def hget(self, name: Any, key: Any) -> Optional[bytes]:
+        with self.lock:
+            return (self._get(name, dict) or {}).get(_encode(key))
+
+    def hgetall(self, name: Any) -> Fields:
+        with self.lock:
+            return dict(self._get(name, dict) or {})
+
+    def hkeys(self, name: Any) -> List[bytes]:
+        with self.lock:
+            return list(self._get(name, dict) or {})
+
+    def hlen(self, name: Any) -> int:
+        with self.lock:
+            return len(self._get(name, dict) or {})
+
+    def hdel(self, name: Any, *keys: Any) -> int:
+        with self.lock:
+            hash_ = self._get(name, dict) or {}
+            return sum(hash_.pop(_encode(key), None) is not None for key in keys)
+
+    # lists
+    def rpush(self, name: Any, *values: Any) -> int:
+        with self.lock:
+            list_ = self._get(name, list, create=True)
+            list_.extend(_encode(v) for v in values)
+            return len(list_)
+
+    def lpush(self, name: Any, *values: Any) -> int:
+        with self.lock:
+            list_ = self._get(name, list, create=True)
+            for value in values:
+                list_.insert(0, _encode(value))
+            return len(list_)
+
+    def lpop(self, name: Any) -> Optional[bytes]:
+        with self.lock:
+            list_ = self._get(name, list)
+            return list_.pop(0) if list_ else None
+
+    def blpop(self, keys: Any, timeout: int = 0) -> Optional[Tuple[bytes, bytes]]:
+        keys = [keys] if isinstance(keys, (str, bytes)) else keys
+        deadline = time.time() + timeout
+        while True:
+            for key in keys:
+                value = self.lpop(key)
+                if value is not None:
+                    return _encode(key), value
+            if timeout and time.time() >= deadline:
+                return None
+            time.sleep(0.01)
+
+    def llen(self, name: Any) -> int:
+        with self.lock:
+            return len(self._get(name, list) or [])
+
+    # pub/sub
+    def publish(self, channel: Any, message: Any) -> int:
+        with self.lock:
+            self.published.append((_encode(channel), _encode(message)))
+            return 0
+
+    # streams
+    def xadd(self, name: Any, fields: Dict[Any, Any], id="*", maxlen=None, approximate=True) -> bytes:
+        with self.lock:
+            stream = self._get(name, _Stream, create=True)
+            last = _parse_stream_id(stream[-1][0]) if stream else (0, 0)
+            if id == "*":
+                ms = int(time.time() * 1000)
+                new = (ms, 0) if ms > last[0] else (last[0], last[1] + 1)
+            else:
+                new = _parse_stream_id(id)
+                if new <= last:
+                    raise ValueError("The ID specified in XADD is equal or smaller than the target stream top item")
+            entry_id = f"{new[0]}-{new[1]}".encode("utf-8")
+            stream.append((entry_id, {_encode(k): _encode(v) for k, v in fields.items()}))
+            if maxlen is not None and len(stream) > maxlen:
+                del stream[: len(stream) - maxlen]
+            return entry_id
+
+    def xlen(self, name: Any) -> int:
+        with self.lock:
+            return len(self._get(name, _Stream) or [])
+
+    def xrange(self, name: Any, min="-", max="+", count=None) -> List[Tuple[bytes, Fields]]:
+        with self.lock:
+            low = (0, 0) if min == "-" else _parse_stream_id(min)
+            high = None if max == "+" else _parse_stream_id(max)
+            entries = [
+                (id_, dict(fields))
+                for id_, fields in self._get(name, _Stream) or []
+                if _parse_stream_id(id_) >= low and (high is None or _parse_stream_id(id_) <= high)
+            ]
+            return entries[:count] if count else entries
+
+    def xrevrange(self, name: Any, max="+", min="-", count=None) -> List[Tuple[bytes, Fields]]:
+        entries = list(reversed(self.xrange(name, min=min, max=max)))
+        return entries[:count] if count else entries
+
+    def xread(self, streams: Dict[Any, Any], count=None, block=None) -> List[List[Any]]:
+        deadline = time.time() + (block or 0) / 1000
+        with self.lock:
+            # "$" means entries added after this call
+            streams = {
+                name: ((self._get(name, _Stream) or [(b"0-0", {})])[-1][0] if _encode(last_id) == b"$" else last_id)
+                for name, last_id in streams.items()
+            }
+        while True:
+            with self.lock:
+                result = []
+                for name, last_id in streams.items():
+                    stream = self._get(name, _Stream) or []
+                    after = _parse_stream_id(last_id)
+                    entries = [(i, dict(f)) for i, f in stream if _parse_stream_id(i) > after]
+                    if entries:
+                        result.append([_encode(name), entries[:count] if count else entries])
+            if result or block is None or time.time() >= deadline:
+                return result
+            time.sleep(0.01)
+
+    # scripts
+    def register_script(self, script: str) -> Callable[..., Any]:
+        """ Only the scripts in SCRIPTS, which are run as their Python equivalents
+        """
+        if script not in SCRIPTS:
+            raise NotImplementedError("fake_redis can't run this script")
+
+        def run(keys: List[Any] = [], args: List[Any] = []) -> Any:
+            with self.lock:
+                return SCRIPTS[script](self, keys, args)
+
+        return run
+
+    def pipeline(self, transaction: bool = True) -> "FakePipeline":
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    """ Queues commands & runs them (atomically, under the FakeRedis lock) on execute().
+    Like redis-py, after watch() commands run right away until multi(), and execute() raises WatchError
+    if a watched key's value changed since.
+    """
+
+    def __init__(self, server: FakeRedis) -> None:
+        self.server = server
+        self.commands: List[Tuple[str, tuple, dict]] = []
+        self.watched: Optional[Dict[Any, Any]] = None
+        self.immediate = False
+
+    def __getattr__(self, command: str):
+        if not hasattr(self.server, command):
+            raise AttributeError(command)
+        if self.immediate:
+            return getattr(self.server, command)
+
+        def queue(*args, **kwargs) -> "FakePipeline":
+            self.commands.append((command, args, kwargs))
+            return self
+
+        return queue
+
+    def __enter__(self) -> "FakePipeline":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.reset()
+
+    def watch(self, *names: Any) -> None:
+        with self.server.lock:
+            self.watched = {name: self.server.data.get(_encode(name)) for name in names}
+        self.immediate = True
+
+    def multi(self) -> None:
+        self.immediate = False
+
+    def reset(self) -> None:
+        self.commands = []
+        self.watched = None
+        self.immediate = False
+
+    def execute(self) -> List[Any]:
+        try:
+            with self.server.lock:
+                if self.watched and any(
+                    self.server.data.get(_encode(name)) != value for name, value in self.watched.items()
+                ):
+                    raise redis.exceptions.WatchError("Watched variable changed.")
+                return [getattr(self.server, c)(*args, **kwargs) for c, args, kwargs in self.commands]
+        finally:
+            self.reset()
+
+
+def _renew(server: FakeRedis, keys: List[Any], args: List[Any]) -> int:
+    return int(server.get(keys[0]) == _encode(args[0]) and server.pexpire(keys[0], int(args[1])))
+
+
+def _release(server: FakeRedis, keys: List[Any], args: List[Any]) -> int:
+    return server.delete(keys[0]) if server.get(keys[0]) == _encode(args[0]) else 0
+
+
+SCRIPTS: Dict[str, Callable[[FakeRedis, List[Any], List[Any]], Any]] = {
+    leader.RENEW_SCRIPT: _renew,
+    leader.RELEASE_SCRIPT: _release,
+}
@@ -0,0 +1,254 @@
+""" An optional websocket fan-out server (REALTIME_FANOUT_PORT), speaking the same protocol to clients as
+web_server/server.js, but fed the parser's payloads directly instead of re-reading them from Redis.
+
+It keeps the latest full payload & diffs in memory, with their JSON headers built once per update, and sends
+each client the compressed payload it needs as is: the diff from the last timestamp it acknowledged
+(data_received) if there is one, the full payload otherwise.
+
+Each client has a single sender task, which always sends the newest update: a client that reads slower than
+updates arrive skips the ones it missed instead of queueing them, and its next diff is from the last
+timestamp it acknowledged. A send that takes longer than FANOUT_SEND_TIMEOUT seconds drops the connection,
+so slow clients never hold up the others. Lazy diffs (REALTIME_LAZY_DIFFS) aren't supported: clients without
+a precomputed diff get the full payload.
+
+It runs in the parser process (main.py starts it on its own thread, and RealtimeManager.push hands it each
+update), or as a sidecar that follows what the parser pushes to Redis:
+    python fanout.py [PORT]
+"""
+import asyncio
+import json
+import sys
+import threading
+import time
+from typing import Dict, NamedTuple, Optional
+from urllib.parse import parse_qs, urlparse
+import redis
+import websockets  # type: ignore
+import util as u  # type: ignore
+
+NO_DATA_ERROR = '{"type": "error","error": "no_data"}'
+
+
+class Update(NamedTuple):
+    timestamp: int
+    data_full: bytes
+    full_header: str
+    data_diffs: Dict[int, bytes]  # by the timestamp each diff is from
+    diff_headers: Dict[int, str]
+
+
+def make_update(timestamp: int, data_full: bytes, data_diffs: Dict[int, bytes]) -> Update:
+    data_diffs = {int(from_timestamp): diff for from_timestamp, diff in data_diffs.items()}
+    return Update(
+        timestamp=timestamp,
+        data_full=data_full,
+        full_header=json.dumps(
+            {"type": "data_full", "timestamp": str(timestamp), "data_size": str(len(data_full))}
+        ),
+        data_diffs=data_diffs,
+        diff_headers={
+            from_timestamp: json.dumps(
+                {
+                    "type": "data_update",
+                    "timestamp_from": str(from_timestamp),
+                    "timestamp_to": str(timestamp),
+                    "data_size": str(len(diff)),
+                }
+            )
+            for from_timestamp, diff in data_diffs.items()
+        },
+    )
+
+
+class Client:
+    def __init__(self) -> None:
+        self.ws = None
+        self.last_timestamp = 0  # the last one the client acknowledged
+        self.sent_timestamp = 0  # of the last update sent to it
+        self.full_requested = False
+        self.heartbeat = ""  # to send once it's caught up
+        self.wake = asyncio.Event()
+        self.disconnected_at: Optional[float] = None
+
+
+class FanoutServer:
+    def __init__(
+        self,
+        host: str = "0.0.0.0",
+        port: int = u.REALTIME_FANOUT_PORT,
+        send_timeout: u.Num = u.FANOUT_SEND_TIMEOUT,
+        client_expiration: u.Num = u.REALTIME_FREQ * u.REALTIME_DATA_DICT_CAP,
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.send_timeout = send_timeout
+        self.client_expiration = client_expiration  # seconds a disconnected client's timestamp is kept
+        self.update: Optional[Update] = None
+        self.clients: Dict[str, Client] = {}
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.server = None
+        self.sent_bytes = 0
+        self.dropped = 0  # connections closed for being too slow
+
+    async def serve(self) -> None:
+        self.loop = asyncio.get_event_loop()
+        # the payloads are compressed already
+        self.server = await websockets.serve(self.handle, self.host, self.port, compression=None)
+        if not self.port:
+            self.port = self.server.sockets[0].getsockname()[1]
+        asyncio.ensure_future(self.expire_clients())
+        u.log.info("parser: fan-out server listening on %s:%s", self.host, self.port)
+
+    def start_in_thread(self) -> None:
+        """ Runs the server on its own event loop, in a daemon thread
+        """
+        loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def run() -> None:
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(self.serve())
+            started.set()
+            loop.run_forever()
+
+        threading.Thread(target=run, name="fanout", daemon=True).start()
+        started.wait()
+
+    def publish(self, timestamp: int, data_full: bytes, data_diffs: Dict[int, bytes]) -> None:
+        """ Sends a new update to every client. Safe to call from any thread.
+        """
+        update = make_update(timestamp, data_full, data_diffs)
+        self.loop.call_soon_threadsafe(self.set_update, update)
+
+    def publish_heartbeat(self, heartbeat_timestamp: int) -> None:
+        """ Lets every client know the data hasn't changed. Safe to call from any thread.
+        """
+        self.loop.call_soon_threadsafe(self.set_heartbeat, heartbeat_timestamp)
+
+    def set_update(self, update: Update) -> None:
+        self.update = update
+        for client in self.clients.values():
+            if client.ws is not None:
+                client.wake.set()
+
+    def set_heartbeat(self, heartbeat_timestamp: int) -> None:
+        heartbeat = json.dumps(
+            {
+                "type": "heartbeat",
+                "timestamp": str(heartbeat_timestamp),
+                "data_timestamp": str(self.update.timestamp if self.update else 0),
+            }
+        )
+        for client in self.clients.values():
+            if client.ws is not None:
+                client.heartbeat = heartbeat
+                client.wake.set()
+
+    async def handle(self, ws, path: Optional[str] = None) -> None:
+        if path is None:
+            path = ws.request.path  # newer websockets versions only pass the connection
+        client_id = parse_qs(urlparse(path).query).get("unique_id", [""])[0]
+        client = self.clients.get(client_id)
+        if client is None:
+            client = self.clients[client_id] = Client()
+        client.ws, client.disconnected_at = ws, None
+
+        sender = asyncio.ensure_future(self.send_updates(client, ws))
+        try:
+            async for message in ws:
+                self.on_message(client, message)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            sender.cancel()
+            if client.ws is ws:
+                client.ws, client.disconnected_at = None, time.monotonic()
+
+    def on_message(self, client: Client, message: str) -> None:
+        try:
+            parsed = json.loads(message)
+            if parsed["type"] == "data_received":
+                client.last_timestamp = int(parsed["last_successful_timestamp"])
+            elif parsed["type"] == "request_full":
+                client.full_requested = True
+                client.wake.set()
+        except (ValueError, KeyError, TypeError) as err:
+            u.log.debug("parser: ignoring fan-out client message %r: %s", message, err)
+
+    async def send_updates(self, client: Client, ws) -> None:
+        """ Sends client the newest update whenever there's one it hasn't had (or it asks for the full data)
+        """
+        while True:
+            await client.wake.wait()
+            client.wake.clear()
+            update = self.update
+            messages = []
+            if update is None:
+                if client.full_requested:
+                    messages.append(NO_DATA_ERROR)
+            elif client.full_requested or client.sent_timestamp != update.timestamp:
+                diff = None if client.full_requested else update.data_diffs.get(client.last_timestamp)
+                if diff is None:
+                    messages += [update.full_header, update.data_full]
+                else:
+                    messages += [update.diff_headers[client.last_timestamp], diff]
+            if client.heartbeat:
+                messages.append(client.heartbeat)
+            client.full_requested, client.heartbeat = False, ""
+
+            try:
+                for message in messages:
+                    await asyncio.wait_for(ws.send(message), self.send_timeout)
+                    self.sent_bytes += len(message)
+            except asyncio.TimeoutError:
+                self.dropped += 1
+                u.log.debug("parser: dropping a fan-out client that's too slow")
+                asyncio.ensure_future(ws.close(code=1008, reason="too slow"))
+                return
+            except websockets.exceptions.ConnectionClosed:
+                return
+            if update is not None:
+                client.sent_timestamp = update.timestamp
+
+    async def expire_clients(self) -> None:
+        while True:
+            await asyncio.sleep(self.client_expiration)
+            expired_before = time.monotonic() - self.client_expiration
+            for client_id, client in list(self.clients.items()):
+                if client.ws is None and client.disconnected_at is not None and client.disconnected_at < expired_before:
+                    del self.clients[client_id]
+
+
+def follow_redis(fanout: FanoutServer, redis_server: redis.Redis) -> None:
+    """ Feeds fanout what the parser pushes to Redis (for running it as a sidecar)
+    """
+    def fetch() -> None:
+        pipe = redis_server.pipeline()
+        pipe.get("realtime:current_timestamp")
+        pipe.get("realtime:data_full")
+        pipe.hgetall("realtime:data_diffs")
+        timestamp, data_full, data_diffs = pipe.execute()
+        if timestamp is not None and data_full is not None:
+            fanout.publish(int(timestamp), data_full, data_diffs)
+
+    pubsub = redis_server.pubsub()
+    pubsub.subscribe("realtime_updates")
+    fetch()
+    for message in pubsub.listen():
+        if message["type"] != "message":
+            continue
+        if message["data"] == b"new_data":
+            fetch()
+        elif message["data"].startswith(b"heartbeat:"):
+            fanout.publish_heartbeat(int(message["data"][len(b"heartbeat:"):]))
+
+
+if __name__ == "__main__":
+    fanout = FanoutServer(port=int(sys.argv[1]) if len(sys.argv) > 1 else u.REALTIME_FANOUT_PORT or 8000)
+    fanout.start_in_thread()
+    while True:
+        try:
+            follow_redis(fanout, redis.Redis(host=u.REDIS_HOSTNAME, port=u.REDIS_PORT, db=0))
+        except redis.exceptions.ConnectionError as err:
+            u.log.error("parser: lost Redis, reconnecting: %s", err)
+            time.sleep(2)
@@ -0,0 +1,183 @@
+""" Leader election between parser replicas, so a hot standby can take over (PARSER_LEADER_ELECTION).
+
+Replicas compete for a lease: the parser:leader key, taken with SET NX PX and renewed every third of
+PARSER_LEASE_TTL from a background thread, by a script that only extends the lease if this replica still
+holds it. The leader fetches & publishes; the others keep warm from the feeds it stores in Redis (see
+RealtimeManager.sync_from_leader) and take the lease as soon as it lapses.
+
+Each time a replica takes the lease, INCR parser:fencing_token gives it a fencing token, which it publishes
+with its data (realtime:fencing_token). Every write a replica makes goes through FencedRedis, which WATCHes
+parser:fencing_token and only runs the write (in MULTI/EXEC) if no newer token was handed out, so a replica
+deposed mid-cycle can't overwrite its successor. Readers can drop anything published with a lower token than
+one they've already seen.
+"""
+import os
+import socket
+import threading
+import time
+from typing import Any, Callable, List, Optional, Tuple
+import redis
+import util as u  # type: ignore
+
+LEASE_KEY = "parser:leader"
+TOKEN_KEY = "parser:fencing_token"
+
+# the commands that write, which FencedRedis fences; the others (reads, and popping requests) pass through
+WRITE_COMMANDS = {
+    "set", "delete", "expire", "pexpire", "incr", "hset", "hmset", "hdel", "rpush", "lpush", "xadd", "publish",
+}
+
+# KEYS[1]: the lease, ARGV[1]: this replica's id, ARGV[2]: the ttl in ms
+RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class LeaseLost(Exception):
+    """ This replica stopped being the leader
+    """
+
+
+class Lease:
+    def __init__(self, redis_server: redis.Redis, replica_id: str = "", ttl: u.Num = u.PARSER_LEASE_TTL) -> None:
+        self.redis_server = redis_server
+        self.replica_id = replica_id or u.PARSER_REPLICA_ID or f"{socket.gethostname()}:{os.getpid()}"
+        self.ttl_ms = int(ttl * 1000)
+        self.token: Optional[int] = None  # while this replica holds the lease
+        self.valid_until = 0.0  # time.monotonic() after which the lease may have lapsed without us noticing
+        self.renew = redis_server.register_script(RENEW_SCRIPT)
+        self.release_lease = redis_server.register_script(RELEASE_SCRIPT)
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def is_leader(self) -> bool:
+        return self.token is not None and time.monotonic() < self.valid_until
+
+    def hold(self) -> bool:
+        """ Renews the lease if this replica holds it, or takes it if it's free. Returns whether this
+        replica is the leader.
+        """
+        started = time.monotonic()
+        if self.token is not None:
+            if self.renew(keys=[LEASE_KEY], args=[self.replica_id, self.ttl_ms]):
+                self.valid_until = started + self.ttl_ms / 1000
+                return True
+            u.log.warning("parser: %s lost the leader lease", self.replica_id)
+            self.token = None
+
+        if self.redis_server.set(LEASE_KEY, self.replica_id, nx=True, px=self.ttl_ms):
+            self.valid_until = started + self.ttl_ms / 1000
+            self.token = self.redis_server.incr(TOKEN_KEY)
+            u.log.info("parser: %s is now the leader, with fencing token %s", self.replica_id, self.token)
+        return self.token is not None
+
+    def check(self) -> int:
+        """ Returns the fencing token to publish with, or raises LeaseLost if this replica isn't the leader
+        anymore (e.g. it was paused for longer than the lease)
+        """
+        return self.verify(self.redis_server.get(TOKEN_KEY))
+
+    def verify(self, latest_token: Optional[bytes]) -> int:
+        """ check() against latest_token, the value of TOKEN_KEY
+        """
+        if not self.is_leader:
+            raise LeaseLost(f"{self.replica_id} isn't the leader")
+        if int(latest_token or 0) > self.token:
+            self.token = None
+            raise LeaseLost(f"{self.replica_id} was superseded by fencing token {int(latest_token or 0)}")
+        return self.token
+
+    def start(self) -> None:
+        """ Holds (or keeps trying to take) the lease from a daemon thread, every third of its ttl
+        """
+        self.thread = threading.Thread(target=self.run, name="lease", daemon=True)
+        self.thread.start()
+
+    def run(self) -> None:
+        interval = self.ttl_ms / 3000
+        while True:
+            try:
+                self.hold()
+            except redis.exceptions.ConnectionError as err:
+                u.log.error("parser: could not reach Redis to hold the lease: %s", err)
+            if self.stopped.wait(interval):
+                return
+
+    def release(self) -> None:
+        """ Stops holding the lease and gives it up, so a standby needn't wait for it to lapse
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.token is not None:
+            self.release_lease(keys=[LEASE_KEY], args=[self.replica_id])
+            self.token = None
+
+
+class FencedRedis:
+    """ Wraps a redis.Redis so each write (see WRITE_COMMANDS), and each pipeline, only runs while lease holds
+    the newest fencing token: it WATCHes TOKEN_KEY, checks it, then runs the commands in MULTI/EXEC, which
+    Redis aborts if TOKEN_KEY changed in between. Raises LeaseLost instead of writing.
+    """
+
+    def __init__(self, server: Any, lease: Lease) -> None:
+        self.server = server
+        self.lease = lease
+
+    def __getattr__(self, command: str) -> Any:
+        method = getattr(self.server, command)
+        if command not in WRITE_COMMANDS:
+            return method
+
+        def run(*args: Any, **kwargs: Any) -> Any:
+            return self.fenced([(command, args, kwargs)])[0]
+
+        return run
+
+    def pipeline(self, transaction: bool = True) -> "FencedPipeline":
+        return FencedPipeline(self)
+
+    def fenced(self, commands: List[Tuple[str, tuple, dict]]) -> List[Any]:
+        pipe = self.server.pipeline()
+        try:
+            pipe.watch(TOKEN_KEY)
+            self.lease.verify(pipe.get(TOKEN_KEY))
+            pipe.multi()
+            for command, args, kwargs in commands:
+                getattr(pipe, command)(*args, **kwargs)
+            return pipe.execute()
+        except redis.exceptions.WatchError:
+            self.lease.token = None
+            raise LeaseLost(f"{self.lease.replica_id} was superseded while writing")
+        finally:
+            pipe.reset()
+
+
+class FencedPipeline:
+    """ Queues commands for FencedRedis to run, fenced, on execute()
+    """
+
+    def __init__(self, fenced_server: FencedRedis) -> None:
+        self.fenced_server = fenced_server
+        self.commands: List[Tuple[str, tuple, dict]] = []
+
+    def __getattr__(self, command: str) -> Callable[..., "FencedPipeline"]:
+        def queue(*args: Any, **kwargs: Any) -> "FencedPipeline":
+            self.commands.append((command, args, kwargs))
+            return self
+
+        return queue
+
+    def execute(self) -> List[Any]:
+        commands, self.commands = self.commands, []
+        return self.fenced_server.fenced(commands) if commands else []
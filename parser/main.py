@@ -1,66 +1,341 @@
 """ This script manages the database server
 """
 import time
-from typing import Dict, Tuple
+import asyncio
+import itertools
+import multiprocessing
+from typing import Dict, List, Optional, Tuple
 import redis
+import agencies   # type: ignore
+import fanout     # type: ignore
 import static     # type: ignore
 import realtime   # type: ignore
+import shm        # type: ignore
+import leader     # type: ignore
+import planner    # type: ignore
+import stream     # type: ignore
+import metrics    # type: ignore
 import util as u  # type: ignore
 
+# seconds before restarting an agency's process that exited, doubled each time it exits again soon after
+RESTART_BACKOFF_BASE = 5
+RESTART_BACKOFF_CAP = 60 * 10
+
 
 class RedisHandler:
-    def __init__(self) -> None:
-        self.server: redis.Redis = redis.Redis(host=u.REDIS_HOSTNAME, port=u.REDIS_PORT, db=0)
+    def __init__(self, server: Optional[redis.Redis] = None) -> None:
+        self.server: redis.Redis = server or agencies.namespaced(
+            redis.Redis(host=u.REDIS_HOSTNAME, port=u.REDIS_PORT, db=0), u.REDIS_NAMESPACE
+        )
 
-    def realtime_push(self, current_timestamp: int, data_full: bytes, data_diffs: Dict[int, bytes]) -> None:
+    def realtime_push(
+        self, current_timestamp: int, data_full: bytes, data_diffs: Dict[int, bytes], fencing_token: Optional[int] = None
+    ) -> None:
+        """ Writes the data in one transaction, so readers never see a timestamp, payload & fencing token
+        (with PARSER_LEADER_ELECTION, see leader.py) from different cycles
+        """
         u.log.debug('Pushing the realime data to redis_server')
 
-        self.server.set('realtime:current_timestamp', current_timestamp)
-        self.server.set('realtime:data_full', data_full)
-        self.server.delete('realtime:data_diffs')
+        pipe = self.server.pipeline()
+        pipe.set('realtime:current_timestamp', current_timestamp)
+        pipe.set('realtime:data_full', data_full)
+        pipe.delete('realtime:data_diffs')
         if data_diffs:
-            self.server.hmset('realtime:data_diffs', data_diffs)
-
-        self.server.publish('realtime_updates', 'new_data')
+            pipe.hmset('realtime:data_diffs', data_diffs)
+        if fencing_token is not None:
+            pipe.set('realtime:fencing_token', fencing_token)
+        pipe.publish('realtime_updates', 'new_data')
+        pipe.execute()
         u.log.debug('published \'new_data\' to realtime_updates')
 
-def connect_to_redis() -> Tuple[realtime.RealtimeManager, redis.Redis]:
+    def boards_push(self, current_timestamp: int, boards: Dict[int, bytes], removed: List[int]) -> None:
+        """ Writes the station boards that changed (see boards.py) and lets subscribers know which ones
+        """
+        pipe = self.server.pipeline()
+        if boards:
+            pipe.hmset('realtime:boards', boards)
+        if removed:
+            pipe.hdel('realtime:boards', *removed)
+        pipe.set('realtime:boards_timestamp', current_timestamp)
+        changed = ','.join(str(station) for station in itertools.chain(boards, removed))
+        pipe.publish('realtime_boards', f'{current_timestamp}:{changed}')
+        pipe.execute()
+
+    def shards_push(self, current_timestamp: int, shards: Dict[str, Tuple[bytes, Dict[int, bytes]]]) -> None:
+        """ Writes each shard's full payload & diffs under its own keys and lets its subscribers know (see shards.py)
+        """
+        pipe = self.server.pipeline()
+        for shard, (data_full, data_diffs) in shards.items():
+            pipe.set(f'realtime:shard:{shard}:current_timestamp', current_timestamp)
+            pipe.set(f'realtime:shard:{shard}:data_full', data_full)
+            pipe.delete(f'realtime:shard:{shard}:data_diffs')
+            if data_diffs:
+                pipe.hmset(f'realtime:shard:{shard}:data_diffs', data_diffs)
+            pipe.hset('realtime:shards', shard, current_timestamp)
+            pipe.publish(f'realtime_updates:{shard}', 'new_data')
+        pipe.execute()
+
+    def realtime_heartbeat(self, heartbeat_timestamp: int) -> None:
+        """ Lets the web_server know the data was checked at heartbeat_timestamp and hasn't changed
+        """
+        self.server.set('realtime:heartbeat_timestamp', heartbeat_timestamp)
+        self.server.publish('realtime_updates', f'heartbeat:{heartbeat_timestamp}')
+        u.log.debug('published \'heartbeat\' to realtime_updates')
+
+    def realtime_push_diff(self, from_timestamp: int, to_timestamp: int, data_diff: Optional[bytes]) -> None:
+        """ Answers a lazy diff request: adds the diff to realtime:data_diffs, or reports that there's no
+        diff from that timestamp so the web_server sends the full data instead
+        """
+        if data_diff is None:
+            self.server.publish('realtime_updates', f'diff_unavailable:{from_timestamp}')
+            return
+
+        self.server.hset('realtime:data_diffs', from_timestamp, data_diff)
+        self.server.publish('realtime_updates', f'diff_ready:{from_timestamp}:{to_timestamp}')
+        u.log.debug('published diff from %s to %s', from_timestamp, to_timestamp)
+
+    def plan_push(self, answers: Dict[str, str]) -> None:
+        """ Stores the answers to journey requests (see planner.py) for a while and lets the web_server know
+        """
+        pipe = self.server.pipeline()
+        for request_id, answer in answers.items():
+            pipe.set(f'realtime:plan:{request_id}', answer, ex=planner.PLAN_TTL)
+            pipe.publish('realtime_plans', request_id)
+        pipe.execute()
+
+    def realtime_stream_append(self, current_timestamp: int, prev_timestamp: int, data_diff: Optional[bytes]) -> None:
+        entry_id = stream.append_update(self.server, current_timestamp, prev_timestamp, data_diff)
+        u.log.debug('appended %s to %s', entry_id, stream.STREAM_KEY)
+
+    def metrics_push(self) -> None:
+        """ Writes the latest value of each parser metric to the parser:metrics hash
+        """
+        values = metrics.REGISTRY.last_values()
+        if values:
+            self.server.hmset('parser:metrics', values)
+
+
+def connect_to_redis(
+    lease: Optional[leader.Lease] = None,
+    fanout_server: Optional[fanout.FanoutServer] = None,
+    shm_sink: Optional[shm.SharedMemorySink] = None,
+) -> Tuple[realtime.RealtimeManager, redis.Redis]:
     """ establishes a connection to Redis and returns the handler and server
+    With a lease, every write goes through leader.FencedRedis
     Retries indefinitely upon failure
     """
     while True:
         try:
             redis_handler = RedisHandler()
+            if lease is not None:
+                redis_handler = RedisHandler(leader.FencedRedis(redis_handler.server, lease))
             redis_server = redis_handler.server
             realtime_manager = realtime.RealtimeManager(redis_handler)
+            realtime_manager.lease = lease
+            realtime_manager.fanout = fanout_server
+            realtime_manager.shm_sink = shm_sink
+            if realtime_manager.publish_checkpoint():
+                u.log.info('published the data restored from the checkpoint')
             return realtime_manager, redis_server
         except redis.exceptions.ConnectionError:
             time.sleep(2)
 
+
+def start_lease() -> Optional[leader.Lease]:
+    """ With PARSER_LEADER_ELECTION, starts competing for the leader lease
+    """
+    if not u.PARSER_LEADER_ELECTION:
+        return None
+    lease = leader.Lease(RedisHandler().server)
+    lease.start()
+    return lease
+
+
+def open_shm_sink() -> Optional[shm.SharedMemorySink]:
+    """ With REALTIME_SHM_PATH, opens the shared-memory output, once for the life of the process, so the
+    RealtimeManagers built on each reconnect or takeover share it
+    """
+    return shm.SharedMemorySink(u.REALTIME_SHM_PATH) if u.REALTIME_SHM_PATH else None
+
+
+def start_fanout() -> Optional[fanout.FanoutServer]:
+    """ With REALTIME_FANOUT_PORT, starts serving websocket clients from this process
+    """
+    if not u.REALTIME_FANOUT_PORT:
+        return None
+    fanout_server = fanout.FanoutServer()
+    fanout_server.start_in_thread()
+    return fanout_server
+
+
+def stand_by(realtime_manager: realtime.RealtimeManager, lease: leader.Lease) -> None:
+    """ Keeps realtime_manager warm from what the leader stores in Redis until this replica takes the
+    lease, then publishes right away
+    """
+    u.log.info('parser: standing by as %s', lease.replica_id)
+    time_for_next_sync = 0.0
+    while not lease.is_leader:
+        if time.time() > time_for_next_sync:
+            realtime_manager.sync_from_leader()
+            time_for_next_sync = time.time() + u.REALTIME_FREQ
+        time.sleep(1)
+    u.log.info('parser: taking over as the leader')
+    realtime_manager.take_over()
+
+
+async def watch_lease(lease: leader.Lease) -> None:
+    while lease.is_leader:
+        await asyncio.sleep(1)
+    raise leader.LeaseLost(f'{lease.replica_id} lost the leader lease')
+
+
+def static_update(redis_server: redis.Redis) -> None:
+    u.log.debug('initiating static parse')
+    static_handler = static.StaticHandler(redis_server)
+    with metrics.stage('static_update'):
+        static_handler.update()
+    del static_handler
+
+
+async def daily_static_updates(redis_server: redis.Redis) -> None:
+    loop = asyncio.get_event_loop()
+    while True:
+        await asyncio.sleep(60 * 60 * 24)
+        await loop.run_in_executor(None, static_update, redis_server)
+
+
+def streaming_main_loop() -> None:
+    """ main_loop for REALTIME_STREAMING: the realtime pipeline (see RealtimeManager.run_streaming) and the
+    daily static parse run on the event loop
+    """
+    loop = asyncio.get_event_loop()
+    lease = start_lease()
+    fanout_server = start_fanout()
+    shm_sink = open_shm_sink()
+    while True:
+        realtime_manager, redis_server = connect_to_redis(lease, fanout_server, shm_sink)
+        tasks = []
+        try:
+            if lease is not None and not lease.is_leader:
+                stand_by(realtime_manager, lease)
+            else:
+                static_update(redis_server)
+            tasks = [
+                asyncio.ensure_future(realtime_manager.run_streaming()),
+                asyncio.ensure_future(daily_static_updates(redis_server)),
+            ]
+            if lease is not None:
+                tasks.append(asyncio.ensure_future(watch_lease(lease)))
+            done, _ = loop.run_until_complete(asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION))
+            for task in done:
+                task.result()
+        except redis.exceptions.ConnectionError:
+            # if we've lost connection to Redis, reconnect.
+            pass
+        except leader.LeaseLost as err:
+            # stand by again, from a fresh RealtimeManager
+            u.log.warning(err)
+        finally:
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+
+
 def main_loop() -> None:
-    realtime_manager, redis_server = connect_to_redis()
+    u.make_data_dirs()
+    if u.METRICS_PORT:
+        metrics.start_http_server(u.METRICS_PORT)
+    if u.REALTIME_STREAMING:
+        streaming_main_loop()
+        return
+
+    lease = start_lease()
+    fanout_server = start_fanout()
+    shm_sink = open_shm_sink()
+    realtime_manager, redis_server = connect_to_redis(lease, fanout_server, shm_sink)
 
     time_for_next_static_parse = time_for_next_realtime_parse = time.time()
 
     while True:
         try:
+            if lease is not None and not lease.is_leader:
+                stand_by(realtime_manager, lease)
+                # the leader kept up the daily static parse, so carry on from its last one
+                static_data = realtime_manager.static_data
+                if static_data is not None:
+                    time_for_next_static_parse = static_data.static_timestamp + (60 * 60 * 24)
+                time_for_next_realtime_parse = time.time() + u.REALTIME_FREQ
+
             if time.time() > time_for_next_static_parse:
-                u.log.debug('initiating static parse')
-                static_handler = static.StaticHandler(redis_server)
-                static_handler.update()
-                del static_handler
+                static_update(redis_server)
                 time_for_next_static_parse += (60 * 60 * 24)
 
             if time.time() > time_for_next_realtime_parse:
                 u.log.debug('initiating realtime parse')
                 realtime_manager.update()
-                time_for_next_realtime_parse += 15
+                realtime_manager.redis_handler.metrics_push()
+                if u.REALTIME_ADAPTIVE:
+                    time_for_next_realtime_parse = realtime_manager.next_update_time()
+                else:
+                    time_for_next_realtime_parse += 15
 
-            time.sleep(1)
+            if u.REALTIME_LAZY_DIFFS:
+                realtime_manager.serve_diff_requests(timeout=1)
+            elif not u.REALTIME_PLANNER:
+                time.sleep(1)
+            if u.REALTIME_PLANNER:
+                realtime_manager.serve_plan_requests(timeout=0 if u.REALTIME_LAZY_DIFFS else 1)
 
         except redis.exceptions.ConnectionError:
             # if we've lost connection to Redis, reconnect.
-            realtime_manager, redis_server = connect_to_redis()
+            realtime_manager, redis_server = connect_to_redis(lease, fanout_server, shm_sink)
+        except leader.LeaseLost as err:
+            # a write was fenced off; stand by on the next iteration
+            u.log.warning(err)
 
-if __name__ == "__main__":
+
+def agency_main_loop(agency: agencies.Agency, index: int) -> None:
+    agencies.configure(agency, index)
     main_loop()
+
+
+def multi_agency_main() -> None:
+    """ main_loop for AGENCIES_CONFIG: runs each agency's main_loop in its own process, restarting any
+    that exit, after a delay that doubles (up to RESTART_BACKOFF_CAP) each time it exits again soon after
+    """
+    agency_list = agencies.load(u.AGENCIES_CONFIG)
+    u.log.info('parser: parsing %s', ', '.join(agency.conf.name for agency in agency_list))
+    processes: List[Optional[multiprocessing.Process]] = [None] * len(agency_list)
+    started_at = [0.0] * len(agency_list)
+    restart_at = [0.0] * len(agency_list)
+    crashes = [0] * len(agency_list)
+    while True:
+        for index, agency in enumerate(agency_list):
+            process = processes[index]
+            if process is not None and process.is_alive():
+                continue
+            if process is not None:
+                if time.time() - started_at[index] > RESTART_BACKOFF_CAP:
+                    crashes[index] = 0  # it ran for a while, so this isn't a crash loop
+                crashes[index] += 1
+                delay = min(RESTART_BACKOFF_BASE * 2 ** (crashes[index] - 1), RESTART_BACKOFF_CAP)
+                u.log.error(
+                    'parser: %s exited with code %s, restarting it in %ss', agency.conf.name, process.exitcode, delay
+                )
+                processes[index] = None
+                restart_at[index] = time.time() + delay
+            if time.time() < restart_at[index]:
+                continue
+            processes[index] = multiprocessing.Process(
+                target=agency_main_loop, args=(agency, index), name=agency.conf.name, daemon=True
+            )
+            processes[index].start()
+            started_at[index] = time.time()
+        time.sleep(5)
+
+
+if __name__ == "__main__":
+    if u.AGENCIES_CONFIG:
+        multi_agency_main()
+    else:
+        main_loop()
@@ -0,0 +1,225 @@
+""" Per-stage metrics for the parser pipeline, exposed in the Prometheus text format on a local HTTP
+endpoint (METRICS_PORT, /metrics) and written to the parser:metrics Redis hash after each cycle.
+
+Usage:
+    with metrics.stage("parse") as stage:
+        ...
+        stage.bytes_in, stage.bytes_out = len(raw), len(parsed)
+"""
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, TypeVar
+import util as u  # type: ignore
+
+LabelValues = Tuple[str, ...]
+
+DURATION_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15]
+BYTES_BUCKETS = [2 ** n for n in range(10, 27, 2)]  # 1KB to 64MB
+COUNT_BUCKETS = [10, 100, 500, 1000, 2500, 5000, 10000, 25000, 50000]
+AGE_BUCKETS = [1, 2.5, 5, 10, 15, 20, 30, 45, 60, 120, 300]
+
+
+def _format_labels(names: Sequence[str], values: Iterable[str], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric:
+    type_ = ""
+
+    def __init__(self, name: str, help_: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help_
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.last: Dict[LabelValues, float] = {}  # the latest value for each label set, see Registry.last_values
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type_}"] + self.samples()
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type_ = "counter"
+
+    def __init__(self, name: str, help_: str, labels: Sequence[str] = ()) -> None:
+        super().__init__(name, help_, labels)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1) -> None:
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+            self.last[label_values] = self.values[label_values]
+
+    def samples(self) -> List[str]:
+        with self.lock:
+            return [
+                f"{self.name}{_format_labels(self.labels, lv)} {_format_value(v)}"
+                for lv, v in sorted(self.values.items())
+            ]
+
+
+class Gauge(Counter):
+    type_ = "gauge"
+
+    def set(self, *label_values: str, value: float) -> None:
+        with self.lock:
+            self.values[label_values] = value
+            self.last[label_values] = value
+
+
+class Histogram(Metric):
+    type_ = "histogram"
+
+    def __init__(self, name: str, help_: str, labels: Sequence[str] = (), buckets: Sequence[float] = ()) -> None:
+        super().__init__(name, help_, labels)
+        self.buckets = sorted(buckets)
+        self.counts: Dict[LabelValues, List[int]] = {}
+        self.sums: Dict[LabelValues, float] = {}
+
+    def observe(self, *label_values: str, value: float) -> None:
+        with self.lock:
+            counts = self.counts.setdefault(label_values, [0] * (len(self.buckets) + 1))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            self.sums[label_values] = self.sums.get(label_values, 0) + value
+            self.last[label_values] = value
+
+    def samples(self) -> List[str]:
+        lines = []
+        with self.lock:
+            for lv, counts in sorted(self.counts.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + [float("inf")], counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else _format_value(bound)
+                    labels = _format_labels(self.labels, lv, f'le="{le}"')
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labels, lv)} {_format_value(self.sums[lv])}")
+                lines.append(f"{self.name}_count{_format_labels(self.labels, lv)} {cumulative}")
+        return lines
+
+
+MetricT = TypeVar("MetricT", bound=Metric)
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: MetricT) -> MetricT:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self.metrics for line in metric.render()) + "\n"
+
+    def last_values(self) -> Dict[str, float]:
+        """ Returns the latest value of each metric & label set, e.g. {'parser_stage_duration_seconds{stage="parse"}': 0.2}
+        """
+        values = {}
+        for metric in self.metrics:
+            with metric.lock:
+                for lv, value in metric.last.items():
+                    values[f"{metric.name}{_format_labels(metric.labels, lv)}"] = value
+        return values
+
+
+REGISTRY = Registry()
+
+STAGE_DURATION = REGISTRY.register(
+    Histogram("parser_stage_duration_seconds", "Duration of each pipeline stage", ["stage"], DURATION_BUCKETS)
+)
+STAGE_BYTES_IN = REGISTRY.register(
+    Histogram("parser_stage_bytes_in", "Bytes consumed by each pipeline stage", ["stage"], BYTES_BUCKETS)
+)
+STAGE_BYTES_OUT = REGISTRY.register(
+    Histogram("parser_stage_bytes_out", "Bytes produced by each pipeline stage", ["stage"], BYTES_BUCKETS)
+)
+TRIPS = REGISTRY.register(Histogram("parser_trips", "Trips in each parsed snapshot", buckets=COUNT_BUCKETS))
+ENTITIES = REGISTRY.register(
+    Histogram("parser_feed_entities", "FeedEntities parsed in each cycle", buckets=COUNT_BUCKETS)
+)
+FEEDS_CHANGED = REGISTRY.register(
+    Histogram("parser_feeds_changed", "Feeds with new data in each cycle", buckets=list(range(10)))
+)
+CYCLES = REGISTRY.register(Counter("parser_cycles_total", "Realtime cycles by result", ["result"]))
+FETCH_REQUESTS = REGISTRY.register(
+    Counter("parser_feed_requests_total", "Feed requests by feed and kind (first, retry, hedge)", ["feed", "kind"])
+)
+FETCHES_SKIPPED = REGISTRY.register(
+    Counter("parser_feed_fetches_skipped_total", "Fetches skipped because the feed wasn't due (REALTIME_ADAPTIVE)", ["feed"])
+)
+FEED_PERIOD = REGISTRY.register(Gauge("parser_feed_period_seconds", "Each feed's learned publish period", ["feed"]))
+FEED_AGE = REGISTRY.register(
+    Histogram("parser_feed_age_seconds", "Age of each feed's latest data after fetching", ["feed"], AGE_BUCKETS)
+)
+BREAKER_STATE = REGISTRY.register(
+    Gauge("parser_feed_breaker_state", "Each feed's circuit breaker: 0 closed, 1 half open, 2 open", ["feed"])
+)
+
+
+class Stage:
+    """ Times a pipeline stage; set bytes_in / bytes_out inside the with block to record them too
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.bytes_in: Optional[int] = None
+        self.bytes_out: Optional[int] = None
+        self.start = 0.0
+
+    def __enter__(self) -> "Stage":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        duration = time.perf_counter() - self.start
+        STAGE_DURATION.observe(self.name, value=duration)
+        if self.bytes_in is not None:
+            STAGE_BYTES_IN.observe(self.name, value=self.bytes_in)
+        if self.bytes_out is not None:
+            STAGE_BYTES_OUT.observe(self.name, value=self.bytes_out)
+        u.log.debug("%s took %f seconds", self.name, duration)
+
+
+def stage(name: str) -> Stage:
+    return Stage(name)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path.rstrip("/") not in ("", "/metrics"):
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        u.log.debug("metrics: " + format, *args)
+
+
+def start_http_server(port: int = u.METRICS_PORT) -> ThreadingHTTPServer:
+    """ Serves the metrics on 0.0.0.0:port/metrics from a daemon thread
+    """
+    server = ThreadingHTTPServer(("0.0.0.0", port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    u.log.info("parser: serving metrics on port %d", port)
+    return server
@@ -0,0 +1,323 @@
+""" The optional journey planner (REALTIME_PLANNER): earliest arrival from one station to another, leaving at a
+given time, over the realtime trips & the static transfers, with RAPTOR (Delling, Pajor & Werneck, "Round-Based
+Public Transit Routing").
+
+RAPTOR works on "routes" whose trips visit the same stations in the same order without overtaking one another;
+here each is a Pattern. A branch's trips in one direction that are suffixes of the same station sequence (the
+realtime feeds drop the stations a trip has passed) share a pattern, and a trip that would overtake another, or
+that visits other stations, gets its own. A pattern's arrival times are one flat array, station by station, with
+its trips sorted, so the earliest trip one can board at a station is a bisect.
+
+The index is updated each cycle from the diff from the previous data, rebuilding only the patterns of the
+branches whose trips changed (see Planner.update), and answers queries in a few ms. Journeys are requested by
+pushing JSON requests to realtime:plan_requests in Redis (see RealtimeManager.serve_plan_requests; the web_server
+doesn't relay requests from its clients yet):
+    {"id": REQUEST_ID, "from": STATION_HASH, "to": STATION_HASH, "departure": TIMESTAMP (optional, now by default)}
+and the answer is stored at realtime:plan:REQUEST_ID for PLAN_TTL seconds, and its id published on realtime_plans:
+    {"id": REQUEST_ID, "arrival": TIMESTAMP, "legs": [[TRIP_HASH or null for a transfer, FROM_STATION_HASH,
+     DEPARTURE_TIME, TO_STATION_HASH, ARRIVAL_TIME], ...]}
+    or {"id": REQUEST_ID, "error": "no_journey"}; invalid requests are logged & dropped
+"""
+import json
+from array import array
+from bisect import bisect_left
+from typing import Any, Dict, Iterable, List, Mapping, NamedTuple, Optional, Set, Tuple
+import util as u  # type: ignore
+
+PLAN_TTL = 60  # seconds the answers are kept for
+INFINITY = 2 ** 62
+
+GroupKey = Tuple[u.Branch, bool]  # a branch & direction, whose trips are split into patterns
+
+
+class Leg(NamedTuple):
+    trip: Optional[u.TripHash]  # None for a transfer
+    from_station: u.StationHash
+    departure_time: int
+    to_station: u.StationHash
+    arrival_time: int
+
+
+class Journey(NamedTuple):
+    arrival_time: int
+    legs: List[Leg]
+
+
+class Pattern:
+    """ Trips visiting stations in order, none overtaking another. times[i * len(trips) + j] is when trip j
+    arrives at stations[i], or 0 if it's past it already; along each station the trips are in order.
+    """
+
+    __slots__ = ("stations", "trips", "times")
+
+    def __init__(self, stations: Tuple[u.StationHash, ...], trips: List[u.TripHash], times: array) -> None:
+        self.stations = stations
+        self.trips = trips
+        self.times = times
+
+
+class Planner:
+    def __init__(self) -> None:
+        self.members: Dict[GroupKey, Set[u.TripHash]] = {}
+        self.patterns: Dict[GroupKey, List[Pattern]] = {}
+        self.patterns_at: Dict[u.StationHash, Dict[Pattern, int]] = {}  # a station's position in each pattern
+        self.footpaths: Dict[u.StationHash, List[Tuple[u.StationHash, u.TransferTime]]] = {}
+        self.change_times: Dict[u.StationHash, u.TransferTime] = {}  # for changing trains within a station
+        self.timestamp = 0  # of the data the index reflects
+        self.static_timestamp = -1
+
+    def update(
+        self, old_data: Optional[u.RealtimeData], new_data: u.RealtimeData, data_diff: Optional[u.DataDiff]
+    ) -> int:
+        """ Brings the index from old_data to new_data, applying data_diff (from old_data to new_data) if the
+        index reflects old_data, or rebuilding it otherwise. Returns how many patterns were rebuilt.
+        """
+        if (
+            old_data is not None
+            and data_diff is not None
+            and old_data.realtime_timestamp == self.timestamp
+            and new_data.static_timestamp == self.static_timestamp
+        ):
+            rebuilt = self.apply(data_diff, old_data.trips, new_data.trips)
+        else:
+            rebuilt = self.build(new_data)
+        self.timestamp = new_data.realtime_timestamp
+        return rebuilt
+
+    def build(self, data: u.RealtimeData) -> int:
+        self.footpaths = {
+            station: [(to_station, time) for to_station, time in transfers.items() if to_station != station]
+            for station, transfers in data.transfers.items()
+        }
+        self.change_times = {
+            station: transfers[station] for station, transfers in data.transfers.items() if station in transfers
+        }
+        self.static_timestamp = data.static_timestamp
+
+        self.members, self.patterns, self.patterns_at = {}, {}, {}
+        for trip_hash, trip in data.trips.items():
+            self.members.setdefault(group_key(trip), set()).add(trip_hash)
+        return self.rebuild(list(self.members), data.trips)
+
+    def apply(
+        self, data_diff: u.DataDiff, old_trips: Mapping[u.TripHash, u.Trip], new_trips: Mapping[u.TripHash, u.Trip]
+    ) -> int:
+        changed = set(data_diff.trips.deleted)
+        changed.update(trip.id_ for trip in data_diff.trips.added)
+        changed.update(data_diff.branch.modified)
+        changed.update(data_diff.arrivals.deleted)
+        changed.update(data_diff.arrivals.added)
+        for trip_stations in data_diff.arrivals.modified.values():
+            changed.update(trip_stations)
+
+        dirty: Set[GroupKey] = set()
+        for trip_hash in changed:
+            if trip_hash in old_trips:
+                key = group_key(old_trips[trip_hash])
+                self.members[key].discard(trip_hash)
+                dirty.add(key)
+            if trip_hash in new_trips:
+                key = group_key(new_trips[trip_hash])
+                self.members.setdefault(key, set()).add(trip_hash)
+                dirty.add(key)
+        return self.rebuild(dirty, new_trips)
+
+    def rebuild(self, keys: Iterable[GroupKey], trips: Mapping[u.TripHash, u.Trip]) -> int:
+        """ Replaces the patterns of the groups keys with ones built from their current members
+        """
+        rebuilt = 0
+        for key in keys:
+            for pattern in self.patterns.pop(key, []):
+                for station in pattern.stations:
+                    positions = self.patterns_at[station]
+                    del positions[pattern]
+                    if not positions:
+                        del self.patterns_at[station]
+            if not self.members.get(key):
+                self.members.pop(key, None)
+                continue
+            patterns = build_patterns([trips[trip_hash] for trip_hash in self.members[key]])
+            for pattern in patterns:
+                for i, station in enumerate(pattern.stations):
+                    self.patterns_at.setdefault(station, {})[pattern] = i
+            self.patterns[key] = patterns
+            rebuilt += len(patterns)
+        return rebuilt
+
+    def plan(
+        self,
+        origin: u.StationHash,
+        destination: u.StationHash,
+        departure_time: int,
+        max_transfers: int = u.PLANNER_MAX_TRANSFERS,
+    ) -> Optional[Journey]:
+        """ The journey leaving origin at departure_time that arrives at destination the earliest, with at most
+        max_transfers changes of trains, or None if there isn't one
+        """
+        if origin == destination:
+            return Journey(arrival_time=departure_time, legs=[])
+
+        # a train's arrival at a station and when one can board another there differ by the station's change
+        # time, and a walk arrives ready to board, so they're pruned apart: rides on the earliest arrival by train
+        # (which footpaths start from), walks on the earliest boarding time
+        arrival = INFINITY  # at destination, so far
+        arrived: Dict[u.StationHash, int] = {origin: departure_time}  # earliest arrival by train so far
+        boardable: Dict[u.StationHash, int] = {origin: departure_time}  # earliest time to board a train so far
+        ready: Dict[u.StationHash, int] = {origin: departure_time}  # those boardable improved, for the next round
+        # how each station was reached in each round: by a ride (pattern, trip, boarding position, position)
+        # or by a transfer from another station
+        rides: List[Dict[u.StationHash, Tuple[Pattern, int, int, int]]] = [{}]
+        walks: List[Dict[u.StationHash, Tuple[u.StationHash, int, int]]] = [{}]
+        for to_station, time in self.footpaths.get(origin, ()):
+            boardable[to_station] = ready[to_station] = departure_time + time
+            walks[0][to_station] = (origin, departure_time, departure_time + time)
+            if to_station == destination:
+                arrival = departure_time + time
+
+        for _ in range(max_transfers + 1):
+            queue: Dict[Pattern, int] = {}
+            for station in ready:
+                for pattern, position in self.patterns_at.get(station, {}).items():
+                    if position < queue.get(pattern, INFINITY):
+                        queue[pattern] = position
+
+            round_rides: Dict[u.StationHash, Tuple[Pattern, int, int, int]] = {}
+            for pattern, start in queue.items():
+                stations, times, trip_count = pattern.stations, pattern.times, len(pattern.trips)
+                trip, boarded_at = trip_count, -1  # trip_count for none
+                for i in range(start, len(stations)):
+                    station = stations[i]
+                    offset = i * trip_count
+                    if trip < trip_count:
+                        arrival_time = times[offset + trip]
+                        if arrival_time < arrived.get(station, INFINITY) and arrival_time < arrival:
+                            arrived[station] = arrival_time
+                            round_rides[station] = (pattern, trip, boarded_at, i)
+                            if station == destination:
+                                arrival = arrival_time
+                    board_time = ready.get(station)
+                    if board_time is not None and (trip == trip_count or board_time <= times[offset + trip]):
+                        earliest = bisect_left(times, board_time, offset, offset + trip) - offset
+                        if earliest < trip:
+                            trip, boarded_at = earliest, i
+
+            ready = {}
+            round_walks: Dict[u.StationHash, Tuple[u.StationHash, int, int]] = {}
+            for station, (pattern, trip, _, i) in round_rides.items():
+                arrival_time = pattern.times[i * len(pattern.trips) + trip]
+                board_time = arrival_time + self.change_times.get(station, 0)
+                if board_time < boardable.get(station, INFINITY):
+                    boardable[station] = ready[station] = board_time
+                for to_station, time in self.footpaths.get(station, ()):
+                    walk_arrival = arrival_time + time
+                    if walk_arrival < boardable.get(to_station, INFINITY) and walk_arrival < arrival:
+                        boardable[to_station] = ready[to_station] = walk_arrival
+                        round_walks[to_station] = (station, arrival_time, walk_arrival)
+                        if to_station == destination:
+                            arrival = walk_arrival
+            rides.append(round_rides)
+            walks.append(round_walks)
+            if not ready:
+                break
+
+        if arrival == INFINITY:
+            return None
+        return Journey(arrival_time=arrival, legs=self.legs(destination, arrival, rides, walks))
+
+    def legs(
+        self,
+        destination: u.StationHash,
+        arrival: int,
+        rides: List[Dict[u.StationHash, Tuple[Pattern, int, int, int]]],
+        walks: List[Dict[u.StationHash, Tuple[u.StationHash, int, int]]],
+    ) -> List[Leg]:
+        """ Follows the labels plan left back from destination, reached at arrival, to the origin: at each
+        station, the walk if it got there in time for the next leg, or else the ride
+        """
+        round_ = max(k for k in range(len(rides)) if destination in rides[k] or destination in walks[k])
+        legs: List[Leg] = []
+        station, by = destination, arrival
+        while round_ >= 0:
+            walk = walks[round_].get(station)
+            if walk is not None and walk[2] <= by:
+                from_station, departure_time, arrival_time = walk
+                legs.append(Leg(None, from_station, departure_time, station, arrival_time))
+                station, by = from_station, departure_time
+                if round_ == 0:
+                    break
+            ride = rides[round_].get(station)
+            if ride is None:
+                break  # the origin
+            pattern, trip, boarded_at, i = ride
+            trip_count = len(pattern.trips)
+            from_station = pattern.stations[boarded_at]
+            departure_time = pattern.times[boarded_at * trip_count + trip]
+            arrival_time = pattern.times[i * trip_count + trip]
+            legs.append(Leg(pattern.trips[trip], from_station, departure_time, station, arrival_time))
+            station, by = from_station, departure_time
+            round_ -= 1
+        legs.reverse()
+        return legs
+
+
+def group_key(trip: u.Trip) -> GroupKey:
+    return trip.branch, trip.direction
+
+
+def build_patterns(trips: List[u.Trip]) -> List[Pattern]:
+    """ Splits the trips of one branch & direction into patterns: each trip joins the first pattern its
+    stations are a suffix of and whose trips it doesn't overtake, or starts a new one
+    """
+    sequences = {trip.id_: tuple(sorted(trip.arrivals, key=trip.arrivals.__getitem__)) for trip in trips}
+    trips = sorted(trips, key=lambda trip: (-len(sequences[trip.id_]), trip.id_))
+
+    groups: List[Tuple[Tuple[u.StationHash, ...], List[Tuple[List[int], u.TripHash]]]] = []
+    for trip in trips:
+        sequence = sequences[trip.id_]
+        for stations, members in groups:
+            if len(sequence) <= len(stations) and stations[len(stations) - len(sequence):] == sequence:
+                times = [trip.arrivals.get(station, 0) for station in stations]
+                if all(not overtakes(times, other) for other, _ in members):
+                    members.append((times, trip.id_))
+                    break
+        else:
+            groups.append((sequence, [([trip.arrivals[station] for station in sequence], trip.id_)]))
+
+    patterns = []
+    for stations, members in groups:
+        members.sort(key=lambda member: member[0][::-1])
+        times = array("q", (member[0][i] for i in range(len(stations)) for member in members))
+        patterns.append(Pattern(stations, [trip_hash for _, trip_hash in members], times))
+    return patterns
+
+
+def overtakes(times: List[int], other: List[int]) -> bool:
+    """ Whether the trip arriving at times is earlier than the other somewhere and later elsewhere
+    """
+    earlier = later = False
+    for time, other_time in zip(times, other):
+        if time < other_time:
+            earlier = True
+        elif time > other_time:
+            later = True
+    return earlier and later
+
+
+def parse_request(raw: bytes, now: int) -> Tuple[str, u.StationHash, u.StationHash, int]:
+    """ The id, origin, destination & departure time of a plan request, raising ValueError if it's invalid
+    """
+    try:
+        request = json.loads(raw)
+        return str(request["id"]), int(request["from"]), int(request["to"]), int(request.get("departure") or now)
+    except (KeyError, TypeError, AttributeError, ValueError) as err:
+        raise ValueError(f"invalid plan request {raw!r} ({err!r})")
+
+
+def encode(request_id: str, journey: Optional[Journey]) -> str:
+    answer: Dict[str, Any] = {"id": request_id}
+    if journey is None:
+        answer["error"] = "no_journey"
+    else:
+        answer["arrival"] = journey.arrival_time
+        answer["legs"] = [list(leg) for leg in journey.legs]
+    return json.dumps(answer, separators=(",", ":"))
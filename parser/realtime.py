@@ -2,28 +2,49 @@
 """
 import sys
 import time
-from typing import Dict, NamedTuple, NewType, Union
+from typing import Callable, Deque, Dict, Iterable, Iterator, List, NamedTuple, NewType, Optional, Set, Tuple, Type, Union
+from collections import deque
+from dataclasses import replace
 import json
-import zlib
+import hashlib
+import itertools
+import random
+import statistics
 import redis
 import asyncio
 import aiohttp  # type: ignore
 import concurrent.futures
-from google.transit.gtfs_realtime_pb2 import FeedMessage  # type: ignore
+from google.transit.gtfs_realtime_pb2 import FeedEntity, FeedMessage  # type: ignore
 from google.protobuf.message import DecodeError
 import transit_data_access_pb2  # type: ignore
+import boards  # type: ignore
+import checkpoint  # type: ignore
+import planner  # type: ignore
+import shards  # type: ignore
+import codec  # type: ignore
+import fanout  # type: ignore
+import leader  # type: ignore
+import metrics  # type: ignore
 import static  # type: ignore
 import util as u  # type: ignore
 import middleware  # type: ignore
+import shm  # type: ignore
+import snapshots  # type: ignore
 
 TIME_DIFF_THRESHOLD = 3
-COMPRESSION_LEVEL = 9
+LATENCY_SAMPLES = 50  # successful request latencies kept per feed, for hedging
+HEDGE_MIN_SAMPLES = 10
+PERIOD_SAMPLES = 10  # header timestamps kept per feed, to learn its publish period
+STALE_VEHICLE_AGE = 90  # seconds after its vehicle's last update that a trip is considered STOPPED
 
 FetchStatus = NewType("FetchStatus", int)
-NONE, NEW_FEED, OLD_FEED, FETCH_FAILED, DECODE_FAILED, RUNTIME_WARNING = list(
-    map(FetchStatus, range(6))
+NONE, NEW_FEED, OLD_FEED, FETCH_FAILED, DECODE_FAILED, RUNTIME_WARNING, BREAKER_OPEN, NOT_DUE = list(
+    map(FetchStatus, range(8))
 )
 
+BreakerState = NewType("BreakerState", int)
+CLOSED, HALF_OPEN, OPEN = list(map(BreakerState, range(3)))
+
 Timestamp = NewType("Timestamp", int)
 
 
@@ -33,6 +54,68 @@ class FetchResult(NamedTuple):
     error: Union[Exception, str, None] = None
 
 
+class FetchPolicy(NamedTuple):
+    timeout: u.Num  # seconds, per request
+    max_attempts: int
+    backoff_base: u.Num  # seconds before the first retry, doubling with each retry
+    backoff_cap: u.Num
+    deadline: u.Num  # seconds for all of a feed's attempts
+    hedge_percentile: u.Num  # 0 disables hedged requests
+    breaker_failures: int  # failed fetches in a row that open the circuit breaker
+    breaker_cooldown: u.Num  # seconds the breaker stays open
+
+    @classmethod
+    def for_feed(cls, id_: str) -> "FetchPolicy":
+        """ The policy from the REALTIME_* settings, with the feed's REALTIME_FETCH_POLICIES overrides
+        """
+        policy = cls(
+            timeout=u.REALTIME_TIMEOUT,
+            max_attempts=u.REALTIME_MAX_ATTEMPTS,
+            backoff_base=u.REALTIME_BACKOFF_BASE,
+            backoff_cap=u.REALTIME_BACKOFF_CAP,
+            deadline=u.REALTIME_FETCH_DEADLINE,
+            hedge_percentile=u.REALTIME_HEDGE_PERCENTILE,
+            breaker_failures=u.REALTIME_BREAKER_FAILURES,
+            breaker_cooldown=u.REALTIME_BREAKER_COOLDOWN,
+        )
+        return policy._replace(**u.REALTIME_FETCH_POLICIES.get(id_, {}))
+
+    def backoff(self, attempt: int) -> float:
+        """ Seconds to wait before retrying after the given (0-indexed) attempt, with full jitter
+        """
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """ Opens after policy.breaker_failures failed fetches in a row, so the feed isn't fetched (and its
+    last good feed is merged instead) until breaker_cooldown has passed. Then a single fetch is let
+    through (HALF_OPEN): success closes the breaker, failure opens it again.
+    """
+
+    def __init__(self, failures: int, cooldown: u.Num, clock: Callable[[], float] = time.monotonic) -> None:
+        self.failures = failures
+        self.cooldown = cooldown
+        self.clock = clock
+        self.state: BreakerState = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+
+    def allow(self) -> bool:
+        if self.state == OPEN and self.clock() - self.opened_at >= self.cooldown:
+            self.state = HALF_OPEN
+        return self.state != OPEN
+
+    def record_success(self) -> None:
+        self.state = CLOSED
+        self.consecutive_failures = 0
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1
+        if self.state == HALF_OPEN or (self.failures and self.consecutive_failures >= self.failures):
+            self.state = OPEN
+            self.opened_at = self.clock()
+
+
 class RealtimeFeedHandler:
     """ TODO: docstring
     """
@@ -43,53 +126,170 @@ class RealtimeFeedHandler:
         self.redis_server = redis_server
         self.result: FetchResult = FetchResult(NONE)
         self.latest_timestamp: int = 0
+        self.latest_size: int = 0  # bytes
         self.latest_feed: FeedMessage = None
         self.prev_feed: FeedMessage = None
+        self.policy = FetchPolicy.for_feed(id_)
+        self.breaker = CircuitBreaker(self.policy.breaker_failures, self.policy.breaker_cooldown)
+        self.latencies: Deque[float] = deque(maxlen=LATENCY_SAMPLES)  # seconds, of successful requests
+        self.metrics_label = id_.lstrip("-") or "1234567"
+        self.header_timestamps: Deque[int] = deque(maxlen=PERIOD_SAMPLES)
+        self.next_fetch_time: float = 0.0  # see schedule()
+        self.adopted_raw: bytes = b""  # the last feed passed to adopt_feed
+
+    async def fetch(self, thread_pool_excecutor: concurrent.futures.ThreadPoolExecutor) -> None:
+        """ Fetches url, updates class attributes with feed info. Failed attempts are retried with backoff
+        while they fit in the policy's deadline; while the circuit breaker is open, the feed isn't fetched.
+        """
+        if not self.breaker.allow():
+            self.result = FetchResult(BREAKER_OPEN)
+            return
 
-    async def fetch(
-        self, thread_pool_excecutor: concurrent.futures.ThreadPoolExecutor, attempt: int = 0,
-    ) -> None:
-        """ Fetches url, updates class attributes with feed info.
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.policy.deadline
+        # replaced by the first attempt's outcome, if there's time for one
+        self.result = FetchResult(FETCH_FAILED, error=f"no attempt fits the {self.policy.deadline}s deadline")
+        for attempt in range(self.policy.max_attempts):
+            timeout = min(self.policy.timeout, deadline - loop.time())
+            if timeout <= 0:
+                break
+            metrics.FETCH_REQUESTS.inc(self.metrics_label, "first" if attempt == 0 else "retry")
+            try:
+                _raw, feed_message = await self.hedged_request(thread_pool_excecutor, timeout)
+                self.handle_feed(_raw, feed_message)
+                break
+            except asyncio.TimeoutError as err:
+                self.result = FetchResult(FETCH_FAILED, error=f"TIMEOUT of {timeout:.1f}s {err}")
+            except (OSError, aiohttp.ClientError) as err:
+                self.result = FetchResult(FETCH_FAILED, error=err)
+            except (DecodeError, SystemError) as err:
+                self.result = FetchResult(DECODE_FAILED, error=err)
+            except RuntimeWarning as err:
+                self.result = FetchResult(RUNTIME_WARNING, error=err)
+
+            backoff = min(self.policy.backoff(attempt), deadline - loop.time())
+            if attempt + 1 < self.policy.max_attempts and backoff > 0:
+                u.log.debug("parser: Fetch failed for %s, trying again in %.2fs", self.id_, backoff)
+                await asyncio.sleep(backoff)
+
+        if self.result.status in (NEW_FEED, OLD_FEED):
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+            if self.breaker.state == OPEN:
+                u.log.warning("parser: circuit breaker open for feed %s", self.id_)
+        metrics.BREAKER_STATE.set(self.metrics_label, value=self.breaker.state)
+
+    async def request(
+        self, thread_pool_excecutor: concurrent.futures.ThreadPoolExecutor, timeout: float
+    ) -> Tuple[bytes, FeedMessage]:
+        """ Downloads & parses the feed once, raising on failure
         """
-        try:
-            headers = {"x-api-key": u.MTA_API_KEY}
-            realtime_timeout = aiohttp.ClientTimeout(total=u.REALTIME_TIMEOUT)
-            async with aiohttp.ClientSession(timeout=realtime_timeout) as session:
-                async with session.get(self.url, headers=headers) as response:
-                    _raw = await response.read()
-                    feed_message = FeedMessage()
-
-                    loop = asyncio.get_event_loop()
-                    await loop.run_in_executor(
-                        thread_pool_excecutor, feed_message.ParseFromString, _raw,
-                    )
+        start = time.perf_counter()
+        headers = {"x-api-key": u.MTA_API_KEY}
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+            async with session.get(self.url, headers=headers) as response:
+                response.raise_for_status()
+                _raw = await response.read()
+        feed_message = FeedMessage()
+        await asyncio.get_event_loop().run_in_executor(
+            thread_pool_excecutor, feed_message.ParseFromString, _raw,
+        )
+        self.latencies.append(time.perf_counter() - start)
+        return _raw, feed_message
 
-                    timestamp: int = feed_message.header.timestamp
-                    if timestamp >= self.latest_timestamp + TIME_DIFF_THRESHOLD:
-                        self.result = FetchResult(NEW_FEED, timestamp=timestamp)
-                        (self.prev_feed, self.latest_feed, self.latest_timestamp,) = (
-                            self.latest_feed,
-                            feed_message,
-                            timestamp,
-                        )
-                        self.redis_server.hset("realtime:feeds", self.id_, _raw)
-                    else:
-                        self.result = FetchResult(OLD_FEED)
-                    return
-        except OSError as err:
-            self.result = FetchResult(FETCH_FAILED, error=err)
-        except (DecodeError, SystemError) as err:
-            self.result = FetchResult(DECODE_FAILED, error=err)
-        except RuntimeWarning as err:
-            self.result = FetchResult(RUNTIME_WARNING, error=err)
-        except asyncio.TimeoutError as err:
-            self.result = FetchResult(FETCH_FAILED, error=f"TIMEOUT of {err}")
-
-        if attempt + 1 < u.REALTIME_MAX_ATTEMPTS:
-            u.log.debug("parser: Fetch failed for %s, trying again", self.id_)
-            await self.fetch(
-                attempt=attempt + 1, thread_pool_excecutor=thread_pool_excecutor,
+    def hedge_delay(self) -> Optional[float]:
+        """ How long to wait for a request before sending a second one, or None to not hedge
+        """
+        if not self.policy.hedge_percentile or len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * self.policy.hedge_percentile / 100))]
+
+    async def hedged_request(
+        self, thread_pool_excecutor: concurrent.futures.ThreadPoolExecutor, timeout: float
+    ) -> Tuple[bytes, FeedMessage]:
+        """ Requests the feed, and if it's slower than the feed's hedge_delay, requests it again, returning
+        whichever response succeeds first
+        """
+        hedge_delay = self.hedge_delay()
+        if hedge_delay is None or hedge_delay >= timeout:
+            return await self.request(thread_pool_excecutor, timeout)
+
+        first = asyncio.ensure_future(self.request(thread_pool_excecutor, timeout))
+        done, _ = await asyncio.wait([first], timeout=hedge_delay)
+        if done:
+            return first.result()
+
+        metrics.FETCH_REQUESTS.inc(self.metrics_label, "hedge")
+        second = asyncio.ensure_future(self.request(thread_pool_excecutor, timeout - hedge_delay))
+        pending = {first, second}
+        try:
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                succeeded = [task for task in done if not task.exception()]
+                if succeeded:
+                    return succeeded[0].result()
+                if not pending:
+                    return done.pop().result()  # raises the last request's error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def handle_feed(self, _raw: bytes, feed_message: FeedMessage) -> None:
+        """ Keeps the fetched feed if it's newer than the latest one, and sets self.result
+        """
+        timestamp: int = feed_message.header.timestamp
+        if timestamp >= self.latest_timestamp + TIME_DIFF_THRESHOLD:
+            self.result = FetchResult(NEW_FEED, timestamp=timestamp)
+            (self.prev_feed, self.latest_feed, self.latest_timestamp,) = (
+                self.latest_feed,
+                feed_message,
+                timestamp,
             )
+            self.latest_size = len(_raw)
+            self.header_timestamps.append(timestamp)
+            self.redis_server.hset("realtime:feeds", self.id_, _raw)
+        else:
+            self.result = FetchResult(OLD_FEED)
+
+    def adopt_feed(self, _raw: bytes) -> None:
+        """ Takes on a feed the leader fetched (see RealtimeManager.sync_from_leader) if it's newer than ours
+        """
+        if _raw == self.adopted_raw:
+            return
+        self.adopted_raw = _raw
+        _feed = FeedMessage()
+        try:
+            _feed.ParseFromString(_raw)
+        except (DecodeError, SystemError, RuntimeWarning) as err:
+            u.log.error("%s: unable to parse feed %s from the leader", err, self.id_)
+            return
+        timestamp: int = _feed.header.timestamp
+        if timestamp > self.latest_timestamp:
+            self.prev_feed, self.latest_feed, self.latest_timestamp = self.latest_feed, _feed, timestamp
+            self.latest_size = len(_raw)
+            self.header_timestamps.append(timestamp)
+
+    def update_period(self) -> Optional[float]:
+        """ The feed's publish period in seconds: the median gap between its recent header timestamps
+        """
+        if len(self.header_timestamps) < 3:
+            return None
+        timestamps = list(self.header_timestamps)
+        return statistics.median(b - a for a, b in zip(timestamps, timestamps[1:]))
+
+    def schedule(self, now: float) -> None:
+        """ Sets next_fetch_time to just after the feed is next expected to publish, or to now if it's
+        overdue, failing, or its period isn't known yet
+        """
+        period = self.update_period()
+        if period is None or self.result.status not in (NEW_FEED, OLD_FEED):
+            self.next_fetch_time = now
+            return
+        metrics.FEED_PERIOD.set(self.metrics_label, value=period)
+        expected = self.latest_timestamp + period + u.REALTIME_PUBLISH_MARGIN
+        self.next_fetch_time = min(max(expected, now), now + period + u.REALTIME_PUBLISH_MARGIN)
 
     def restore_feed_from_redis(self) -> None:
         _raw = self.redis_server.hget("realtime:feeds", self.id_)
@@ -101,6 +301,7 @@ class RealtimeFeedHandler:
             _feed.ParseFromString(_raw)
             self.latest_feed = _feed
             self.latest_timestamp = _feed.header.timestamp
+            self.latest_size = len(_raw)
         except (DecodeError, SystemError, RuntimeWarning) as err:
             u.log.error(
                 "%s: unable to parse feed %s restored from redis", err, self.id_,
@@ -111,25 +312,47 @@ class RealtimeManager:
     """docstring for RealtimeManager
     """
 
-    def __init__(self, redis_handler) -> None:
+    feed_handler_class: Type[RealtimeFeedHandler] = RealtimeFeedHandler
+
+    def __init__(self, redis_handler, clock: Callable[[], float] = time.time) -> None:
+        self.clock = clock
         self.initial_merge_attempts = 0
         self.max_initial_merge_attempts = 10
         self.redis_handler = redis_handler
         self.redis_server = redis_handler.server
-        self.feed: FeedMessage = None
+        self.feeds: List[FeedMessage] = []  # each feed's message to parse, see merge_feeds
         self.current_timestamp: Timestamp = Timestamp(0)
         self.current_data: u.RealtimeData = None  # type: ignore
+        self.static_json_str: str = ""  # the static data last loaded, decoded into static_data
+        self.static_data: u.StaticData = None  # type: ignore
         self.current_data_json: str = ""
         self.current_data_zlib: bytes = b""
-        self.data_dict: Dict[Timestamp, u.RealtimeData] = {}
-
-        self.diff_dict: Dict[Timestamp, u.DataDiff] = {}
-        self.diff_dict_zlib: Dict[Timestamp, bytes] = {}
+        self.current_data_size: int = 0  # bytes, before compression
+        self.current_fingerprint: str = ""
+        self.codec: codec.Codec = codec.get_codec()
+        self.snapshots = snapshots.SnapshotStore()  # the published snapshots, with their diffs to current_data
+        self.diff_cache: Dict[Tuple[Timestamp, Timestamp], bytes] = u.LRUCache(u.DIFF_CACHE_SIZE)
+        self.cycles_since_checkpoint = 0
+        self.restored_feeds: Dict[str, bytes] = {}  # by feed id, see restore_checkpoint
+        self.shm_sink: Optional[shm.SharedMemorySink] = None  # with REALTIME_SHM_PATH
+        self.lease: Optional[leader.Lease] = None  # with PARSER_LEADER_ELECTION, only its holder publishes
+        self.fanout: Optional[fanout.FanoutServer] = None  # with REALTIME_FANOUT_PORT
+        self.boards: Optional[boards.BoardIndex] = boards.BoardIndex() if u.REALTIME_BOARDS else None
+        self.sharder: Optional[shards.Sharder] = shards.Sharder(u.REALTIME_SHARDS) if u.REALTIME_SHARDS else None
+        self.planner: Optional[planner.Planner] = planner.Planner() if u.REALTIME_PLANNER else None
+
+        # REALTIME_STREAMING state, see run_streaming
+        self.feed_trips: Dict[str, Dict[u.TripHash, u.Trip]] = {}  # each feed's latest parsed trips
+        self.stationhash_lookup: Dict[str, u.StationHash] = {}
+        self.feeds_changed: Optional[asyncio.Event] = None
+        self.publish_executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
 
         self.feed_handlers = [
-            RealtimeFeedHandler(url, id_, self.redis_server)
+            self.feed_handler_class(url, id_, self.redis_server)
             for id_, url in u.GTFS_CONF.realtime_urls.items()
         ]
+        if self.restore_checkpoint():
+            return
         with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.feed_handlers)) as executor:
             _tasks = [executor.submit(fh.restore_feed_from_redis) for fh in self.feed_handlers]
             concurrent.futures.wait(_tasks)
@@ -137,12 +360,12 @@ class RealtimeManager:
         self.load_data_dict_from_redis()
 
     def load_data_dict_from_redis(self):
-        if not self.redis_server.exists("realtime_data_dict"):
+        if not self.redis_server.exists(snapshots.REDIS_KEY):
             u.log.info("No realtime_data_dict key in Redis")
             return
 
-        _redis_data_dict_timestamps = self.redis_server.hkeys("realtime_data_dict")
-        _oldest_timestamp_desired = time.time() - u.REALTIME_DATA_DICT_CAP * u.REALTIME_FREQ
+        _redis_data_dict_timestamps = self.redis_server.hkeys(snapshots.REDIS_KEY)
+        _oldest_timestamp_desired = self.clock() - u.REALTIME_DATA_DICT_CAP * u.REALTIME_FREQ
         _outdated_timestamps = [
             t for t in _redis_data_dict_timestamps if float(t) < _oldest_timestamp_desired
         ]
@@ -150,66 +373,259 @@ class RealtimeManager:
             "removing these timestamps from redis since they're too old: %s", _outdated_timestamps,
         )
 
-        if _outdated_timestamps:
-            self.redis_server.hdel("realtime_data_dict", *_outdated_timestamps)
+        self.prune_data_dict(_outdated_timestamps)
 
-        data_json_dict = self.redis_server.hgetall("realtime_data_dict")
+        data_json_dict = self.redis_server.hgetall(snapshots.REDIS_KEY)
         u.log.debug(
             "realtime_data_dict loaded from Redis, len is %s", len(data_json_dict),
         )
 
+        evicted: List[int] = []
         try:
-            for timestamp, json_str in data_json_dict.items():
-                self.data_dict[int(timestamp.decode("utf-8"))] = json.loads(
-                    json_str, cls=u.RealtimeJSONDecoder
+            for timestamp, json_str in sorted(data_json_dict.items(), key=lambda item: int(item[0])):
+                evicted += self.snapshots.add(
+                    int(timestamp.decode("utf-8")), json.loads(json_str, cls=u.RealtimeJSONDecoder)
                 )
         except json.decoder.JSONDecodeError as e:
             u.log.error(e)
+        self.prune_data_dict(evicted)
+
+    def prune_data_dict(self, timestamps: Iterable[Union[int, bytes]]) -> None:
+        """ Removes these snapshots from Redis, unless this replica is standing by: that's up to the leader
+        """
+        if not timestamps:
+            return
+        try:
+            self.redis_server.hdel(snapshots.REDIS_KEY, *timestamps)
+        except leader.LeaseLost:
+            pass
+
+    def write_checkpoint(self) -> None:
+        """ Writes the state restore_checkpoint needs to u.REALTIME_CHECKPOINT_PATH
+        """
+        state = checkpoint.Checkpoint(
+            written_at=self.clock(),
+            current_timestamp=self.current_timestamp,
+            current_fingerprint=self.current_fingerprint,
+            current_data_zlib=self.current_data_zlib,
+            current_data_size=self.current_data_size,
+            static_json_str=self.static_json_str,
+            static_data=self.static_data,
+            snapshots=[(snapshot.timestamp, snapshot.data, snapshot.diff_zlib) for snapshot in self.snapshots],
+            feeds={
+                fh.id_: checkpoint.FeedState(
+                    raw=fh.latest_feed.SerializeToString(),
+                    latest_timestamp=fh.latest_timestamp,
+                    header_timestamps=list(fh.header_timestamps),
+                )
+                for fh in self.feed_handlers
+                if fh.latest_feed is not None
+            },
+        )
+        try:
+            size = checkpoint.write(u.REALTIME_CHECKPOINT_PATH, state)
+            u.log.debug("parser: wrote a %dKB checkpoint", size // 1024)
+        except OSError as err:
+            u.log.error("parser: could not write checkpoint: %s", err)
+
+    def restore_checkpoint(self) -> bool:
+        """ Restores the state saved by write_checkpoint, if it's recent enough for its snapshots to still
+        be retained. Returns whether it did.
+        """
+        if not u.REALTIME_CHECKPOINT_EVERY:
+            return False
+        state = checkpoint.read(u.REALTIME_CHECKPOINT_PATH)
+        if state is None:
+            return False
+        if state.written_at < self.clock() - u.REALTIME_DATA_DICT_CAP * u.REALTIME_FREQ:
+            u.log.info("parser: checkpoint is too old to restore")
+            return False
+
+        for timestamp, data, diff_zlib in state.snapshots:
+            self.snapshots.add(timestamp, data)
+            if diff_zlib is not None:
+                self.snapshots.set_diff_zlib(timestamp, diff_zlib)
+        self.current_timestamp = Timestamp(state.current_timestamp)
+        self.current_data = self.snapshots[self.current_timestamp] if self.current_timestamp in self.snapshots else None
+        self.current_fingerprint = state.current_fingerprint
+        self.current_data_zlib, self.current_data_size = state.current_data_zlib, state.current_data_size
+        self.static_json_str, self.static_data = state.static_json_str, state.static_data
+
+        for fh in self.feed_handlers:
+            if fh.id_ in state.feeds:
+                fh.latest_timestamp = state.feeds[fh.id_].latest_timestamp
+                fh.header_timestamps.extend(state.feeds[fh.id_].header_timestamps)
+        # parsing the feeds is the slow part of a restore, so it waits until after publish_checkpoint
+        self.restored_feeds = {id_: feed_state.raw for id_, feed_state in state.feeds.items()}
+        u.log.info("parser: restored %d snapshots from the checkpoint", len(self.snapshots))
+        return True
+
+    def parse_restored_feeds(self) -> None:
+        """ Parses the feeds restore_checkpoint left for later, as each handler's latest_feed
+        """
+        for fh in self.feed_handlers:
+            raw = self.restored_feeds.pop(fh.id_, None)
+            if raw is None or fh.latest_feed is not None:
+                continue
+            fh.latest_feed = FeedMessage()
+            fh.latest_feed.ParseFromString(raw)
+            fh.latest_size = len(raw)
+
+    def publish_checkpoint(self) -> bool:
+        """ Pushes the data restored from a checkpoint if Redis doesn't have it (e.g. Redis restarted too),
+        so clients needn't wait for the first update(). Returns whether it did.
+        """
+        if not self.current_data_zlib or (self.lease is not None and not self.lease.is_leader):
+            return False
+        published_timestamp = self.redis_server.get("realtime:current_timestamp")
+        if published_timestamp is not None and int(published_timestamp) >= self.current_timestamp:
+            return False
+        self.push(self.snapshots.diffs_zlib())
+        return True
+
+    def push(self, data_diffs: Dict[Timestamp, bytes]) -> None:
+        """ Pushes the current full payload & data_diffs to Redis, and to the shared-memory output and the
+        fan-out server if they're on.
+        With a lease, raises leader.LeaseLost instead if this replica isn't the leader anymore.
+        """
+        fencing_token = self.lease.check() if self.lease is not None else None
+        self.redis_handler.realtime_push(
+            current_timestamp=self.current_timestamp,
+            data_full=self.current_data_zlib,
+            data_diffs=data_diffs,
+            fencing_token=fencing_token,
+        )
+        if self.shm_sink is not None:
+            self.shm_sink.write(self.current_timestamp, self.current_data_zlib, data_diffs)
+        if self.fanout is not None:
+            self.fanout.publish(self.current_timestamp, self.current_data_zlib, data_diffs)
 
     async def fetch_all(self) -> None:
         """get all new feeds, check each, and combine
         """
+        if self.restored_feeds:
+            self.parse_restored_feeds()
+        now = self.clock()
+        due = [fh for fh in self.feed_handlers if not u.REALTIME_ADAPTIVE or fh.next_fetch_time <= now]
+        for fh in self.feed_handlers:
+            if fh not in due:
+                fh.result = FetchResult(NOT_DUE)
+                metrics.FETCHES_SKIPPED.inc(fh.metrics_label)
+
         with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.feed_handlers)) as executor:
             u.log.debug("parser: Checking feeds!")
-            await asyncio.gather(
-                *[fh.fetch(thread_pool_excecutor=executor) for fh in self.feed_handlers]
-            )
+            await asyncio.gather(*[fh.fetch(thread_pool_excecutor=executor) for fh in due])
 
+        now = self.clock()
         for fh in self.feed_handlers:
-            if fh.result.status not in [NEW_FEED, OLD_FEED]:
+            if fh in due and u.REALTIME_ADAPTIVE:
+                fh.schedule(now)
+            if fh.latest_timestamp:
+                metrics.FEED_AGE.observe(fh.metrics_label, value=max(0.0, now - fh.latest_timestamp))
+            if fh.result.status == NOT_DUE:
+                continue
+            if fh.result.status == BREAKER_OPEN:
+                u.log.debug("parser: circuit breaker open, merging the last good feed %s", fh.id_)
+            elif fh.result.status not in [NEW_FEED, OLD_FEED]:
                 u.log.error(
                     "parser: Encountered %s when fetching feed %s", fh.result.error, fh.id_,
                 )
 
         new_feeds = sum([int(fh.result.status == NEW_FEED) for fh in self.feed_handlers])
         u.log.info("parser: %s new feeds", new_feeds)
+        metrics.FEEDS_CHANGED.observe(value=new_feeds)
         if new_feeds < 1:
             raise u.UpdateFailed("No new feeds.")
 
+    def next_update_time(self) -> float:
+        """ When the next cycle should run with REALTIME_ADAPTIVE: when the first feed is due, but no sooner
+        than REALTIME_MIN_FREQ and no later than REALTIME_FREQ from now
+        """
+        now = self.clock()
+        first_due = min(fh.next_fetch_time for fh in self.feed_handlers)
+        return min(max(first_due, now + u.REALTIME_MIN_FREQ), now + u.REALTIME_FREQ)
+
     def merge_feeds(self) -> None:
-        """ Parses the feed into the smallest possible representation of the necessary realtime data.
+        """ Picks each feed's latest message, or its previous one if there's no latest, for parse() to
+        iterate in turn. The messages aren't copied into one merged FeedMessage.
         """
-        full_feed = FeedMessage()
+        feeds = []
         for fh in self.feed_handlers:
-            try:
-                full_feed.MergeFrom(fh.latest_feed)
-            except (ValueError, TypeError):
-                try:
-                    full_feed.MergeFrom(fh.prev_feed)
-                except (ValueError, TypeError) as err:
-                    u.log.error("Could not merge feed %s. Error: %s", fh.id_, err)
+            feed = fh.latest_feed if fh.latest_feed is not None else fh.prev_feed
+            if feed is None:
+                u.log.error("Could not merge feed %s. Error: no feed fetched", fh.id_)
+                continue
+            feeds.append(feed)
+
+        self.feeds = feeds
 
-        self.feed = full_feed
+    def entities(self) -> Iterator[FeedEntity]:
+        """ Iterates over the entities of every merged feed
+        """
+        return itertools.chain.from_iterable(feed.entity for feed in self.feeds)
+
+    def sync_from_leader(self) -> None:
+        """ Keeps a standby replica warm: adopts the newer feeds the leader stored in realtime:feeds and
+        decodes the static data if it changed, so taking over only costs one update()
+        """
+        if self.restored_feeds:
+            self.parse_restored_feeds()
+        raw_feeds = self.redis_server.hgetall("realtime:feeds")
+        for fh in self.feed_handlers:
+            _raw = raw_feeds.get(fh.id_.encode("utf-8"))
+            if _raw:
+                fh.adopt_feed(_raw)
+        if self.redis_server.exists("static:json_full"):
+            self.refresh_static()
+
+    def take_over(self) -> None:
+        """ Publishes the feeds adopted by sync_from_leader right away when this replica becomes the leader,
+        rather than waiting for a feed to change
+        """
+        if self.restored_feeds:
+            self.parse_restored_feeds()
+        tmp_data_placeholder = self.current_data
+        tmp_timestamp_placeholder = self.current_timestamp
+        try:
+            self.merge_feeds()
+            if not self.feeds:
+                raise u.UpdateFailed("No feeds to take over with.")
+            self.load_static()
+            self.parse()
+            self.publish(tmp_data_placeholder, tmp_timestamp_placeholder)
+        except (u.UpdateFailed, leader.LeaseLost) as err:
+            self.current_data = tmp_data_placeholder
+            self.current_timestamp = tmp_timestamp_placeholder
+            u.log.error(err)
+            metrics.CYCLES.inc("failed")
 
     def load_static(self) -> None:
         """Loads the static.json file into self.current_data
         """
+        static_data = self.refresh_static()
+        self.current_timestamp = Timestamp(int(self.clock()))
+        self.current_data = u.RealtimeData(
+            name=static_data.name,
+            static_timestamp=static_data.static_timestamp,
+            routes=static_data.routes,
+            stations=static_data.stations,
+            station_complexes=static_data.station_complexes,
+            routehash_lookup=static_data.routehash_lookup,
+            stationhash_lookup=static_data.stationhash_lookup,
+            transfers=static_data.transfers,
+            realtime_timestamp=self.current_timestamp,
+        )
+
+    def refresh_static(self) -> u.StaticData:
+        """ Returns the static data in Redis (running the static parser if there's none), decoding it into
+        self.static_data only when it changed
+        """
         try:
             static_json_str = self.redis_server.get("static:json_full").decode("utf-8")
             u.log.debug("got static from redis!")
         except AttributeError:
             u.log.warning("STATIC NOT FOUND, running static parser")
-            sh = static.StaticHandler(self.redis_server)
+            sh = static.StaticHandler(self.redis_server, clock=self.clock)
             sh.update()
             static_json_str = self.redis_server.get("static:json_full").decode("utf-8")
             del sh
@@ -217,41 +633,53 @@ class RealtimeManager:
         if not static_json_str:
             raise u.UpdateFailed("Could not load static")
 
-        static_data = json.loads(static_json_str, cls=u.StaticJSONDecoder)
-        self.current_timestamp = Timestamp(int(time.time()))
-        self.current_data = u.RealtimeData(
-            name=static_data.name,
-            static_timestamp=static_data.static_timestamp,
-            routes=static_data.routes,
-            stations=static_data.stations,
-            station_complexes={str(k): v for k, v in static_data.station_complexes.items()},
-            routehash_lookup={str(k): v for k, v in static_data.routehash_lookup.items()},
-            stationhash_lookup={str(k): v for k, v in static_data.stationhash_lookup.items()},
-            transfers={
-                int(k): {int(_k): _v for _k, _v in v.items()}
-                for k, v in static_data.transfers.items()
-            },
-            realtime_timestamp=self.current_timestamp,
-        )
+        if static_json_str != self.static_json_str:
+            # only decoded when it changes, so every snapshot shares the same (frozen) routes & stations
+            static_data = json.loads(static_json_str, cls=u.StaticJSONDecoder)
+            self.static_data = u.StaticData(
+                name=static_data.name,
+                static_timestamp=static_data.static_timestamp,
+                routes=static_data.routes,
+                stations=static_data.stations,
+                station_complexes={str(k): v for k, v in static_data.station_complexes.items()},
+                routehash_lookup={str(k): v for k, v in static_data.routehash_lookup.items()},
+                stationhash_lookup={str(k): v for k, v in static_data.stationhash_lookup.items()},
+                transfers={
+                    int(k): {int(_k): _v for _k, _v in v.items()}
+                    for k, v in static_data.transfers.items()
+                },
+            )
+            self.static_json_str = static_json_str
+        return self.static_data
 
     def parse(self) -> None:
-        for elem in self.feed.entity:
+        self.parse_entities(self.entities(), self.current_data.trips, self.current_data.stationhash_lookup)
+
+    def parse_entities(
+        self,
+        entities: Iterable[FeedEntity],
+        trips: Dict[u.TripHash, u.Trip],
+        stationhash_lookup: Dict[str, u.StationHash],
+    ) -> None:
+        """ Parses the trip updates & vehicle positions in entities into trips
+        """
+        for elem in entities:
             trip_hash = u.short_hash(elem.trip_update.trip.trip_id, u.TripHash)
             route_id = middleware.transform_route(elem.trip_update.trip.route_id)
             route_hash = u.short_hash(route_id, u.RouteHash)
 
-            if trip_hash not in self.current_data.trips:
+            if trip_hash not in trips:
                 if not len(elem.trip_update.stop_time_update):
                     continue
                 last_stop_id = elem.trip_update.stop_time_update[-1].stop_id
                 try:
-                    final_station = self.current_data.stationhash_lookup[last_stop_id]
+                    final_station = stationhash_lookup[last_stop_id]
                     if not final_station:
                         continue
                 except KeyError as err:
                     u.log.error(err)
                     continue
-                branch = u.Branch(route_hash, final_station)
+                branch = u.interned(u.Branch(route_hash, final_station))
 
                 direction = last_stop_id[-1]
                 if direction == "N":
@@ -262,14 +690,14 @@ class RealtimeManager:
                     u.log.error("%s has no direction indicator", last_stop_id)
                     continue
 
-                self.current_data.trips[trip_hash] = u.Trip(
+                trips[trip_hash] = u.Trip(
                     id_=trip_hash, branch=branch, direction=direction
                 )
 
             if elem.HasField("trip_update"):
                 for stop_time_update in elem.trip_update.stop_time_update:
                     try:
-                        station_hash = self.current_data.stationhash_lookup[
+                        station_hash = stationhash_lookup[
                             stop_time_update.stop_id
                         ]
                     except KeyError:
@@ -281,38 +709,60 @@ class RealtimeManager:
                         arrival_time = u.ArrivalTime(stop_time_update.departure.time) - 15
                         # TODO ^^ this is hacky...
 
-                    if arrival_time < time.time():
+                    if arrival_time < self.clock():
                         continue
-                    self.current_data.trips[trip_hash].add_arrival(station_hash, arrival_time)
+                    trips[trip_hash].add_arrival(station_hash, arrival_time)
 
             elif elem.HasField("vehicle"):
                 timestamp = elem.vehicle.timestamp
-                self.current_data.trips[trip_hash].timestamp = timestamp
+                trips[trip_hash] = replace(trips[trip_hash], timestamp=timestamp)
 
-                if time.time() - timestamp > 90:
+                if self.clock() - timestamp > STALE_VEHICLE_AGE:
                     trip_hash = u.short_hash(elem.vehicle.trip.trip_id, u.TripHash)
-                    self.current_data.trips[trip_hash].status = u.STOPPED
+                    trips[trip_hash] = replace(trips[trip_hash], status=u.STOPPED)
 
-    def load_data_and_diffs(self) -> None:
-        self.data_dict[self.current_timestamp] = self.current_data
-
-        # TODO !!! optimize this with piping
-        self.redis_server.hset(
-            "realtime_data_dict", self.current_timestamp, self.current_data_json,
-        )
-        if self.redis_server.hlen("realtime_data_dict") > u.REALTIME_DATA_DICT_CAP:
-            self.redis_server.hdel(
-                "realtime_data_dict", min(self.redis_server.hkeys("realtime_data_dict")),
+    def fingerprint(self) -> str:
+        """ Returns a content hash of the parsed trip state, so unchanged cycles can skip publishing
+        """
+        hash_ = hashlib.blake2b(digest_size=16)
+        trips = self.current_data.trips
+        for trip_hash in sorted(trips):
+            trip = trips[trip_hash]
+            hash_.update(
+                repr(
+                    (
+                        trip_hash,
+                        trip.branch,
+                        trip.direction,
+                        trip.status,
+                        trip.timestamp,
+                        sorted(trip.arrivals.items()),
+                    )
+                ).encode()
             )
-        assert self.redis_server.hlen("realtime_data_dict") <= u.REALTIME_DATA_DICT_CAP
+        return hash_.hexdigest()
 
-        new_diff_dict = {}
-        for timestamp in set(self.data_dict) - {self.current_timestamp}:
-            new_diff_dict[timestamp] = self.diff(
-                old_data=self.data_dict[timestamp], new_data=self.current_data
-            )
+    def load_data_and_diffs(self) -> None:
+        self.snapshots.add(
+            self.current_timestamp, self.current_data, self.redis_server, self.current_data_json
+        )
+        self.snapshots.set_diffs(
+            {
+                timestamp: self.diff(old_data=self.snapshots[timestamp], new_data=self.current_data)
+                for timestamp in self.baseline_timestamps()
+            }
+        )
 
-        self.diff_dict = new_diff_dict
+    def baseline_timestamps(self) -> List[Timestamp]:
+        """ Returns the timestamps of the stored snapshots that diffs should be built from,
+        i.e. those u.DIFF_BASELINES published cycles before the current one
+        """
+        previous_timestamps = [t for t in reversed(self.snapshots.timestamps()) if t != self.current_timestamp]
+        return [
+            previous_timestamps[cycles_back - 1]
+            for cycles_back in u.DIFF_BASELINES
+            if cycles_back <= len(previous_timestamps)
+        ]
 
     def serialize_to_JSON(self):
         """ Stores data in outfile with custom JSON encoder u.RealtimeJSONEncoder
@@ -366,7 +816,7 @@ class RealtimeManager:
                 time_diff = u.TimeDiff(
                     new_trip.arrivals[station_hash] - old_trip.arrivals[station_hash]
                 )
-                arrivals_diff.modified[time_diff][trip_hash].append(station_hash)
+                arrivals_diff.modified.setdefault(time_diff, {}).setdefault(trip_hash, []).append(station_hash)
 
             # Then, find status & branch changes:
             if new_trip.status != old_trip.status:
@@ -387,7 +837,15 @@ class RealtimeManager:
     def full_to_protobuf_zlib(self) -> None:
         """ doc
         """
-        data_full = self.current_data
+        proto_full_str = self.full_to_protobuf(self.current_data)
+        self.current_data_size = len(proto_full_str)
+        self.current_data_zlib = self.codec.encode(proto_full_str)
+
+        u.log.debug("full: %fKB", sys.getsizeof(self.current_data_zlib) / 1024)
+
+    def full_to_protobuf(self, data_full: u.RealtimeData) -> bytes:
+        """ Serializes data_full into a DataFull message
+        """
         proto_full = transit_data_access_pb2.DataFull()
 
         proto_full.name = data_full.name
@@ -432,11 +890,7 @@ class RealtimeManager:
             for station_hash, arrival_time in trip.arrivals.items():
                 proto_full.trips[trip_hash].arrivals[station_hash] = arrival_time
 
-        self.current_data_zlib = zlib.compress(
-            proto_full.SerializeToString(), level=COMPRESSION_LEVEL
-        )
-
-        u.log.debug("full: %fKB", sys.getsizeof(self.current_data_zlib) / 1024)
+        return proto_full.SerializeToString(deterministic=True)
 
     def diff_to_protobuf_zlib(self, data_diff: u.DataDiff) -> bytes:
         """ doc
@@ -481,53 +935,389 @@ class RealtimeManager:
             proto_update.branch[trip_hash].route_hash = branch.route
             proto_update.branch[trip_hash].final_station = branch.final_station
 
-        compressed_protobuf = zlib.compress(
-            proto_update.SerializeToString(), level=COMPRESSION_LEVEL
-        )
+        compressed_protobuf = self.codec.encode(proto_update.SerializeToString(deterministic=True))
         return compressed_protobuf
 
     def all_diff_to_protobuf_zlib(self):
-        for timestamp in sorted(self.diff_dict.keys()):
-            diff = self.diff_dict[timestamp]
+        # only the baselines have diffs (see set_diffs), so diffs from older baselines aren't pushed
+        for timestamp, diff in self.snapshots.diffs().items():
             _zlib = self.diff_to_protobuf_zlib(diff)
             u.log.debug("update %s: %fKB", timestamp, sys.getsizeof(_zlib) / 1024)
-            self.diff_dict_zlib[timestamp] = _zlib
+            self.snapshots.set_diff_zlib(timestamp, _zlib)
+
+    def lazy_diff(self, from_timestamp: Timestamp) -> Optional[bytes]:
+        """ Returns the compressed diff from the snapshot at from_timestamp to the current data,
+        building & caching it if it wasn't precomputed. Returns None if that snapshot isn't retained.
+        """
+        data_diff_zlib = self.snapshots.diff_zlib(from_timestamp)
+        if data_diff_zlib is not None:
+            return data_diff_zlib
+
+        key = (from_timestamp, self.current_timestamp)
+        data_diff_zlib = self.diff_cache.get(key)
+        if data_diff_zlib is None:
+            if from_timestamp not in self.snapshots or from_timestamp == self.current_timestamp:
+                return None
+            data_diff = self.diff(old_data=self.snapshots[from_timestamp], new_data=self.current_data)
+            data_diff_zlib = self.diff_to_protobuf_zlib(data_diff)
+            self.diff_cache[key] = data_diff_zlib
+        return data_diff_zlib
+
+    def serve_diff_requests(self, timeout: int = 1) -> None:
+        """ Answers the web_server's requests (timestamps pushed to realtime:diff_requests) for a diff
+        from a given snapshot to the current one. Blocks for up to timeout seconds waiting for one.
+        """
+        self.answer_diff_requests(self.pop_diff_requests(timeout))
+
+    def pop_diff_requests(self, timeout: int) -> Set[Timestamp]:
+        """ Returns the timestamps diffs were requested from, waiting for up to timeout seconds for one
+        """
+        request = self.redis_server.blpop("realtime:diff_requests", timeout=timeout)
+        if not request:
+            return set()
+
+        # several web_server replicas may ask for the same diff, so drain the list & answer each once
+        requested = {request[1]}
+        while True:
+            request = self.redis_server.lpop("realtime:diff_requests")
+            if request is None:
+                break
+            requested.add(request)
+
+        from_timestamps = set()
+        for raw_timestamp in requested:
+            try:
+                from_timestamps.add(Timestamp(int(raw_timestamp)))
+            except ValueError:
+                u.log.warning("parser: ignoring invalid diff request %s", raw_timestamp)
+        return from_timestamps
+
+    def answer_diff_requests(self, from_timestamps: Set[Timestamp]) -> None:
+        for from_timestamp in sorted(from_timestamps):
+            self.redis_handler.realtime_push_diff(
+                from_timestamp=from_timestamp,
+                to_timestamp=self.current_timestamp,
+                data_diff=self.lazy_diff(from_timestamp) if self.current_data else None,
+            )
+
+    def serve_plan_requests(self, timeout: int = 1) -> None:
+        """ Answers the journey requests pushed to realtime:plan_requests (see planner.py), waiting for up to
+        timeout seconds for one, or not at all if it's 0
+        """
+        self.answer_plan_requests(self.pop_plan_requests(timeout))
+
+    def pop_plan_requests(self, timeout: int) -> List[bytes]:
+        """ Returns the pending journey requests, waiting for up to timeout seconds for one (none if it's 0)
+        """
+        if timeout:
+            request = self.redis_server.blpop("realtime:plan_requests", timeout=timeout)
+            raw_request = request[1] if request else None
+        else:
+            raw_request = self.redis_server.lpop("realtime:plan_requests")
+
+        raw_requests = []
+        while raw_request is not None:
+            raw_requests.append(raw_request)
+            raw_request = self.redis_server.lpop("realtime:plan_requests")
+        return raw_requests
+
+    def answer_plan_requests(self, raw_requests: List[bytes]) -> None:
+        answers = {}
+        for raw_request in raw_requests:
+            try:
+                request_id, origin, destination, departure_time = planner.parse_request(raw_request, int(self.clock()))
+            except ValueError as err:
+                u.log.warning("parser: %s", err)
+            else:
+                journey = self.planner.plan(origin, destination, departure_time) if self.current_data else None
+                answers[request_id] = planner.encode(request_id, journey)
+        if answers:
+            self.redis_handler.plan_push(answers)
 
     def update(self) -> None:
         try:
             tmp_data_placeholder = self.current_data
-            asyncio.get_event_loop().run_until_complete(self.fetch_all())
-            self.merge_feeds()
-            self.load_static()
-            self.parse()
-            self.load_data_and_diffs()
-            self.full_to_protobuf_zlib()
-            self.all_diff_to_protobuf_zlib()
+            tmp_timestamp_placeholder = self.current_timestamp
+            with metrics.stage("fetch_all") as stage:
+                asyncio.get_event_loop().run_until_complete(self.fetch_all())
+                stage.bytes_out = sum(
+                    fh.latest_size for fh in self.feed_handlers if fh.result.status == NEW_FEED
+                )
+            with metrics.stage("merge_feeds") as stage:
+                self.merge_feeds()
+                stage.bytes_in = sum(fh.latest_size for fh in self.feed_handlers)
+            with metrics.stage("load_static"):
+                self.load_static()
+            with metrics.stage("parse"):
+                self.parse()
+            metrics.ENTITIES.observe(value=sum(len(feed.entity) for feed in self.feeds))
+            self.publish(tmp_data_placeholder, tmp_timestamp_placeholder)
 
-            # trim the in-memory data stores so we don't get a memory leak!
-            # they are each trimmed to only the u.REALTIME_DATA_DICT_CAP most recent keys
-            u.trim_dict(self.data_dict)
-            u.trim_dict(self.diff_dict)
-            u.trim_dict(self.diff_dict_zlib)
+        except u.UpdateFailed as err:
+            self.current_data = tmp_data_placeholder
+            u.log.error(err)
+            metrics.CYCLES.inc("failed")
+            if not self.current_data:
+                self.initial_update_failed(err)
+        except leader.LeaseLost as err:
+            # the main loop stands by once it sees the lease is gone
+            self.current_data = tmp_data_placeholder
+            self.current_timestamp = tmp_timestamp_placeholder
+            u.log.error("parser: not publishing: %s", err)
+            metrics.CYCLES.inc("failed")
+
+    def initial_update_failed(self, err: u.UpdateFailed) -> None:
+        """ Retries until there's data to publish, exiting after max_initial_merge_attempts failures
+        """
+        if self.initial_merge_attempts < self.max_initial_merge_attempts:
+            time.sleep(5)
+            self.initial_merge_attempts += 1
+            self.update()
+        else:
+            u.log.error(
+                "parser: Couldn't get all feeds, exiting after %s attempts.\n%s", self.max_initial_merge_attempts, err,
+            )
+            sys.exit(1)
 
-            self.redis_handler.realtime_push(
-                current_timestamp=self.current_timestamp,
-                data_full=self.current_data_zlib,
-                data_diffs=self.diff_dict_zlib,
+    def publish(self, tmp_data_placeholder: u.RealtimeData, tmp_timestamp_placeholder: Timestamp) -> None:
+        """ Diffs, encodes & pushes the freshly parsed self.current_data, or sends a heartbeat if it's
+        unchanged. The placeholders are the previously published data & timestamp.
+        With a lease, raises leader.LeaseLost before writing anything if this replica isn't the leader anymore.
+        """
+        if self.lease is not None:
+            self.lease.check()
+        metrics.TRIPS.observe(value=len(self.current_data.trips))
+
+        with metrics.stage("fingerprint"):
+            fingerprint = self.fingerprint()
+        if fingerprint == self.current_fingerprint:
+            # nothing changed, so keep the previous snapshot and skip the encode & compress stages
+            heartbeat_timestamp = self.current_timestamp
+            self.current_data, self.current_timestamp = (
+                tmp_data_placeholder,
+                tmp_timestamp_placeholder,
             )
+            u.log.info("parser: realtime data unchanged, sending heartbeat")
+            self.redis_handler.realtime_heartbeat(heartbeat_timestamp)
+            if self.fanout is not None:
+                self.fanout.publish_heartbeat(heartbeat_timestamp)
+            metrics.CYCLES.inc("heartbeat")
+            return
+        self.current_fingerprint = fingerprint
 
-        except u.UpdateFailed as err:
+        with metrics.stage("load_data_and_diffs"):
+            self.load_data_and_diffs()
+        with metrics.stage("full_to_protobuf_zlib") as stage:
+            self.full_to_protobuf_zlib()
+            stage.bytes_in, stage.bytes_out = self.current_data_size, len(self.current_data_zlib)
+        with metrics.stage("all_diff_to_protobuf_zlib") as stage:
+            self.all_diff_to_protobuf_zlib()
+            data_diffs = self.snapshots.diffs_zlib()
+            stage.bytes_out = sum(len(diff) for diff in data_diffs.values())
+        if u.REALTIME_STREAM:
+            stream_diff = self.lazy_diff(tmp_timestamp_placeholder)
+
+        with metrics.stage("realtime_push") as stage:
+            self.push(data_diffs)
+            if u.REALTIME_STREAM:
+                self.redis_handler.realtime_stream_append(
+                    current_timestamp=self.current_timestamp,
+                    prev_timestamp=tmp_timestamp_placeholder,
+                    data_diff=stream_diff,
+                )
+            stage.bytes_out = len(self.current_data_zlib) + sum(len(diff) for diff in data_diffs.values())
+        if self.boards is not None:
+            with metrics.stage("boards") as stage:
+                stage.bytes_out = self.push_boards(tmp_data_placeholder)
+        if self.sharder is not None:
+            with metrics.stage("shards") as stage:
+                stage.bytes_out = self.push_shards()
+        if self.planner is not None:
+            with metrics.stage("planner"):
+                self.planner.update(
+                    tmp_data_placeholder,
+                    self.current_data,
+                    self.diff_from(tmp_data_placeholder, self.planner.timestamp),
+                )
+        metrics.CYCLES.inc("published")
+
+        self.cycles_since_checkpoint += 1
+        if u.REALTIME_CHECKPOINT_EVERY and self.cycles_since_checkpoint >= u.REALTIME_CHECKPOINT_EVERY:
+            with metrics.stage("checkpoint"):
+                self.write_checkpoint()
+            self.cycles_since_checkpoint = 0
+
+    def diff_from(self, prev_data: Optional[u.RealtimeData], index_timestamp: int) -> Optional[u.DataDiff]:
+        """ The diff from the previously published data to the current data, for an index (the boards, the
+        planner) last updated at index_timestamp: the precomputed one if there is one, or else computed if the
+        index reflects prev_data
+        """
+        if prev_data is None or prev_data.realtime_timestamp == self.current_timestamp:
+            return None
+        data_diff = self.snapshots.diffs().get(Timestamp(prev_data.realtime_timestamp))
+        if data_diff is None and prev_data.realtime_timestamp == index_timestamp:
+            data_diff = self.diff(old_data=prev_data, new_data=self.current_data)
+        return data_diff
+
+    def push_boards(self, prev_data: Optional[u.RealtimeData]) -> int:
+        """ Updates the station boards from the previously published data to the current data, and pushes the
+        ones that changed. Returns the bytes pushed.
+        """
+        changed = self.boards.update(prev_data, self.current_data, self.diff_from(prev_data, self.boards.timestamp))
+
+        trips = self.current_data.trips
+        encoded = {
+            station: self.codec.encode(self.boards.encode(station, trips, u.REALTIME_BOARD_DEPTH))
+            for station in changed
+            if station in self.boards
+        }
+        removed = [station for station in changed if station not in self.boards]
+        self.redis_handler.boards_push(self.current_timestamp, encoded, removed)
+        return sum(len(blob) for blob in encoded.values())
+
+    def push_shards(self) -> int:
+        """ Encodes & pushes the shards (see shards.py) whose trips changed since they were last pushed, with diffs
+        from their own recent publishes. Returns the bytes pushed.
+        """
+        sharder = self.sharder
+        current = sharder.partition(self.current_data)
+
+        payloads: Dict[str, Tuple[bytes, Dict[Timestamp, bytes]]] = {}
+        for shard in sharder.changed(current):
+            trips = current.get(shard, {})
+            new_data = shards.shard_data(self.current_data, trips)
+            data_diffs = {}
+            for timestamp, old_trips in sharder.baselines_of(shard, self.current_timestamp):
+                old_data = shards.shard_data(self.current_data, old_trips)
+                data_diffs[timestamp] = self.diff_to_protobuf_zlib(self.diff(old_data=old_data, new_data=new_data))
+            payloads[shard] = (self.codec.encode(self.full_to_protobuf(new_data)), data_diffs)
+
+        if self.current_data.static_timestamp != sharder.static_timestamp:
+            static_full = self.full_to_protobuf(shards.static_data(self.current_data))
+            payloads[shards.STATIC_SHARD] = (self.codec.encode(static_full), {})
+
+        self.redis_handler.shards_push(self.current_timestamp, payloads)
+        for shard in payloads:
+            if shard != shards.STATIC_SHARD:
+                sharder.record(shard, self.current_timestamp, current.get(shard, {}))
+        sharder.static_timestamp = self.current_data.static_timestamp
+        return sum(len(full) + sum(len(diff) for diff in diffs.values()) for full, diffs in payloads.values())
+
+    async def run_streaming(self) -> None:
+        """ Fetches each feed on its own schedule and parses it as soon as it arrives, publishing
+        REALTIME_COALESCE_WINDOW seconds after the first feed that changed since the last publish,
+        so a slow feed doesn't hold back the others. Runs until cancelled.
+        """
+        loop = asyncio.get_event_loop()
+        # publishing & answering diff & plan requests share this single thread, so they never overlap
+        self.publish_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        fetch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(self.feed_handlers))
+        self.feeds_changed = asyncio.Event()
+
+        if self.restored_feeds:
+            self.parse_restored_feeds()
+        await loop.run_in_executor(self.publish_executor, self.load_static)
+        self.stationhash_lookup = self.current_data.stationhash_lookup
+        for fh in self.feed_handlers:
+            self.feed_trips[fh.id_] = self.parse_feed(fh.latest_feed) if fh.latest_feed else {}
+        self.feeds_changed.set()
+
+        tasks = [asyncio.ensure_future(self.stream_feed(fh, fetch_executor)) for fh in self.feed_handlers]
+        tasks.append(asyncio.ensure_future(self.stream_publish()))
+        if u.REALTIME_LAZY_DIFFS:
+            tasks.append(asyncio.ensure_future(self.stream_diff_requests()))
+        if u.REALTIME_PLANNER:
+            tasks.append(asyncio.ensure_future(self.stream_plan_requests()))
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            fetch_executor.shutdown(wait=False)
+            self.publish_executor.shutdown(wait=False)
+
+    def parse_feed(self, feed_message: FeedMessage) -> Dict[u.TripHash, u.Trip]:
+        trips: Dict[u.TripHash, u.Trip] = {}
+        self.parse_entities(feed_message.entity, trips, self.stationhash_lookup)
+        return trips
+
+    async def stream_feed(
+        self, fh: RealtimeFeedHandler, executor: concurrent.futures.ThreadPoolExecutor
+    ) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            started = self.clock()
+            await fh.fetch(thread_pool_excecutor=executor)
+            if fh.result.status == NEW_FEED:
+                with metrics.stage("parse_feed") as stage:
+                    self.feed_trips[fh.id_] = await loop.run_in_executor(executor, self.parse_feed, fh.latest_feed)
+                    stage.bytes_in = fh.latest_size
+                self.feeds_changed.set()
+            elif fh.result.status not in (OLD_FEED, BREAKER_OPEN):
+                u.log.error("parser: Encountered %s when fetching feed %s", fh.result.error, fh.id_)
+
+            if u.REALTIME_ADAPTIVE:
+                fh.schedule(self.clock())
+                next_fetch_time = max(fh.next_fetch_time, started + u.REALTIME_MIN_FREQ)
+            else:
+                next_fetch_time = started + u.REALTIME_FREQ
+            await asyncio.sleep(max(0.0, next_fetch_time - self.clock()))
+
+    async def stream_publish(self) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            await self.feeds_changed.wait()
+            await asyncio.sleep(u.REALTIME_COALESCE_WINDOW)
+            self.feeds_changed.clear()
+            await loop.run_in_executor(self.publish_executor, self.publish_streamed)
+
+    def publish_streamed(self) -> None:
+        """ Publishes the static data plus every feed's most recently parsed trips
+        """
+        tmp_data_placeholder = self.current_data
+        tmp_timestamp_placeholder = self.current_timestamp
+        try:
+            with metrics.stage("load_static"):
+                self.load_static()
+            self.stationhash_lookup = self.current_data.stationhash_lookup
+            for trips in list(self.feed_trips.values()):
+                self.current_data.trips.update(self.expire_trips(trips))
+            self.publish(tmp_data_placeholder, tmp_timestamp_placeholder)
+        except (u.UpdateFailed, leader.LeaseLost) as err:
             self.current_data = tmp_data_placeholder
+            self.current_timestamp = tmp_timestamp_placeholder
             u.log.error(err)
-            if not self.current_data:
-                if self.initial_merge_attempts < self.max_initial_merge_attempts:
-                    time.sleep(5)
-                    self.initial_merge_attempts += 1
-                    self.update()
-                else:
-                    u.log.error(
-                        "parser: Couldn't get all feeds, exiting after %s attempts.\n%s",
-                        self.max_initial_merge_attempts,
-                        err,
-                    )
-                    exit()
+            metrics.CYCLES.inc("failed")
+        self.redis_handler.metrics_push()
+
+    def expire_trips(self, trips: Dict[u.TripHash, u.Trip]) -> Dict[u.TripHash, u.Trip]:
+        """ trips, parsed from a feed that may not have changed since, as parse_entities would parse them now:
+        without the arrivals that have passed, and STOPPED if their vehicle's last update is too old. The trips
+        that change are copied, since published snapshots share them.
+        """
+        now = self.clock()
+        expired = {}
+        for trip_hash, trip in trips.items():
+            if any(arrival_time < now for arrival_time in trip.arrivals.values()):
+                arrivals = {station: t for station, t in trip.arrivals.items() if t >= now}
+                trip = replace(trip, arrivals=arrivals)
+            if trip.timestamp is not None and trip.status != u.STOPPED and now - trip.timestamp > STALE_VEHICLE_AGE:
+                trip = replace(trip, status=u.STOPPED)
+            expired[trip_hash] = trip
+        return expired
+
+    async def stream_diff_requests(self) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            # the blocking BLPOP runs on the default executor; the diffs are built on the publish thread
+            from_timestamps = await loop.run_in_executor(None, self.pop_diff_requests, 1)
+            if from_timestamps:
+                await loop.run_in_executor(self.publish_executor, self.answer_diff_requests, from_timestamps)
+
+    async def stream_plan_requests(self) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            # like diff requests: popped on the default executor, answered on the publish thread, between updates
+            raw_requests = await loop.run_in_executor(None, self.pop_plan_requests, 1)
+            if raw_requests:
+                await loop.run_in_executor(self.publish_executor, self.answer_plan_requests, raw_requests)
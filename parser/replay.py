@@ -0,0 +1,239 @@
+""" Replays recorded raw realtime feeds through RealtimeManager offline -- with a fake clock and
+fake_redis instead of the MTA & Redis -- as fast as possible, reporting each cycle's timings and
+a hash of its output, so optimizations can be checked for byte-identical results.
+
+The feeds directory holds one file per feed per cycle, named <timestamp><feed_id>.pb, e.g.
+1563000000.pb (feed id '') and 1563000000-ace.pb. A feed without a file in a cycle is treated
+as unchanged. The static zip is a GTFS zip that also contains stations.csv & stationcomplexes.csv.
+
+Usage:
+    python replay.py run FEEDS_DIR STATIC_ZIP [--report REPORT.json] [--compare BASELINE.json]
+    python replay.py record FEEDS_DIR    # records the running parser's realtime:feeds hash
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+import redis
+from google.transit.gtfs_realtime_pb2 import FeedMessage  # type: ignore
+from google.protobuf.message import DecodeError
+import codec  # type: ignore
+import fake_redis  # type: ignore
+import main  # type: ignore
+import metrics  # type: ignore
+import realtime  # type: ignore
+import static  # type: ignore
+import util as u  # type: ignore
+
+FEED_FILE_RE = re.compile(r"^(\d+)(.*)\.pb$")
+
+Cycle = Tuple[int, Dict[str, bytes]]  # (timestamp, {feed_id: raw feed})
+
+
+class CycleReport(NamedTuple):
+    timestamp: int
+    result: str  # published, heartbeat, or failed
+    seconds: float
+    stages: Dict[str, float]
+    full_hash: str
+    diffs_hash: str
+
+
+class FakeClock:
+    def __init__(self, now: float = 0) -> None:
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class ReplayFeedHandler(realtime.RealtimeFeedHandler):
+    """ 'Fetches' the recorded feed set for the current cycle instead of downloading it
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.recorded: Optional[bytes] = None
+
+    async def fetch(self, thread_pool_excecutor) -> None:
+        if self.recorded is None:
+            self.result = realtime.FetchResult(realtime.OLD_FEED)
+            return
+
+        feed_message = FeedMessage()
+        try:
+            feed_message.ParseFromString(self.recorded)
+            self.handle_feed(self.recorded, feed_message)
+        except (DecodeError, SystemError) as err:
+            self.result = realtime.FetchResult(realtime.DECODE_FAILED, error=err)
+        self.recorded = None
+
+
+class ReplayManager(realtime.RealtimeManager):
+    feed_handler_class = ReplayFeedHandler
+
+    def initial_update_failed(self, err: u.UpdateFailed) -> None:
+        """ Doesn't sleep, retry or exit: the cycle is reported as failed and the replay carries on
+        """
+
+
+def load_cycles(feeds_dir: str) -> List[Cycle]:
+    cycles: Dict[int, Dict[str, bytes]] = {}
+    for fname in os.listdir(feeds_dir):
+        match = FEED_FILE_RE.match(fname)
+        if not match:
+            continue
+        timestamp, feed_id = int(match.group(1)), match.group(2)
+        with open(os.path.join(feeds_dir, fname), "rb") as in_stream:
+            cycles.setdefault(timestamp, {})[feed_id] = in_stream.read()
+    return sorted(cycles.items())
+
+
+def output_hashes(redis_server: fake_redis.FakeRedis) -> Tuple[str, str]:
+    """ Hashes the uncompressed published payloads, so codec changes don't change the hashes
+    """
+    data_full = redis_server.get("realtime:data_full")
+    full_hash = hashlib.sha256(codec.decode(data_full) if data_full else b"").hexdigest()
+
+    diffs_hash = hashlib.sha256()
+    for timestamp, data_diff in sorted(redis_server.hgetall("realtime:data_diffs").items()):
+        diffs_hash.update(timestamp + b":" + codec.decode(data_diff))
+    return full_hash, diffs_hash.hexdigest()
+
+
+def cycle_result(redis_server: fake_redis.FakeRedis, published_before: int) -> str:
+    for channel, message in redis_server.published[published_before:]:
+        if channel == b"realtime_updates" and message == b"new_data":
+            return "published"
+        if channel == b"realtime_updates" and message.startswith(b"heartbeat:"):
+            return "heartbeat"
+    return "failed"
+
+
+def set_up(static_zip: str, clock: FakeClock) -> Tuple[ReplayManager, fake_redis.FakeRedis]:
+    """ Parses the static zip into a fresh fake_redis and returns a ReplayManager using it
+    """
+    redis_server = fake_redis.FakeRedis()
+    static.StaticHandler(redis_server, clock=clock).update(zip_path=static_zip)
+    if not redis_server.exists("static:json_full"):
+        raise SystemExit(f"could not parse static data from {static_zip}")
+    return ReplayManager(main.RedisHandler(redis_server), clock=clock), redis_server
+
+
+def run_cycle(manager: ReplayManager, clock: FakeClock, cycle: Cycle) -> CycleReport:
+    redis_server = manager.redis_server
+    timestamp, feeds = cycle
+    clock.now = timestamp
+    for fh in manager.feed_handlers:
+        fh.recorded = feeds.get(fh.id_)
+
+    metrics.STAGE_DURATION.last.clear()
+    published_before = len(redis_server.published)
+    start = time.perf_counter()
+    manager.update()
+    seconds = time.perf_counter() - start
+
+    full_hash, diffs_hash = output_hashes(redis_server)
+    return CycleReport(
+        timestamp=timestamp,
+        result=cycle_result(redis_server, published_before),
+        seconds=seconds,
+        stages={stage: d for (stage,), d in metrics.STAGE_DURATION.last.items()},
+        full_hash=full_hash,
+        diffs_hash=diffs_hash,
+    )
+
+
+def replay(feeds_dir: str, static_zip: str) -> List[CycleReport]:
+    cycles = load_cycles(feeds_dir)
+    if not cycles:
+        raise SystemExit(f"no recorded feeds found in {feeds_dir}")
+
+    clock = FakeClock(cycles[0][0])
+    manager, _ = set_up(static_zip, clock)
+    return [run_cycle(manager, clock, cycle) for cycle in cycles]
+
+
+def compare(reports: List[CycleReport], baseline_path: str) -> int:
+    """ Prints the cycles whose output differs from the baseline report's; returns how many did
+    """
+    with open(baseline_path) as in_stream:
+        baseline = {r["timestamp"]: r for r in json.load(in_stream)}
+
+    mismatches = 0
+    for report in reports:
+        expected = baseline.get(report.timestamp)
+        if expected is None:
+            print(f"{report.timestamp}: not in baseline")
+            mismatches += 1
+        elif (expected["full_hash"], expected["diffs_hash"]) != (report.full_hash, report.diffs_hash):
+            print(f"{report.timestamp}: output differs from baseline")
+            mismatches += 1
+    return mismatches
+
+
+def record(feeds_dir: str) -> None:
+    """ Writes the running parser's feeds to feeds_dir whenever they change
+    """
+    os.makedirs(feeds_dir, exist_ok=True)
+    redis_server = redis.Redis(host=u.REDIS_HOSTNAME, port=u.REDIS_PORT, db=0)
+    latest: Dict[bytes, int] = {}
+    while True:
+        now = int(time.time())
+        for feed_id, raw in redis_server.hgetall("realtime:feeds").items():
+            feed_message = FeedMessage()
+            feed_message.ParseFromString(raw)
+            if feed_message.header.timestamp != latest.get(feed_id):
+                latest[feed_id] = feed_message.header.timestamp
+                with open(os.path.join(feeds_dir, f"{now}{feed_id.decode()}.pb"), "wb") as out_stream:
+                    out_stream.write(raw)
+        time.sleep(1)
+
+
+def main_() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command")
+    run_parser = subparsers.add_parser("run")
+    run_parser.add_argument("feeds_dir")
+    run_parser.add_argument("static_zip")
+    run_parser.add_argument("--report", help="write the per-cycle report to this JSON file")
+    run_parser.add_argument("--compare", help="check output hashes against this report")
+    record_parser = subparsers.add_parser("record")
+    record_parser.add_argument("feeds_dir")
+    args = parser.parse_args()
+
+    if args.command == "record":
+        record(args.feeds_dir)
+        return
+    if args.command != "run":
+        parser.print_help()
+        return
+
+    reports = replay(args.feeds_dir, args.static_zip)
+    for report in reports:
+        slowest = sorted(report.stages.items(), key=lambda kv: -kv[1])[:3]
+        print(
+            f"{report.timestamp}  {report.result:<9}  {report.seconds * 1000:8.1f}ms  "
+            f"full {report.full_hash[:12]}  diffs {report.diffs_hash[:12]}  "
+            + "  ".join(f"{stage} {seconds * 1000:.1f}ms" for stage, seconds in slowest)
+        )
+    total = sum(r.seconds for r in reports)
+    print(f"\n{len(reports)} cycles in {total:.2f}s ({total / len(reports) * 1000:.1f}ms per cycle)")
+
+    if args.report:
+        with open(args.report, "w") as out_stream:
+            json.dump([r._asdict() for r in reports], out_stream, indent=1)
+    failed = sum(report.result == "failed" for report in reports)
+    if failed:
+        print(f"{failed} cycles failed")
+    mismatches = compare(reports, args.compare) if args.compare else 0
+    if failed or mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_()
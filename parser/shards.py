@@ -0,0 +1,106 @@
+""" The optional sharded payloads (REALTIME_SHARDS): besides the whole-system payload, the trips of each route (and
+optionally each borough) are published on their own, so a client showing one line only downloads that line.
+
+Each shard is named KIND:KEY, e.g. route:2116459744 (a RouteHash) or borough:Manhattan; a trip is in the shard of
+its branch's route, and in the shard of every borough it has arrivals in. A shard's payloads are the usual DataFull
+(with only the shard's trips, none of the static data) and DataUpdates, under their own keys & channel:
+    realtime:shard:SHARD:current_timestamp, realtime:shard:SHARD:data_full, realtime:shard:SHARD:data_diffs
+    and 'new_data' on realtime_updates:SHARD
+The static data is the static shard (realtime:shard:static:data_full), a DataFull without trips, published when it
+changes. The realtime:shards hash maps each shard to the timestamp it was last published at. A shard is only
+published in the cycles its trips changed, so its diffs are from its own previous publishes (DIFF_BASELINES of
+them back), the timestamps a client following it has, rather than the whole-system payload's.
+"""
+from collections import deque
+from typing import Deque, Dict, Iterator, List, Mapping, Optional, Tuple
+import util as u  # type: ignore
+
+KINDS = ["route", "borough"]
+STATIC_SHARD = "static"
+
+Trips = Dict[u.TripHash, u.Trip]
+Partition = Dict[str, Trips]  # each shard's trips, by shard name
+
+
+class Sharder:
+    def __init__(self, kinds: List[str], baselines: List[int] = u.DIFF_BASELINES) -> None:
+        unknown = set(kinds) - set(KINDS)
+        if unknown:
+            raise ValueError(f"unknown shard kinds: {', '.join(sorted(unknown))}")
+        self.kinds = kinds
+        self.baselines = baselines
+        # each shard's last max(baselines) + 1 publishes, as (timestamp, trips), oldest first
+        self.published: Dict[str, Deque[Tuple[int, Trips]]] = {}
+        self.static_timestamp = -1  # of the static shard last published
+
+    def shards_of(self, trip: u.Trip, stations: Mapping[u.StationHash, u.Station]) -> Iterator[str]:
+        if "route" in self.kinds:
+            yield f"route:{trip.branch.route}"
+        if "borough" in self.kinds:
+            boroughs = {stations[s].borough for s in trip.arrivals if s in stations}
+            for borough in sorted(boroughs):
+                if borough:
+                    yield f"borough:{borough}"
+
+    def partition(self, data: u.RealtimeData) -> Partition:
+        """ data's trips by shard
+        """
+        partition: Partition = {}
+        for trip_hash, trip in data.trips.items():
+            for shard in self.shards_of(trip, data.stations):
+                partition.setdefault(shard, {})[trip_hash] = trip
+        return partition
+
+    def changed(self, partition: Partition) -> List[str]:
+        """ The shards whose trips in partition differ from what they were last published with, including those
+        that were published with trips & have none now
+        """
+        return [
+            shard for shard in sorted(set(partition) | set(self.published))
+            if self.last_published(shard) != partition.get(shard, {})
+        ]
+
+    def last_published(self, shard: str) -> Optional[Trips]:
+        history = self.published.get(shard)
+        return history[-1][1] if history else None
+
+    def baselines_of(self, shard: str, timestamp: int) -> List[Tuple[int, Trips]]:
+        """ The publishes of shard that are baselines for its publish at timestamp, oldest first
+        """
+        history = [(t, trips) for t, trips in self.published.get(shard, ()) if t != timestamp]
+        return [history[-n] for n in reversed(self.baselines) if n <= len(history)]
+
+    def record(self, shard: str, timestamp: int, trips: Trips) -> None:
+        """ Remembers that shard was published with trips at timestamp
+        """
+        history = self.published.setdefault(shard, deque(maxlen=max(self.baselines, default=0) + 1))
+        if history and history[-1][0] == timestamp:
+            history.pop()  # published twice in the same second
+        history.append((timestamp, trips))
+
+
+def shard_data(data: u.RealtimeData, trips: Dict[u.TripHash, u.Trip]) -> u.RealtimeData:
+    """ A RealtimeData holding only trips, to encode or diff a shard with
+    """
+    return u.RealtimeData(
+        name=data.name,
+        static_timestamp=data.static_timestamp,
+        realtime_timestamp=data.realtime_timestamp,
+        trips=trips,
+    )
+
+
+def static_data(data: u.RealtimeData) -> u.RealtimeData:
+    """ data without its trips, for the static shard
+    """
+    return u.RealtimeData(
+        name=data.name,
+        static_timestamp=data.static_timestamp,
+        routes=data.routes,
+        stations=data.stations,
+        station_complexes=data.station_complexes,
+        routehash_lookup=data.routehash_lookup,
+        stationhash_lookup=data.stationhash_lookup,
+        transfers=data.transfers,
+        realtime_timestamp=data.realtime_timestamp,
+    )
@@ -0,0 +1,171 @@
+""" The optional shared-memory output (REALTIME_SHM_PATH): the latest full payload & diffs in a memory-mapped
+file, for readers on the same host that shouldn't have to copy them out of Redis.
+
+The file starts with a header, followed by a directory of (from_timestamp, offset, length) entries -- the full
+payload first, with from_timestamp 0, then a diff from each baseline -- and the payloads themselves. The
+payloads are the ones pushed to Redis, codec header included (see codec.py).
+
+Writes are guarded by a seqlock: the writer makes the header's sequence number odd before it changes
+anything and even again when it's done, so a reader that sees the same even number before & after reading
+knows its read wasn't torn. Put the file on a tmpfs (e.g. /dev/shm) so it never touches the disk.
+multiprocessing.shared_memory would do too, but needs Python 3.8.
+
+Running this module follows the file:
+    python shm.py [PATH]
+"""
+import mmap
+import os
+import struct
+import sys
+import time
+from typing import Dict, List, NamedTuple, Optional, Union
+import util as u  # type: ignore
+
+MAGIC = b"MTASHM\x00\x00"
+VERSION = 1
+HEADER = struct.Struct("<8sIQQQI")  # magic, version, sequence, timestamp, capacity, entries
+ENTRY = struct.Struct("<QQQ")  # from_timestamp (0 for the full payload), offset, length
+SEQUENCE_OFFSET = 12  # of the sequence number in HEADER
+MIN_CAPACITY = 1 << 22
+
+Payload = Union[bytes, memoryview]
+
+
+class SharedUpdate(NamedTuple):
+    sequence: int
+    timestamp: int
+    data_full: Payload
+    data_diffs: Dict[int, Payload]  # by the timestamp each diff is from
+
+
+class SharedMemorySink:
+    """ Writes the published payloads to the file at path, growing it if they don't fit
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        size = os.fstat(self.fd).st_size
+        if size < HEADER.size:
+            size = MIN_CAPACITY
+            os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+
+        magic, version, sequence, *_ = HEADER.unpack_from(self.map)
+        if (magic, version) != (MAGIC, VERSION) or sequence % 2:
+            sequence = 0
+        # readers may still have the file open, so carry on from its sequence number
+        self.sequence = sequence
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, self.sequence, 0, size, 0)
+
+    def write(self, timestamp: int, data_full: bytes, data_diffs: Dict[int, bytes]) -> None:
+        payloads = [(0, data_full)] + sorted(data_diffs.items())
+        offset = HEADER.size + ENTRY.size * len(payloads)
+        entries = []
+        for from_timestamp, payload in payloads:
+            entries.append((from_timestamp, offset, len(payload)))
+            offset += len(payload)
+
+        self.set_sequence(self.sequence + 1)  # odd: readers retry until it's even again
+        if offset > len(self.map):
+            self.grow(offset)
+        for i, (_, payload) in enumerate(payloads):
+            _, payload_offset, length = entries[i]
+            ENTRY.pack_into(self.map, HEADER.size + ENTRY.size * i, *entries[i])
+            self.map[payload_offset:payload_offset + length] = payload
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, self.sequence, timestamp, len(self.map), len(entries))
+        self.set_sequence(self.sequence + 1)
+
+    def set_sequence(self, sequence: int) -> None:
+        self.sequence = sequence
+        struct.pack_into("<Q", self.map, SEQUENCE_OFFSET, sequence)
+
+    def grow(self, needed: int) -> None:
+        capacity = len(self.map)
+        while capacity < needed:
+            capacity *= 2
+        self.map.close()
+        os.ftruncate(self.fd, capacity)
+        self.map = mmap.mmap(self.fd, capacity)
+        u.log.info("parser: grew %s to %dKB", self.path, capacity // 1024)
+
+    def close(self) -> None:
+        self.map.close()
+        os.close(self.fd)
+
+
+class SharedMemoryReader:
+    """ Reads the latest update from a file written by SharedMemorySink
+    """
+
+    def __init__(self, path: str, max_retries: int = 1000) -> None:
+        self.path = path
+        self.max_retries = max_retries
+        self.map: Optional[mmap.mmap] = None
+
+    def open(self) -> mmap.mmap:
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                pass  # payloads read with copy=False still point into it, so it's closed once they're gone
+        with open(self.path, "rb") as in_stream:
+            self.map = mmap.mmap(in_stream.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.map
+
+    def sequence(self) -> int:
+        return struct.unpack_from("<Q", self.map or self.open(), SEQUENCE_OFFSET)[0]
+
+    def read(self, copy: bool = True) -> Optional[SharedUpdate]:
+        """ Returns the latest update, or None if nothing has been written yet. With copy=False the payloads
+        are memoryviews into the file, which the next write may change: check is_current(update) after
+        using them, and read again if it isn't.
+        """
+        for _ in range(self.max_retries):
+            shared = self.map or self.open()
+            magic, version, sequence, timestamp, capacity, count = HEADER.unpack_from(shared)
+            if (magic, version) != (MAGIC, VERSION):
+                raise ValueError(f"{self.path} isn't a version {VERSION} shared-memory output")
+            if sequence % 2:
+                time.sleep(0)  # mid-write
+                continue
+            if capacity > len(shared):
+                self.open()  # the writer grew the file
+                continue
+            if not count:
+                return None
+
+            payloads: List[Payload] = []
+            from_timestamps = []
+            for i in range(count):
+                from_timestamp, offset, length = ENTRY.unpack_from(shared, HEADER.size + ENTRY.size * i)
+                payload = shared[offset:offset + length] if copy else memoryview(shared)[offset:offset + length]
+                payloads.append(payload)
+                from_timestamps.append(from_timestamp)
+
+            if self.sequence() != sequence:
+                continue  # torn: the writer started while we were reading
+            return SharedUpdate(
+                sequence=sequence,
+                timestamp=timestamp,
+                data_full=payloads[0],
+                data_diffs=dict(zip(from_timestamps[1:], payloads[1:])),
+            )
+        raise TimeoutError(f"couldn't get a consistent read of {self.path}")
+
+    def is_current(self, update: SharedUpdate) -> bool:
+        """ Whether update (read with copy=False) is still intact, i.e. nothing has been written since
+        """
+        return self.sequence() == update.sequence
+
+
+if __name__ == "__main__":
+    reader = SharedMemoryReader(sys.argv[1] if len(sys.argv) > 1 else u.REALTIME_SHM_PATH)
+    last_timestamp = 0
+    while True:
+        update = reader.read()
+        if update and update.timestamp != last_timestamp:
+            diffs = ", ".join(f"{t}: {len(d) / 1024:.1f}KB" for t, d in update.data_diffs.items())
+            print(f"{update.timestamp}  full {len(update.data_full) / 1024:.1f}KB  diffs {diffs or '-'}")
+            last_timestamp = update.timestamp
+        time.sleep(1)
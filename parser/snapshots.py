@@ -0,0 +1,103 @@
+""" The snapshots of the published realtime data that diffs are built from.
+
+SnapshotStore keeps the u.REALTIME_DATA_DICT_CAP most recently published snapshots in time order, in a
+ring buffer: each snapshot holds its data, its diff to the current data (if it's a diff baseline) and
+that diff compressed, so all three are evicted together, oldest first, in O(1). Adding a snapshot
+mirrors it and whatever it evicted to the realtime_data_dict Redis hash in a single pipeline.
+"""
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Dict, Iterator, List, Optional
+import redis
+import util as u  # type: ignore
+
+REDIS_KEY = "realtime_data_dict"
+
+
+@u.slotted
+@dataclass
+class Snapshot:
+    timestamp: int
+    data: u.RealtimeData
+    diff: Optional[u.DataDiff] = None  # from this snapshot to the current data
+    diff_zlib: Optional[bytes] = None  # diff, encoded & compressed
+
+
+class SnapshotStore:
+    def __init__(self, cap: int = u.REALTIME_DATA_DICT_CAP) -> None:
+        self.cap = cap
+        self.snapshots: Deque[Snapshot] = deque()  # oldest first
+        self.by_timestamp: Dict[int, Snapshot] = {}
+
+    def __len__(self) -> int:
+        return len(self.snapshots)
+
+    def __contains__(self, timestamp: int) -> bool:
+        return timestamp in self.by_timestamp
+
+    def __getitem__(self, timestamp: int) -> u.RealtimeData:
+        return self.by_timestamp[timestamp].data
+
+    def __iter__(self) -> Iterator[Snapshot]:
+        return iter(self.snapshots)
+
+    def timestamps(self) -> List[int]:
+        """ The retained snapshots' timestamps, oldest first
+        """
+        return [snapshot.timestamp for snapshot in self.snapshots]
+
+    def add(
+        self, timestamp: int, data: u.RealtimeData, redis_server: Optional[redis.Redis] = None, payload: str = "",
+    ) -> List[int]:
+        """ Adds the snapshot published at timestamp, evicting the oldest ones beyond the cap, and returns
+        the evicted timestamps. With redis_server, also stores payload under timestamp in realtime_data_dict
+        and deletes the evicted timestamps from it, in one pipeline.
+        """
+        if timestamp in self.by_timestamp:
+            # published twice in the same second
+            self.by_timestamp[timestamp].data = data
+        else:
+            snapshot = Snapshot(timestamp=timestamp, data=data)
+            self.by_timestamp[timestamp] = snapshot
+            index = len(self.snapshots)
+            while index and self.snapshots[index - 1].timestamp > timestamp:
+                index -= 1  # only if the clock went backwards
+            self.snapshots.insert(index, snapshot)
+
+        evicted = []
+        while len(self.snapshots) > self.cap:
+            oldest = self.snapshots.popleft()
+            del self.by_timestamp[oldest.timestamp]
+            evicted.append(oldest.timestamp)
+
+        if redis_server is not None:
+            pipe = redis_server.pipeline(transaction=False)
+            pipe.hset(REDIS_KEY, timestamp, payload)
+            if evicted:
+                pipe.hdel(REDIS_KEY, *evicted)
+            pipe.execute()
+        return evicted
+
+    def set_diffs(self, diffs: Dict[int, u.DataDiff]) -> None:
+        """ Replaces every snapshot's diff (and compressed diff) with those in diffs, by snapshot timestamp
+        """
+        for snapshot in self.snapshots:
+            snapshot.diff = diffs.get(snapshot.timestamp)
+            snapshot.diff_zlib = None
+
+    def set_diff_zlib(self, timestamp: int, diff_zlib: bytes) -> None:
+        self.by_timestamp[timestamp].diff_zlib = diff_zlib
+
+    def diff_zlib(self, timestamp: int) -> Optional[bytes]:
+        snapshot = self.by_timestamp.get(timestamp)
+        return snapshot.diff_zlib if snapshot else None
+
+    def diffs(self) -> Dict[int, u.DataDiff]:
+        """ The current diffs by the timestamp of the snapshot they're from, oldest first
+        """
+        return {snapshot.timestamp: snapshot.diff for snapshot in self.snapshots if snapshot.diff is not None}
+
+    def diffs_zlib(self) -> Dict[int, bytes]:
+        return {
+            snapshot.timestamp: snapshot.diff_zlib for snapshot in self.snapshots if snapshot.diff_zlib is not None
+        }
@@ -1,14 +1,17 @@
 """ downloads static GTFS data, checks if it's new, parses it, and stores it
+
+pandas & requests are imported where they're used, since only the daily static parse needs them
+and they're slow to import.
 """
-# import os
+import os
 from contextlib import suppress
+from dataclasses import replace
+from typing import Callable, Optional
 import time
-import requests
 import shutil
 import csv
 import zipfile
 import json
-import pandas as pd
 from redis import ResponseError
 import util as u  # type: ignore
 import middleware  # type: ignore
@@ -17,8 +20,9 @@ import middleware  # type: ignore
 class StaticHandler(object):
     """docstring for StaticHandler
     """
-    def __init__(self, redis_server) -> None:
+    def __init__(self, redis_server, clock: Callable[[], float] = time.time) -> None:
         self.redis_server = redis_server
+        self.clock = clock
         self.current_checksum = None
         self.latest_checksum = None
         self.url: str = u.GTFS_CONF.static_url
@@ -33,6 +37,8 @@ class StaticHandler(object):
         merge_trips_and_stops combines trips, stops, and stop_times to make route_stops_with_names
         load_time_between_stops calculates time b/w each pair of adjacent stops using stop_times
         """
+        import requests
+
         u.log.info('parser: Downloading GTFS static data from %s', self.url)
         try:
             new_data = requests.get(self.url, allow_redirects=True, timeout=10)
@@ -43,6 +49,13 @@ class StaticHandler(object):
         with open(_zipfile, 'wb') as zip_out_stream:
             zip_out_stream.write(new_data.content)
 
+        self.load_zip(_zipfile)
+
+    def load_zip(self, _zipfile: str, download_additional_data: bool = True) -> None:
+        """Checks if the static GTFS zip is different than existing data, unzips it, and generates
+        the additional csv files. If download_additional_data is False, the files from
+        additional_static_urls (e.g. stations.csv) must be in the zip.
+        """
         self.current_checksum = u.checksum(_zipfile)
 
         with suppress(ResponseError):
@@ -60,10 +73,13 @@ class StaticHandler(object):
         except zipfile.BadZipFile as err:
                 raise u.UpdateFailed(err)
 
-        self.get_additional_data()
+        if download_additional_data:
+            self.get_additional_data()
         self.merge_trips_and_stops()
 
     def get_additional_data(self) -> None:
+        import requests
+
         for url in u.GTFS_CONF.additional_static_urls:
             try:
                 data_file = requests.get(url, allow_redirects=True, timeout=10)
@@ -77,13 +93,16 @@ class StaticHandler(object):
     def locate_csv(self, name: str) -> str:
         """Generates the path/filname for the csv given the name & gtfs_settings
         """
-        for url in u.GTFS_CONF.additional_static_urls:
-            shortened_name = url.split('/')[-1].lower()
-            if shortened_name == name + ".csv":
-                return f'{u.STATIC_PATH}/raw/{name}.csv'
+        if self.is_additional_csv(name):
+            return f'{u.STATIC_PATH}/raw/{name}.csv'
 
         return f'{u.STATIC_PATH}/raw/{name}.txt'
 
+    def is_additional_csv(self, name: str) -> bool:
+        """Whether name.csv is one of the agency's additional_static_urls
+        """
+        return any(url.split('/')[-1].lower() == name + ".csv" for url in u.GTFS_CONF.additional_static_urls)
+
     def merge_trips_and_stops(self):
         """Combines trips.csv stops.csv and stop_times.csv into locate_csv('route_stops_with_names')
         Keeps the columns in rswn_columns
@@ -99,6 +118,8 @@ class StaticHandler(object):
             'route_id',
             'stop_sequence'
         ]
+        import pandas as pd
+
         u.log.info("Cross referencing route, stop, and trip information...")
 
         trips_csv = self.locate_csv('trips')
@@ -124,12 +145,13 @@ class StaticHandler(object):
         u.log.info('parser: %s created', rswn_csv)
 
     def load_station_info(self) -> None:
-        """ Loads info for each station
+        """ Loads info for each station: from the GTFS stops, plus the boroughs, direction labels & complexes
+        in the MTA subway's stations.csv & stationcomplexes.csv if the agency has them (other agencies don't)
         """
         with open(self.locate_csv('stops'), mode='r') as stops_file:
             stops_csv_reader = csv.DictReader(stops_file)
             for row in stops_csv_reader:
-                stop_id, parent_station = row['stop_id'], row['parent_station']
+                stop_id, parent_station = row['stop_id'], row.get('parent_station') or ''
                 if parent_station.strip() == '':
                     station_hash = u.short_hash(stop_id, u.StationHash)
                     self.data.stations[station_hash] = u.Station(
@@ -142,6 +164,12 @@ class StaticHandler(object):
                     station_hash = u.short_hash(parent_station, u.StationHash)
                     self.data.stationhash_lookup[stop_id] = station_hash
 
+        if self.is_additional_csv('stations'):
+            self.load_mta_stations()
+        if self.is_additional_csv('stationcomplexes'):
+            self.load_mta_station_complexes()
+
+    def load_mta_stations(self) -> None:
         with open(self.locate_csv('stations'), mode='r') as stations_file:
             stations_csv_reader = csv.DictReader(stations_file)
             for row in stations_csv_reader:
@@ -158,12 +186,12 @@ class StaticHandler(object):
                 else:
                     borough, n_label, s_label = row['Borough'], row['North Direction Label'], row['South Direction Label']
                     borough = middleware.transform_borough(borough)
-                    self.data.stations[station_hash].borough = borough
-                    self.data.stations[station_hash].n_label = n_label
-                    self.data.stations[station_hash].s_label = s_label
+                    station = replace(self.data.stations[station_hash], borough=borough, n_label=n_label, s_label=s_label)
                     if station_complex:
-                        self.data.stations[station_hash].station_complex = station_complex
+                        station = replace(station, station_complex=station_complex)
+                    self.data.stations[station_hash] = station
 
+    def load_mta_station_complexes(self) -> None:
         with open(self.locate_csv('stationcomplexes'), mode='r') as stations_file:
             stations_csv_reader = csv.DictReader(stations_file)
             for row in stations_csv_reader:
@@ -178,11 +206,11 @@ class StaticHandler(object):
             for row in route_csv_reader:
                 route_id = row['route_id']
                 route_id = middleware.transform_route(route_id)
-                route_color = int(row['route_color'].strip() or 'D3D3D3', 16)
-                text_color = int(row['route_text_color'].strip() or '000000', 16)
+                route_color = int((row.get('route_color') or '').strip() or 'D3D3D3', 16)
+                text_color = int((row.get('route_text_color') or '').strip() or '000000', 16)
                 route_hash = u.short_hash(route_id, u.RouteHash)
                 self.data.routes[route_hash] = u.RouteInfo(
-                    desc=row['route_desc'],
+                    desc=row.get('route_desc') or '',
                     color=route_color,
                     text_color=text_color,
                     stations=[])
@@ -200,6 +228,11 @@ class StaticHandler(object):
                     stations.append(station_hash)
 
     def load_transfers(self):
+        """ Loads the min transfer times between stations, if the feed has a transfers.txt (it's optional)
+        """
+        if not os.path.exists(self.locate_csv('transfers')):
+            u.log.info('parser: no transfers in the static data')
+            return
         with open(self.locate_csv('transfers'), mode='r') as transfers_file:
             transfers_csv_reader = csv.DictReader(transfers_file)
             for row in transfers_csv_reader:
@@ -215,7 +248,7 @@ class StaticHandler(object):
         self.load_station_info()
         self.load_route_info()
         self.load_transfers()
-        self.data.static_timestamp = int(time.time())
+        self.data.static_timestamp = int(self.clock())
 
     def serialize(self, attempt=0) -> None:
         """ Stores self.data in JSON format
@@ -228,14 +261,20 @@ class StaticHandler(object):
         u.log.info('parser: Wrote parsed static data JSON to %s', _jsonfile)
 
 
-    def update(self):
+    def update(self, zip_path: Optional[str] = None):
+        """ Downloads & parses the static data, or parses the local zip at zip_path
+        """
         u.log.info('parser: ~~~~~~~~~~ Running STATIC.py ~~~~~~~~~~')
+        u.make_data_dirs()
         try:
             try:
                 self.latest_checksum = self.redis_server.get('static:latest_checksum').decode('utf-8')
             except AttributeError:
                 self.latest_checksum = None
-            self.get_feed()
+            if zip_path:
+                self.load_zip(zip_path, download_additional_data=False)
+            else:
+                self.get_feed()
             self.parse()
             self.serialize()
             # TODO!!! improve with piping:
@@ -0,0 +1,103 @@
+""" The optional Redis Streams output (REALTIME_STREAM): a durable, ordered log of published cycles.
+
+Each entry holds a cycle's timestamp, the timestamp of the cycle before it, and the compressed diff
+between the two. A consumer remembers the ID of the last entry it applied and resumes from there with
+XREAD. If the entries it needs were trimmed (see REALTIME_STREAM_MAXLEN), or an entry's prev_timestamp
+isn't the consumer's timestamp, it reloads realtime:data_full and continues from the newest entry.
+
+Running this module tails the stream:
+    python stream.py [LAST_ID]
+"""
+import sys
+from typing import List, NamedTuple, Optional
+import redis
+import util as u  # type: ignore
+
+STREAM_KEY = "realtime:stream"
+
+
+class StreamUpdate(NamedTuple):
+    id_: bytes
+    timestamp: int
+    prev_timestamp: int  # 0 if there is no diff, i.e. the consumer needs the full data
+    data_diff: bytes
+
+
+def append_update(
+    redis_server: redis.Redis, timestamp: int, prev_timestamp: int, data_diff: Optional[bytes]
+) -> bytes:
+    """ Appends a published cycle to the stream, trimming it to about u.REALTIME_STREAM_MAXLEN entries
+    """
+    fields = {
+        "timestamp": timestamp,
+        "prev_timestamp": prev_timestamp if data_diff else 0,
+        "data_diff": data_diff or b"",
+    }
+    return redis_server.xadd(STREAM_KEY, fields, maxlen=u.REALTIME_STREAM_MAXLEN, approximate=True)
+
+
+def read_updates(
+    redis_server: redis.Redis, last_id: bytes = b"0-0", block: Optional[int] = None, count: Optional[int] = None,
+) -> List[StreamUpdate]:
+    """ Returns the updates appended after last_id, waiting up to block ms for one if block is set
+    """
+    response = redis_server.xread({STREAM_KEY: last_id}, count=count, block=block)
+    if not response:
+        return []
+
+    _, entries = response[0]
+    return [
+        StreamUpdate(
+            id_=id_,
+            timestamp=int(fields[b"timestamp"]),
+            prev_timestamp=int(fields[b"prev_timestamp"]),
+            data_diff=fields[b"data_diff"],
+        )
+        for id_, fields in entries
+    ]
+
+
+def has_gap(timestamp: int, update: StreamUpdate) -> bool:
+    """ Whether a consumer at timestamp can't apply update's diff, and has to reload realtime:data_full instead
+    """
+    return bool(timestamp) and update.prev_timestamp != timestamp
+
+
+class StreamConsumer:
+    """ Follows the stream, remembering the ID & timestamp of the last update it returned
+    """
+
+    def __init__(self, redis_server: redis.Redis, last_id: bytes = b"$", timestamp: int = 0) -> None:
+        self.redis_server = redis_server
+        if last_id == b"$":
+            # pin "$" down to the newest entry now, or the entries appended between two polls would be skipped
+            newest = redis_server.xrevrange(STREAM_KEY, count=1)
+            last_id = newest[0][0] if newest else b"0-0"
+        self.last_id = last_id
+        self.timestamp = timestamp
+
+    def poll(self, block: Optional[int] = None) -> List[StreamUpdate]:
+        """ Returns the updates appended since the last poll, in order. It doesn't check them for gaps: the caller
+        does, with has_gap, before applying each one.
+        """
+        updates = read_updates(self.redis_server, self.last_id, block=block)
+        if updates:
+            self.last_id = updates[-1].id_
+            self.timestamp = updates[-1].timestamp
+        return updates
+
+
+if __name__ == "__main__":
+    consumer = StreamConsumer(
+        redis.Redis(host=u.REDIS_HOSTNAME, port=u.REDIS_PORT, db=0),
+        last_id=sys.argv[1].encode() if len(sys.argv) > 1 else b"$",
+    )
+    while True:
+        previous_timestamp = consumer.timestamp
+        for update in consumer.poll(block=int(u.REALTIME_FREQ * 2000)):
+            gap = has_gap(previous_timestamp, update)
+            print(
+                f"{update.id_.decode()}  {update.prev_timestamp} -> {update.timestamp}  "
+                f"{len(update.data_diff) / 1024:.1f}KB{'  (gap: reload full)' if gap else ''}"
+            )
+            previous_timestamp = update.timestamp
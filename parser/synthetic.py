@@ -0,0 +1,257 @@
+""" Generates a synthetic transit system for scale benchmarks: a static GTFS zip (with the
+stations.csv & stationcomplexes.csv that StaticHandler.load_station_info expects) and a matching
+stream of realtime FeedMessages, in the directory layout replay.py reads.
+
+Trip count, stop count and churn are configurable, and --scale multiplies the routes (and so
+the stops) and trips, so benchmarks can sweep from today's load (--scale 1) to agency-scale growth (--scale 20).
+
+Usage:
+    python synthetic.py OUT_DIR [--scale 1] [--routes 25] [--stops-per-route 40] [--trips 500]
+                                [--cycles 40] [--churn 0.05] [--seed 0]
+writes OUT_DIR/static.zip and OUT_DIR/feeds/<timestamp><feed_id>.pb
+"""
+import argparse
+import csv
+import io
+import os
+import random
+import zipfile
+from collections import Counter
+from typing import Dict, Iterator, List, NamedTuple, Tuple
+from google.transit.gtfs_realtime_pb2 import FeedMessage  # type: ignore
+
+FEED_IDS = ["", "-ace", "-bdfm", "-g", "-jz", "-nqrw", "-l", "-7", "-si"]
+START_TIMESTAMP = 1563000000
+CYCLE_SECONDS = 15
+TRAVEL_SECONDS = 90  # between adjacent stops
+TRANSFER_EVERY = 8  # every nth stop of a route is a transfer station shared with the next route
+
+
+class SyntheticConf(NamedTuple):
+    routes: int = 25
+    stops_per_route: int = 40
+    trips: int = 500
+    cycles: int = 40
+    churn: float = 0.05  # fraction of trips replaced by new trips each cycle
+    seed: int = 0
+
+    def scaled(self, scale: float) -> "SyntheticConf":
+        """ Scales the system by adding routes (and so stops) & trips, keeping route length the same
+        """
+        return self._replace(routes=max(1, int(self.routes * scale)), trips=max(1, int(self.trips * scale)))
+
+
+class Route(NamedTuple):
+    id_: str
+    feed_id: str
+    stations: List[str]  # parent stop ids, in northbound order
+
+
+class SyntheticTrip:
+    def __init__(self, id_: str, route: Route, northbound: bool, start: int, delay: int) -> None:
+        self.id_ = id_
+        self.route = route
+        self.northbound = northbound
+        self.start = start  # when the trip leaves its first station
+        self.delay = delay
+
+    def stations(self) -> List[str]:
+        return self.route.stations if self.northbound else self.route.stations[::-1]
+
+    def stop_id(self, station: str) -> str:
+        return station + ("N" if self.northbound else "S")
+
+    def arrivals(self, now: int) -> List[Tuple[str, int]]:
+        """ The (stop_id, arrival time) of each station the trip hasn't reached yet
+        """
+        first_arrival = self.start + self.delay
+        return [
+            (self.stop_id(station), first_arrival + i * TRAVEL_SECONDS)
+            for i, station in enumerate(self.stations())
+            if first_arrival + i * TRAVEL_SECONDS >= now
+        ]
+
+
+def build_routes(conf: SyntheticConf) -> List[Route]:
+    routes = []
+    for r in range(conf.routes):
+        stations = [f"{r:03d}{s:03d}" for s in range(conf.stops_per_route)]
+        if r > 0:
+            # share transfer stations with the previous route
+            prev = routes[-1].stations
+            for s in range(0, conf.stops_per_route, TRANSFER_EVERY):
+                if s < len(prev):
+                    stations[s] = prev[s]
+        routes.append(Route(id_=f"R{r}", feed_id=FEED_IDS[r % len(FEED_IDS)], stations=stations))
+    return routes
+
+
+def _csv(header: List[str], rows: Iterator[List]) -> str:
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator="\n")
+    writer.writerow(header)
+    writer.writerows(rows)
+    return out.getvalue()
+
+
+def write_static_zip(path: str, routes: List[Route], rng: random.Random) -> None:
+    routes_per_station = Counter(s for route in routes for s in set(route.stations))
+    stations = sorted(routes_per_station)
+    transfer_stations = {s for s, count in routes_per_station.items() if count > 1}
+
+    def stops_rows():
+        for s in stations:
+            lat, lon = 40.5 + rng.random() * 0.4, -74.1 + rng.random() * 0.4
+            yield [s, f"Station {s}", lat, lon, ""]
+            yield [s + "N", f"Station {s}", lat, lon, s]
+            yield [s + "S", f"Station {s}", lat, lon, s]
+
+    def stations_rows():
+        for i, s in enumerate(stations):
+            complex_id = f"C{s}" if s in transfer_stations else str(i)
+            yield [str(i), complex_id, s, "Uptown", "Downtown", rng.choice(["M", "Bk", "Q", "Bx", "SI"])]
+
+    def trips_rows():
+        for route in routes:
+            for direction in (0, 1):
+                yield [route.id_, "Weekday", f"{route.id_}_static_{direction}", direction]
+
+    def stop_times_rows():
+        for route in routes:
+            for direction in (0, 1):
+                ordered = route.stations if direction == 0 else route.stations[::-1]
+                for seq, s in enumerate(ordered):
+                    stop_id = s + ("N" if direction == 0 else "S")
+                    yield [f"{route.id_}_static_{direction}", stop_id, seq + 1]
+
+    files = {
+        "stops.txt": _csv(["stop_id", "stop_name", "stop_lat", "stop_lon", "parent_station"], stops_rows()),
+        "routes.txt": _csv(
+            ["route_id", "route_desc", "route_color", "route_text_color"],
+            ([r.id_, f"Route {r.id_}", f"{rng.randrange(0xFFFFFF):06X}", "FFFFFF"] for r in routes),
+        ),
+        "trips.txt": _csv(["route_id", "service_id", "trip_id", "direction_id"], trips_rows()),
+        "stop_times.txt": _csv(["trip_id", "stop_id", "stop_sequence"], stop_times_rows()),
+        "transfers.txt": _csv(
+            ["from_stop_id", "to_stop_id", "transfer_type", "min_transfer_time"],
+            ([s, s, 2, 180] for s in sorted(transfer_stations)),
+        ),
+        "stations.csv": _csv(
+            ["Station ID", "Complex ID", "GTFS Stop ID", "North Direction Label", "South Direction Label", "Borough"],
+            stations_rows(),
+        ),
+        "stationcomplexes.csv": _csv(
+            ["Complex ID", "Complex Name"], ([f"C{s}", f"Complex {s}"] for s in sorted(transfer_stations))
+        ),
+    }
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zip_out:
+        for name, content in files.items():
+            zip_out.writestr(name, content)
+
+
+class FeedGenerator:
+    """ Simulates trips running along the routes, producing each cycle's FeedMessage for every feed
+    """
+
+    def __init__(self, conf: SyntheticConf, routes: List[Route], rng: random.Random) -> None:
+        self.conf = conf
+        self.routes = routes
+        self.rng = rng
+        self.trip_count = 0
+        self.trips: List[SyntheticTrip] = []
+        for _ in range(conf.trips):
+            self.trips.append(self.new_trip(START_TIMESTAMP, started=True))
+
+    def new_trip(self, now: int, started: bool = False) -> SyntheticTrip:
+        self.trip_count += 1
+        route = self.rng.choice(self.routes)
+        duration = len(route.stations) * TRAVEL_SECONDS
+        # trips present at the start are spread along their routes, new ones leave soon
+        start = now - self.rng.randrange(duration) if started else now + self.rng.randrange(600)
+        return SyntheticTrip(
+            id_=f"{self.trip_count:06d}_{route.id_}..{'N' if self.trip_count % 2 else 'S'}",
+            route=route,
+            northbound=bool(self.trip_count % 2),
+            start=start,
+            delay=0,
+        )
+
+    def step(self, now: int) -> None:
+        """ Replaces finished trips & a churn fraction of the others, and delays some trips
+        """
+        for i, trip in enumerate(self.trips):
+            if not trip.arrivals(now) or self.rng.random() < self.conf.churn:
+                self.trips[i] = self.new_trip(now)
+            elif self.rng.random() < 0.2:
+                trip.delay += self.rng.choice([-30, 15, 30, 60])
+
+    def feeds(self, now: int) -> Dict[str, bytes]:
+        messages = {}
+        for feed_id in FEED_IDS:
+            feed_message = FeedMessage()
+            feed_message.header.gtfs_realtime_version = "1.0"
+            feed_message.header.timestamp = now
+            messages[feed_id] = feed_message
+
+        for trip in self.trips:
+            arrivals = trip.arrivals(now)
+            if not arrivals:
+                continue
+            feed_message = messages[trip.route.feed_id]
+            entity = feed_message.entity.add()
+            entity.id = trip.id_
+            entity.trip_update.trip.trip_id = trip.id_
+            entity.trip_update.trip.route_id = trip.route.id_
+            for stop_id, arrival_time in arrivals:
+                stop_time_update = entity.trip_update.stop_time_update.add()
+                stop_time_update.stop_id = stop_id
+                stop_time_update.arrival.time = arrival_time
+                stop_time_update.departure.time = arrival_time + 15
+
+            vehicle = feed_message.entity.add()
+            vehicle.id = trip.id_ + "_vehicle"
+            vehicle.vehicle.trip.trip_id = trip.id_
+            vehicle.vehicle.timestamp = now
+
+        return {feed_id: message.SerializeToString() for feed_id, message in messages.items()}
+
+
+def generate(out_dir: str, conf: SyntheticConf) -> Tuple[str, str]:
+    """ Writes the static zip & feeds, returning (static zip path, feeds dir)
+    """
+    rng = random.Random(conf.seed)
+    routes = build_routes(conf)
+
+    os.makedirs(out_dir, exist_ok=True)
+    static_zip = os.path.join(out_dir, "static.zip")
+    write_static_zip(static_zip, routes, rng)
+
+    feeds_dir = os.path.join(out_dir, "feeds")
+    os.makedirs(feeds_dir, exist_ok=True)
+    generator = FeedGenerator(conf, routes, rng)
+    for cycle in range(conf.cycles):
+        now = START_TIMESTAMP + cycle * CYCLE_SECONDS
+        if cycle:
+            generator.step(now)
+        for feed_id, raw in generator.feeds(now).items():
+            with open(os.path.join(feeds_dir, f"{now}{feed_id}.pb"), "wb") as out_stream:
+                out_stream.write(raw)
+    return static_zip, feeds_dir
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("out_dir")
+    parser.add_argument("--scale", type=float, default=1.0)
+    defaults = SyntheticConf()
+    for field, default in defaults._asdict().items():
+        parser.add_argument(f"--{field.replace('_', '-')}", type=type(default), default=default)
+    args = parser.parse_args()
+
+    conf = SyntheticConf(**{field: getattr(args, field) for field in defaults._fields}).scaled(args.scale)
+    static_zip, feeds_dir = generate(args.out_dir, conf)
+    print(f"wrote {static_zip} and {conf.cycles} cycles of feeds to {feeds_dir} ({conf})")
+
+
+if __name__ == "__main__":
+    main()
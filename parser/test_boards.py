@@ -0,0 +1,99 @@
+""" boards.BoardIndex, updated incrementally from each cycle's diff
+"""
+import asyncio
+import copy
+import pytest  # type: ignore
+import boards  # type: ignore
+import fake_redis  # type: ignore
+import main  # type: ignore
+import realtime  # type: ignore
+import replay  # type: ignore
+import synthetic  # type: ignore
+import util as u  # type: ignore
+
+A, B, C, D, E, F = 1, 2, 3, 4, 5, 6
+
+
+@pytest.fixture
+def current_loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    asyncio.set_event_loop(None)
+    loop.close()
+
+
+def trip(id_, route, arrivals, direction=True, status=u.ON_TIME):
+    final_station = max(arrivals, key=arrivals.get)
+    return u.Trip(id_=id_, branch=u.Branch(route, final_station), direction=direction, arrivals=arrivals, status=status)
+
+
+def data(timestamp, trips):
+    return u.RealtimeData(name="test", realtime_timestamp=timestamp, trips={t.id_: t for t in trips})
+
+
+def diff(old_data, new_data):
+    manager = realtime.RealtimeManager(main.RedisHandler(fake_redis.FakeRedis()))
+    manager.current_data = new_data
+    return manager.diff(old_data, new_data)
+
+
+def built(trips):
+    index = boards.BoardIndex()
+    index.build(trips)
+    return index.boards
+
+
+def test_apply_matches_a_rebuild():
+    old_data = data(100, [
+        trip(7, 1, {A: 100, B: 200}),
+        trip(2, 1, {A: 150, B: 250, C: 350}),
+        trip(3, 2, {B: 120, C: 220}),
+        trip(4, 1, {E: 500}),
+        trip(5, 2, {E: 600}),
+        trip(1, 1, {A: 150}),
+    ])
+    new_data = data(130, [
+        # 7 is gone; 2's arrivals at A & B are later, its C is dropped and D added; 3 moves to route 3 &
+        # is later at C; 4 is delayed; 1 & 5 are unchanged; 6 is new
+        trip(2, 1, {A: 160, B: 260, D: 400}),
+        trip(3, 3, {B: 120, C: 230}),
+        trip(4, 1, {E: 500}, status=u.DELAYED),
+        trip(5, 2, {E: 600}),
+        trip(6, 2, {A: 170, F: 180}, direction=False),
+        trip(1, 1, {A: 150}),
+    ])
+    data_diff = diff(old_data, new_data)
+    assert data_diff.trips.deleted and data_diff.trips.added and data_diff.branch.modified
+    assert data_diff.arrivals.deleted and data_diff.arrivals.added and data_diff.arrivals.modified
+    assert data_diff.status.modified
+
+    index = boards.BoardIndex()
+    index.update(None, old_data, None)
+    changed = index.update(old_data, new_data, data_diff)
+
+    assert index.boards == built(new_data.trips)
+    assert changed == {A, B, C, D, E, F}
+    # 1 & 2 both arrived at A at 150: only 2's arrival moved
+    assert index.next_arrivals(A, direction=True) == [u.StationArrival(150, 1), u.StationArrival(160, 2)]
+
+
+def test_apply_matches_a_rebuild_on_synthetic_cycles(tmp_path, current_loop):
+    static_zip, feeds_dir = synthetic.generate(str(tmp_path), synthetic.SyntheticConf(routes=4, trips=40, cycles=6))
+    cycles = replay.load_cycles(feeds_dir)
+    clock = replay.FakeClock(cycles[0][0])
+    manager, _ = replay.set_up(static_zip, clock)
+
+    index = boards.BoardIndex()
+    prev_data = None
+    for cycle in cycles:
+        replay.run_cycle(manager, clock, cycle)
+        new_data = manager.current_data
+        data_diff = manager.diff(prev_data, new_data) if prev_data is not None else None
+        before = copy.deepcopy(index.boards)
+        changed = index.update(prev_data, new_data, data_diff)
+
+        after = built(new_data.trips)
+        assert index.boards == after
+        assert {s for s in set(before) | set(after) if before.get(s) != after.get(s)} <= changed
+        prev_data = new_data
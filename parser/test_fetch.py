@@ -0,0 +1,270 @@
+""" RealtimeFeedHandler.fetch() against fake_mta.py's faults: errors, truncated & stale feeds, latency, and hedging
+"""
+import asyncio
+import concurrent.futures
+import time
+import aiohttp  # type: ignore
+import pytest  # type: ignore
+import fake_mta  # type: ignore
+import fake_redis  # type: ignore
+import realtime  # type: ignore
+import replay  # type: ignore
+import synthetic  # type: ignore
+
+POLICY = realtime.FetchPolicy(
+    timeout=1.0,
+    max_attempts=3,
+    backoff_base=0.01,
+    backoff_cap=0.02,
+    deadline=3.0,
+    hedge_percentile=0,
+    breaker_failures=2,
+    breaker_cooldown=30,
+)
+
+
+@pytest.fixture(scope="module")
+def cycles(tmp_path_factory):
+    conf = synthetic.SyntheticConf(routes=2, trips=10, cycles=3)
+    _, feeds_dir = synthetic.generate(str(tmp_path_factory.mktemp("fake_mta")), conf)
+    return replay.load_cycles(feeds_dir)
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def run(cycles, scenario, **policy):
+    """ Serves cycles with fake_mta and runs scenario(server, handler) with a handler for their first feed
+    """
+    feed_id = sorted(cycles[0][1])[0]
+    server = fake_mta.FakeMTAServer(cycles)
+
+    async def main():
+        base_url = await server.start()
+        try:
+            handler = realtime.RealtimeFeedHandler(base_url + feed_id, feed_id, fake_redis.FakeRedis())
+            handler.policy = POLICY._replace(**policy)
+            handler.breaker = realtime.CircuitBreaker(
+                handler.policy.breaker_failures, handler.policy.breaker_cooldown, clock=FakeClock()
+            )
+            return await scenario(server, handler)
+        finally:
+            await server.stop()
+
+    return asyncio.run(main())
+
+
+async def fetch(server, handler):
+    """ Fetches once; returns how many requests it made & how long it took
+    """
+    requests_before = sum(server.requests.values())
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        await handler.fetch(thread_pool_excecutor=executor)
+    return sum(server.requests.values()) - requests_before, time.perf_counter() - start
+
+
+def test_clean_feed_is_new(cycles):
+    async def scenario(server, handler):
+        requests, _ = await fetch(server, handler)
+        assert handler.result.status == realtime.NEW_FEED
+        assert requests == 1
+        assert handler.redis_server.hget("realtime:feeds", handler.id_) == server.served[handler.id_]
+        assert handler.breaker.state == realtime.CLOSED
+
+    run(cycles, scenario)
+
+
+def test_errors_are_retried_then_open_the_breaker(cycles):
+    async def scenario(server, handler):
+        server.default_faults = fake_mta.Faults(error_rate=1.0)
+        requests, _ = await fetch(server, handler)
+        assert handler.result.status == realtime.FETCH_FAILED
+        assert requests == POLICY.max_attempts
+        assert handler.breaker.state == realtime.CLOSED
+
+        await fetch(server, handler)
+        assert handler.breaker.state == realtime.OPEN
+
+        # while it's open, the feed isn't requested at all
+        requests, _ = await fetch(server, handler)
+        assert handler.result.status == realtime.BREAKER_OPEN
+        assert requests == 0
+
+    run(cycles, scenario)
+
+
+def test_breaker_closes_after_a_successful_trial_fetch(cycles):
+    async def scenario(server, handler):
+        server.default_faults = fake_mta.Faults(error_rate=1.0)
+        await fetch(server, handler)
+        await fetch(server, handler)
+        assert handler.breaker.state == realtime.OPEN
+
+        server.default_faults = fake_mta.Faults()
+        handler.breaker.clock.now += POLICY.breaker_cooldown
+        requests, _ = await fetch(server, handler)
+        assert requests == 1
+        assert handler.result.status == realtime.NEW_FEED
+        assert handler.breaker.state == realtime.CLOSED
+
+    run(cycles, scenario)
+
+
+def test_failed_trial_fetch_reopens_the_breaker(cycles):
+    async def scenario(server, handler):
+        server.default_faults = fake_mta.Faults(error_rate=1.0)
+        await fetch(server, handler)
+        await fetch(server, handler)
+        handler.breaker.clock.now += POLICY.breaker_cooldown
+        await fetch(server, handler)
+        assert handler.result.status == realtime.FETCH_FAILED
+        assert handler.breaker.state == realtime.OPEN
+
+    run(cycles, scenario)
+
+
+def test_truncated_feed_fails_to_decode(cycles):
+    async def scenario(server, handler):
+        server.default_faults = fake_mta.Faults(truncate_rate=1.0)
+        requests, _ = await fetch(server, handler)
+        assert handler.result.status == realtime.DECODE_FAILED
+        assert requests == POLICY.max_attempts
+        assert handler.latest_feed is None
+        assert handler.redis_server.hget("realtime:feeds", handler.id_) is None
+
+    run(cycles, scenario)
+
+
+def test_stale_feed_is_old(cycles):
+    async def scenario(server, handler):
+        await fetch(server, handler)
+        latest_timestamp = handler.latest_timestamp
+
+        server.advance()
+        server.default_faults = fake_mta.Faults(stale_rate=1.0)
+        requests, _ = await fetch(server, handler)
+        assert handler.result.status == realtime.OLD_FEED
+        assert requests == 1
+        assert handler.latest_timestamp == latest_timestamp
+        assert handler.breaker.state == realtime.CLOSED
+
+        server.default_faults = fake_mta.Faults()
+        await fetch(server, handler)
+        assert handler.result.status == realtime.NEW_FEED
+        assert handler.latest_timestamp > latest_timestamp
+
+    run(cycles, scenario)
+
+
+def test_slow_feed_times_out_within_the_deadline(cycles):
+    async def scenario(server, handler):
+        server.default_faults = fake_mta.Faults(latency=5.0)
+        requests, seconds = await fetch(server, handler)
+        assert handler.result.status == realtime.FETCH_FAILED
+        assert "TIMEOUT" in str(handler.result.error)
+        assert requests == 2  # the deadline leaves room for two 0.3s attempts
+        assert seconds < 0.6 + 0.2
+
+    run(cycles, scenario, timeout=0.3, deadline=0.6)
+
+
+def test_latency_under_the_timeout_succeeds(cycles):
+    async def scenario(server, handler):
+        server.default_faults = fake_mta.Faults(latency=0.1)
+        requests, _ = await fetch(server, handler)
+        assert handler.result.status == realtime.NEW_FEED
+        assert requests == 1
+
+    run(cycles, scenario)
+
+
+def test_no_time_for_an_attempt_fails(cycles):
+    async def scenario(server, handler):
+        handler.policy = POLICY
+        await fetch(server, handler)
+        assert handler.result.status == realtime.NEW_FEED
+
+        handler.policy = POLICY._replace(deadline=0)
+        requests, _ = await fetch(server, handler)
+        assert handler.result.status == realtime.FETCH_FAILED
+        assert requests == 0
+
+    run(cycles, scenario)
+
+
+def hedging(handler, delay=0.05):
+    """ Has handler hedge requests slower than delay
+    """
+    handler.latencies.extend([delay] * realtime.HEDGE_MIN_SAMPLES)
+    assert handler.hedge_delay() == delay
+
+
+async def after_first_request(server, handler, faults):
+    """ Waits for handler's first request to reach server, then changes the faults for the next ones
+    """
+    while not server.requests[handler.id_]:
+        await asyncio.sleep(0.01)
+    server.default_faults = faults
+
+
+def test_fast_hedge_wins(cycles):
+    async def scenario(server, handler):
+        hedging(handler)
+        server.default_faults = fake_mta.Faults(latency=5.0)
+        switch = asyncio.ensure_future(after_first_request(server, handler, fake_mta.Faults()))
+        requests, seconds = await fetch(server, handler)
+        await switch
+        assert handler.result.status == realtime.NEW_FEED
+        assert requests == 2
+        assert seconds < 1.0
+        assert handler.redis_server.hget("realtime:feeds", handler.id_) == server.served[handler.id_]
+
+    run(cycles, scenario, hedge_percentile=50)
+
+
+def test_hedge_raises_the_last_error(cycles):
+    async def scenario(server, handler):
+        hedging(handler)
+        # the first request fails after the hedge, which fails right away
+        server.default_faults = fake_mta.Faults(latency=0.3, error_rate=1.0, error_status=503)
+        switch = asyncio.ensure_future(
+            after_first_request(server, handler, fake_mta.Faults(error_rate=1.0, error_status=500))
+        )
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            with pytest.raises(aiohttp.ClientResponseError) as err:
+                await handler.hedged_request(executor, timeout=1.0)
+        await switch
+        assert err.value.status == 503
+        assert server.requests[handler.id_] == 2
+
+    run(cycles, scenario, hedge_percentile=50)
+
+
+def test_losing_request_is_cancelled(cycles):
+    async def scenario(server, handler):
+        hedging(handler)
+        tasks = []
+        request = handler.request
+
+        async def tracked_request(*args):
+            tasks.append(asyncio.current_task())
+            return await request(*args)
+
+        handler.request = tracked_request
+        server.default_faults = fake_mta.Faults(latency=5.0)
+        switch = asyncio.ensure_future(after_first_request(server, handler, fake_mta.Faults()))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            await handler.hedged_request(executor, timeout=1.0)
+        await switch
+        first, second = tasks
+        await asyncio.wait([first], timeout=1.0)
+        assert first.cancelled()
+        assert second.done() and not second.cancelled()
+
+    run(cycles, scenario, hedge_percentile=50)
@@ -0,0 +1,107 @@
+""" leader.FencedRedis against fake_redis: a deposed leader's writes are dropped
+"""
+import asyncio
+import pytest  # type: ignore
+import fake_redis  # type: ignore
+import leader  # type: ignore
+import main  # type: ignore
+import replay  # type: ignore
+import snapshots  # type: ignore
+import synthetic  # type: ignore
+
+
+def take_lease(redis_server, replica_id):
+    lease = leader.Lease(redis_server, replica_id)
+    assert lease.hold()
+    return lease
+
+
+def depose(redis_server, lease):
+    """ Lets lease lapse and has another replica take it over
+    """
+    redis_server.delete(leader.LEASE_KEY)
+    return take_lease(redis_server, lease.replica_id + "'")
+
+
+def test_leader_writes():
+    redis_server = fake_redis.FakeRedis()
+    fenced = leader.FencedRedis(redis_server, take_lease(redis_server, "a"))
+    fenced.set("realtime:current_timestamp", 100)
+    pipe = fenced.pipeline()
+    pipe.hset("realtime:feeds", "1", b"feed")
+    pipe.publish("realtime_updates", "new_data")
+    pipe.execute()
+
+    assert fenced.get("realtime:current_timestamp") == b"100"
+    assert redis_server.hget("realtime:feeds", "1") == b"feed"
+    assert redis_server.published == [(b"realtime_updates", b"new_data")]
+
+
+def test_deposed_leader_cannot_write():
+    redis_server = fake_redis.FakeRedis()
+    lease = take_lease(redis_server, "a")
+    fenced = leader.FencedRedis(redis_server, lease)
+    depose(redis_server, lease)
+
+    with pytest.raises(leader.LeaseLost):
+        fenced.set("realtime:current_timestamp", 100)
+    assert lease.token is None
+    with pytest.raises(leader.LeaseLost):
+        snapshots.SnapshotStore(3).add(100, None, fenced, "{}")
+    assert redis_server.get("realtime:current_timestamp") is None
+    assert not redis_server.exists(snapshots.REDIS_KEY)
+
+
+def test_leader_deposed_between_check_and_exec(monkeypatch):
+    redis_server = fake_redis.FakeRedis()
+    lease = take_lease(redis_server, "a")
+    fenced = leader.FencedRedis(redis_server, lease)
+    verify = lease.verify
+
+    def verify_then_depose(latest_token):
+        token = verify(latest_token)
+        depose(redis_server, lease)
+        return token
+
+    monkeypatch.setattr(lease, "verify", verify_then_depose)
+    pipe = fenced.pipeline()
+    pipe.set("realtime:current_timestamp", 100)
+    pipe.set("realtime:fencing_token", lease.token)
+    with pytest.raises(leader.LeaseLost):
+        pipe.execute()
+    assert redis_server.get("realtime:current_timestamp") is None
+    assert lease.token is None
+
+
+@pytest.fixture
+def current_loop():
+    """ RealtimeManager.update() runs on the current event loop, which asyncio.run() elsewhere unsets
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    asyncio.set_event_loop(None)
+    loop.close()
+
+
+def test_deposed_manager_publishes_nothing(tmp_path, current_loop):
+    static_zip, feeds_dir = synthetic.generate(str(tmp_path), synthetic.SyntheticConf(routes=2, trips=10, cycles=2))
+    cycles = replay.load_cycles(feeds_dir)
+    clock = replay.FakeClock()
+    _, redis_server = replay.set_up(static_zip, clock)
+    lease = take_lease(redis_server, "a")
+    manager = replay.ReplayManager(main.RedisHandler(leader.FencedRedis(redis_server, lease)), clock=clock)
+    manager.lease = lease
+
+    first = replay.run_cycle(manager, clock, cycles[0])
+    assert first.result == "published"
+    assert redis_server.get("realtime:fencing_token") == str(lease.token).encode("utf-8")
+    written = {key: value for key, value in redis_server.data.items() if key != leader.LEASE_KEY.encode()}
+
+    depose(redis_server, lease)
+    second = replay.run_cycle(manager, clock, cycles[1])
+    assert second.result != "published"
+    assert manager.current_timestamp == first.timestamp
+    assert {key: value for key, value in redis_server.data.items() if key != leader.LEASE_KEY.encode()} == {
+        **written, leader.TOKEN_KEY.encode(): redis_server.get(leader.TOKEN_KEY)
+    }
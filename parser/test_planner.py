@@ -0,0 +1,93 @@
+""" planner.Planner on a hand-built system
+"""
+import fake_redis  # type: ignore
+import main  # type: ignore
+import planner  # type: ignore
+import realtime  # type: ignore
+import util as u  # type: ignore
+
+O, X, Y, D = 1, 2, 3, 4
+
+
+def trip(id_, route, arrivals):
+    final_station = max(arrivals, key=arrivals.get)
+    return u.Trip(id_=id_, branch=u.Branch(route, final_station), direction=True, arrivals=arrivals)
+
+
+def system(timestamp, trips):
+    return u.RealtimeData(
+        name="test",
+        transfers={X: {X: 180}, Y: {X: 60}},
+        realtime_timestamp=timestamp,
+        trips={t.id_: t for t in trips},
+    )
+
+
+def build_planner():
+    """ O -> X by train, with a 180s change time at X, or O -> Y by train & a 60s walk to X; then X -> D
+    """
+    data = system(0, [
+        trip(11, 1, {O: 90, X: 100}),
+        trip(21, 2, {O: 40, Y: 50}),
+        trip(31, 3, {X: 150, D: 200}),
+        trip(32, 3, {X: 1000, D: 1100}),
+    ])
+    index = planner.Planner()
+    index.update(None, data, None)
+    return index, data
+
+
+def patterns_by_station(index):
+    return {
+        station: sorted((p.stations, tuple(p.trips), tuple(p.times), i) for p, i in positions.items())
+        for station, positions in index.patterns_at.items()
+    }
+
+
+def test_walk_beats_an_earlier_train_with_a_long_change():
+    journey = build_planner()[0].plan(O, D, 0)
+
+    assert journey.arrival_time == 200
+    assert journey.legs == [
+        planner.Leg(21, O, 40, Y, 50),
+        planner.Leg(None, Y, 50, X, 110),
+        planner.Leg(31, X, 150, D, 200),
+    ]
+
+
+def test_no_change_time_at_the_destination():
+    journey = build_planner()[0].plan(O, X, 0)
+
+    assert journey.arrival_time == 100
+    assert journey.legs == [planner.Leg(11, O, 90, X, 100)]
+
+
+def test_apply_matches_a_rebuild():
+    index, old_data = build_planner()
+    # 11 is gone, 22 is new, and 32 runs as route 4, so route 1's only pattern goes & route 3's is rebuilt
+    new_data = system(30, [
+        trip(21, 2, {O: 40, Y: 50}),
+        trip(22, 2, {O: 140, Y: 150}),
+        trip(31, 3, {X: 150, D: 200}),
+        trip(32, 4, {X: 1000, D: 1100}),
+    ])
+    manager = realtime.RealtimeManager(main.RedisHandler(fake_redis.FakeRedis()))
+    manager.current_data = new_data
+    data_diff = manager.diff(old_data, new_data)
+    assert data_diff.trips.deleted and data_diff.trips.added and data_diff.branch.modified
+
+    assert index.update(old_data, new_data, data_diff) == 3
+    fresh = planner.Planner()
+    fresh.build(new_data)
+
+    assert patterns_by_station(index) == patterns_by_station(fresh)
+    assert sorted(index.members) == sorted(fresh.members)
+    for origin in (O, X, Y, D):
+        for destination in (O, X, Y, D):
+            for departure in range(0, 1200, 50):
+                assert index.plan(origin, destination, departure) == fresh.plan(origin, destination, departure)
+    assert index.plan(O, D, 100).legs == [
+        planner.Leg(22, O, 140, Y, 150),
+        planner.Leg(None, Y, 150, X, 210),
+        planner.Leg(32, X, 1000, D, 1100),
+    ]
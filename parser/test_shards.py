@@ -0,0 +1,36 @@
+""" shards.Sharder's record of each shard's publishes
+"""
+import shards  # type: ignore
+
+
+def test_changed_shards():
+    sharder = shards.Sharder(["route"], baselines=[1])
+    sharder.record("route:1", 100, {"a": 1})
+    sharder.record("route:2", 100, {"b": 1})
+
+    assert sharder.changed({"route:1": {"a": 1}, "route:2": {"b": 2}, "route:3": {"c": 1}}) == ["route:2", "route:3"]
+    # a shard whose trips are all gone is published once, empty
+    assert sharder.changed({"route:1": {"a": 1}}) == ["route:2"]
+    sharder.record("route:2", 200, {})
+    assert sharder.changed({"route:1": {"a": 1}}) == []
+
+
+def test_baselines_are_the_shards_own_publishes():
+    sharder = shards.Sharder(["route"], baselines=[1, 2, 4])
+    for timestamp in (100, 400, 500, 900, 1000, 1300):
+        sharder.record("route:1", timestamp, {"a": timestamp})
+
+    # the shard skipped the cycles in between, so its baselines are its own last publishes, however long ago
+    assert [t for t, _ in sharder.baselines_of("route:1", 1600)] == [500, 1000, 1300]
+    assert sharder.baselines_of("route:1", 1600)[-1] == (1300, {"a": 1300})
+    assert sharder.baselines_of("route:2", 1600) == []
+
+
+def test_republished_in_the_same_second():
+    sharder = shards.Sharder(["route"], baselines=[1])
+    sharder.record("route:1", 100, {"a": 1})
+    sharder.record("route:1", 200, {"a": 2})
+    sharder.record("route:1", 200, {"a": 3})
+
+    assert sharder.last_published("route:1") == {"a": 3}
+    assert sharder.baselines_of("route:1", 200) == [(100, {"a": 1})]
@@ -0,0 +1,29 @@
+""" StaticHandler on an agency without the MTA subway's extra files
+"""
+import json
+import zipfile
+import fake_redis  # type: ignore
+import static  # type: ignore
+import synthetic  # type: ignore
+import util as u  # type: ignore
+
+SUBWAY_ONLY = ("stations.csv", "stationcomplexes.csv")
+
+
+def test_parses_plain_gtfs(tmp_path, monkeypatch):
+    static_zip, _ = synthetic.generate(str(tmp_path), synthetic.SyntheticConf(routes=2, trips=2, cycles=1))
+    plain_zip = str(tmp_path / "plain.zip")
+    with zipfile.ZipFile(static_zip) as zip_in, zipfile.ZipFile(plain_zip, "w") as zip_out:
+        for name in zip_in.namelist():
+            if name not in SUBWAY_ONLY + ("transfers.txt",):
+                zip_out.writestr(name, zip_in.read(name))
+
+    monkeypatch.setattr(u, "GTFS_CONF", u.GTFS_CONF._replace(name="plain", additional_static_urls=[]))
+    monkeypatch.setattr(u, "STATIC_PATH", str(tmp_path / "static"))
+    redis_server = fake_redis.FakeRedis()
+    static.StaticHandler(redis_server).update(zip_path=plain_zip)
+
+    data = json.loads(redis_server.get("static:json_full"), cls=u.StaticJSONDecoder)
+    assert data.stations and data.routes
+    assert not data.station_complexes and not data.transfers
+    assert all(not station.borough for station in data.stations.values())
@@ -0,0 +1,81 @@
+""" stream.py against fake_redis
+"""
+import fake_redis  # type: ignore
+import stream  # type: ignore
+import util as u  # type: ignore
+
+
+def append(redis_server, timestamp, prev_timestamp, data_diff=b"diff"):
+    return stream.append_update(redis_server, timestamp, prev_timestamp, data_diff)
+
+
+def test_append_update_trims_to_maxlen(monkeypatch):
+    monkeypatch.setattr(u, "REALTIME_STREAM_MAXLEN", 3)
+    redis_server = fake_redis.FakeRedis()
+    for timestamp in range(100, 106):
+        append(redis_server, timestamp, timestamp - 1)
+
+    assert redis_server.xlen(stream.STREAM_KEY) == 3
+    assert [update.timestamp for update in stream.read_updates(redis_server)] == [103, 104, 105]
+
+
+def test_append_update_without_diff_has_no_prev_timestamp():
+    redis_server = fake_redis.FakeRedis()
+    append(redis_server, 100, 99, data_diff=None)
+
+    (update,) = stream.read_updates(redis_server)
+    assert update.prev_timestamp == 0
+    assert update.data_diff == b""
+
+
+def test_read_updates_after_last_id():
+    redis_server = fake_redis.FakeRedis()
+    ids = [append(redis_server, timestamp, timestamp - 1, b"diff %d" % timestamp) for timestamp in range(100, 104)]
+
+    updates = stream.read_updates(redis_server, last_id=ids[1])
+    assert [(u_.id_, u_.timestamp, u_.prev_timestamp, u_.data_diff) for u_ in updates] == [
+        (ids[2], 102, 101, b"diff 102"),
+        (ids[3], 103, 102, b"diff 103"),
+    ]
+    assert stream.read_updates(redis_server, last_id=ids[3]) == []
+    assert len(stream.read_updates(redis_server, last_id=ids[0], count=2)) == 2
+
+
+def test_read_updates_block_times_out():
+    assert stream.read_updates(fake_redis.FakeRedis(), block=10) == []
+
+
+def test_consumer_follows_new_entries_only():
+    redis_server = fake_redis.FakeRedis()
+    append(redis_server, 100, 99)
+    consumer = stream.StreamConsumer(redis_server)  # from "$": only what's appended from now on
+
+    assert consumer.poll() == []
+    append(redis_server, 101, 100)
+    append(redis_server, 102, 101)
+    assert [update.timestamp for update in consumer.poll()] == [101, 102]
+    assert consumer.timestamp == 102
+    assert consumer.poll() == []
+
+
+def test_consumer_resumes_from_last_id():
+    redis_server = fake_redis.FakeRedis()
+    ids = [append(redis_server, timestamp, timestamp - 1) for timestamp in range(100, 103)]
+
+    consumer = stream.StreamConsumer(redis_server, last_id=ids[0], timestamp=100)
+    assert [update.timestamp for update in consumer.poll()] == [101, 102]
+    assert consumer.last_id == ids[2]
+
+
+def test_consumer_reports_gap_after_trimming(monkeypatch):
+    monkeypatch.setattr(u, "REALTIME_STREAM_MAXLEN", 2)
+    redis_server = fake_redis.FakeRedis()
+    first_id = append(redis_server, 100, 99)
+    consumer = stream.StreamConsumer(redis_server, last_id=first_id, timestamp=100)
+    for timestamp in range(101, 105):
+        append(redis_server, timestamp, timestamp - 1)
+
+    updates = consumer.poll()
+    assert [update.timestamp for update in updates] == [103, 104]
+    assert stream.has_gap(100, updates[0])
+    assert not stream.has_gap(103, updates[1])
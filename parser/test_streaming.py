@@ -0,0 +1,53 @@
+""" RealtimeManager.publish_streamed, which publishes each feed's most recently parsed trips
+"""
+import asyncio
+import pytest  # type: ignore
+from google.transit.gtfs_realtime_pb2 import FeedMessage  # type: ignore
+import realtime  # type: ignore
+import replay  # type: ignore
+import synthetic  # type: ignore
+import util as u  # type: ignore
+
+
+@pytest.fixture
+def current_loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    asyncio.set_event_loop(None)
+    loop.close()
+
+
+def parse(manager, feeds, feed_id):
+    feed_message = FeedMessage()
+    feed_message.ParseFromString(feeds[feed_id])
+    return manager.parse_feed(feed_message)
+
+
+def test_unchanged_feed_is_expired(tmp_path, current_loop):
+    static_zip, feeds_dir = synthetic.generate(str(tmp_path), synthetic.SyntheticConf(routes=4, trips=40, cycles=20))
+    cycles = replay.load_cycles(feeds_dir)
+    clock = replay.FakeClock(cycles[0][0])
+    manager, _ = replay.set_up(static_zip, clock)
+    manager.load_static()
+    manager.stationhash_lookup = manager.current_data.stationhash_lookup
+
+    unchanged, changing = sorted(cycles[0][1])[:2]
+    manager.feed_trips = {feed_id: parse(manager, cycles[0][1], feed_id) for feed_id in (unchanged, changing)}
+    manager.publish_streamed()
+    cached = manager.feed_trips[unchanged]
+
+    # only the other feed is parsed again, much later
+    clock.now, feeds = cycles[-1]
+    manager.feed_trips[changing] = parse(manager, feeds, changing)
+    manager.publish_streamed()
+
+    trips = manager.current_data.trips
+    assert manager.current_timestamp == clock.now
+    assert set(cached) <= set(trips)
+    assert all(t >= clock.now for trip in trips.values() for t in trip.arrivals.values())
+    for trip_hash, trip in cached.items():
+        if trip.timestamp is not None and clock.now - trip.timestamp > realtime.STALE_VEHICLE_AGE:
+            assert trips[trip_hash].status == u.STOPPED
+    # the cached trips, shared with the first snapshot, are left as they were
+    assert any(t < clock.now for trip in cached.values() for t in trip.arrivals.values())
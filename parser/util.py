@@ -15,23 +15,15 @@ from typing import (
     Optional,
     Union,
 )
-from collections import defaultdict
-import time
+from collections import defaultdict, OrderedDict
 import json
-import asyncio
 import logging
 import logging.config
-from dataclasses import dataclass, is_dataclass, field
+from dataclasses import dataclass, is_dataclass, field, fields
 import pyhash  # type: ignore
 import hashlib
 import middleware  # type: ignore
 
-loop = asyncio.get_event_loop()
-
-
-os.makedirs("/opt/data/static/parsed", exist_ok=True)
-os.makedirs("/opt/data/realtime/parsed", exist_ok=True)
-
 
 #####################################
 #            CUSTOM TYPES           #
@@ -78,8 +70,89 @@ REALTIME_PATH: str = f"/opt/data/realtime"
 REALTIME_FREQ: Num = to_num(os.environ.get("REALTIME_FREQ", 15))
 REALTIME_TIMEOUT: Num = to_num(os.environ.get("REALTIME_TIMEOUT", 3.2))
 REALTIME_MAX_ATTEMPTS: int = int(os.environ.get("REALTIME_MAX_ATTEMPTS", 3))
+# retries back off exponentially (with jitter) from REALTIME_BACKOFF_BASE up to REALTIME_BACKOFF_CAP seconds,
+# and a feed's attempts all have to fit in REALTIME_FETCH_DEADLINE seconds (set below the REALTIME_FREQ check)
+REALTIME_BACKOFF_BASE: Num = to_num(os.environ.get("REALTIME_BACKOFF_BASE", "0.25"))
+REALTIME_BACKOFF_CAP: Num = to_num(os.environ.get("REALTIME_BACKOFF_CAP", 2))
+# if set (e.g. 95), a second request is sent when the first takes longer than this percentile of the feed's latencies
+REALTIME_HEDGE_PERCENTILE: Num = to_num(os.environ.get("REALTIME_HEDGE_PERCENTILE", 0))
+# a feed that fails this many cycles in a row isn't fetched for REALTIME_BREAKER_COOLDOWN seconds
+REALTIME_BREAKER_FAILURES: int = int(os.environ.get("REALTIME_BREAKER_FAILURES", 5))
+REALTIME_BREAKER_COOLDOWN: Num = to_num(os.environ.get("REALTIME_BREAKER_COOLDOWN", 60))
+# per-feed overrides of the above, as JSON, e.g. {"-si": {"timeout": 5, "hedge_percentile": 0}}
+REALTIME_FETCH_POLICIES: Dict[str, Dict[str, Num]] = json.loads(os.environ.get("REALTIME_FETCH_POLICIES", "{}"))
+# when set, each feed is only fetched just after it's next expected to publish, going by the period between its
+# recent header timestamps, and cycles run when a feed is due (but at most every REALTIME_MIN_FREQ seconds)
+REALTIME_ADAPTIVE: bool = os.environ.get("REALTIME_ADAPTIVE", "false").lower() == "true"
+REALTIME_MIN_FREQ: Num = to_num(os.environ.get("REALTIME_MIN_FREQ", 3))
+REALTIME_PUBLISH_MARGIN: Num = to_num(os.environ.get("REALTIME_PUBLISH_MARGIN", 1))
+# when set, each feed is fetched & parsed on its own, and the data is published REALTIME_COALESCE_WINDOW seconds
+# after the first feed that changed, instead of waiting for every feed each cycle (see RealtimeManager.run_streaming)
+REALTIME_STREAMING: bool = os.environ.get("REALTIME_STREAMING", "false").lower() == "true"
+REALTIME_COALESCE_WINDOW: Num = to_num(os.environ.get("REALTIME_COALESCE_WINDOW", "0.5"))
 
 REALTIME_DATA_DICT_CAP: int = int(os.environ.get("REALTIME_DATA_DICT_CAP", 20))
+# every REALTIME_CHECKPOINT_EVERY published cycles (0 disables), the parser's state is written to
+# REALTIME_CHECKPOINT_PATH, and restored from there on restart if it's recent enough (see checkpoint.py)
+REALTIME_CHECKPOINT_EVERY: int = int(os.environ.get("REALTIME_CHECKPOINT_EVERY", 0))
+REALTIME_CHECKPOINT_PATH: str = os.environ.get("REALTIME_CHECKPOINT_PATH", f"{REALTIME_PATH}/checkpoint.bin")
+
+# diffs are only built from snapshots this many published cycles back ("all" builds one per snapshot).
+# clients whose last snapshot isn't one of these baselines are sent the full data instead
+_diff_baselines: str = os.environ.get("DIFF_BASELINES", "1,2,4,8,16")
+DIFF_BASELINES: List[int] = (
+    list(range(1, REALTIME_DATA_DICT_CAP))
+    if _diff_baselines == "all"
+    else sorted({int(n) for n in _diff_baselines.split(",")})
+)
+if DIFF_BASELINES and DIFF_BASELINES[0] < 1:
+    print(f"ERROR: DIFF_BASELINES must be at least 1 cycle back, not {DIFF_BASELINES[0]}", file=sys.stderr)
+    exit(1)
+
+# when set, the web_server can ask for diffs from any retained snapshot (see RealtimeManager.serve_diff_requests)
+REALTIME_LAZY_DIFFS: bool = os.environ.get("REALTIME_LAZY_DIFFS", "false").lower() == "true"
+DIFF_CACHE_SIZE: int = int(os.environ.get("DIFF_CACHE_SIZE", 64))
+INTERN_CAP: int = 1 << 18  # distinct values interned() keeps before starting over
+
+# when set, each published cycle's diff is also appended to the realtime:stream Redis Stream (see stream.py)
+REALTIME_STREAM: bool = os.environ.get("REALTIME_STREAM", "false").lower() == "true"
+REALTIME_STREAM_MAXLEN: int = int(os.environ.get("REALTIME_STREAM_MAXLEN", 240))
+
+# when set (e.g. /dev/shm/realtime), each published cycle's payloads are also written to this memory-mapped file,
+# for readers on the same host (see shm.py)
+REALTIME_SHM_PATH: str = os.environ.get("REALTIME_SHM_PATH", "")
+
+# when set, each station's upcoming arrivals are also published on their own, in the realtime:boards hash (see boards.py)
+REALTIME_BOARDS: bool = os.environ.get("REALTIME_BOARDS", "false").lower() == "true"
+REALTIME_BOARD_DEPTH: int = int(os.environ.get("REALTIME_BOARD_DEPTH", 8))  # arrivals per route & direction
+
+# comma separated kinds of shards ("route", "borough") whose trips are also published on their own (see shards.py)
+REALTIME_SHARDS: List[str] = [kind for kind in os.environ.get("REALTIME_SHARDS", "").split(",") if kind]
+
+# when set, the parser answers journey requests pushed to realtime:plan_requests (see planner.py)
+REALTIME_PLANNER: bool = os.environ.get("REALTIME_PLANNER", "false").lower() == "true"
+PLANNER_MAX_TRANSFERS: int = int(os.environ.get("PLANNER_MAX_TRANSFERS", 3))
+
+# when set, the parser serves websocket clients itself on this port, alongside the web_server (see fanout.py)
+REALTIME_FANOUT_PORT: int = int(os.environ.get("REALTIME_FANOUT_PORT", 0))
+FANOUT_SEND_TIMEOUT: Num = to_num(os.environ.get("FANOUT_SEND_TIMEOUT", 5))  # seconds, before a slow client is dropped
+
+# with PARSER_LEADER_ELECTION=true, replicas share a PARSER_LEASE_TTL second lease in Redis: only its holder
+# fetches & publishes, the others stand by and take over when it lapses (see leader.py)
+PARSER_LEADER_ELECTION: bool = os.environ.get("PARSER_LEADER_ELECTION", "false").lower() == "true"
+PARSER_LEASE_TTL: Num = to_num(os.environ.get("PARSER_LEASE_TTL", 5))
+PARSER_REPLICA_ID: str = os.environ.get("PARSER_REPLICA_ID", "")  # defaults to hostname:pid
+
+# a JSON file listing the agencies to parse, each in its own process & Redis namespace (see agencies.py).
+# unset, the parser only parses GTFS_CONF (the MTA subway), without a namespace
+AGENCIES_CONFIG: str = os.environ.get("AGENCIES_CONFIG", "")
+REDIS_NAMESPACE: str = ""  # this process' agency's, set by agencies.configure
+
+METRICS_PORT: int = int(os.environ.get("METRICS_PORT", 45654))  # 0 disables the /metrics endpoint
+
+COMPRESSION_CODEC: str = os.environ.get("COMPRESSION_CODEC", "zlib")  # zlib, deflate, or zstd
+# each codec's own default level (see codec.py) unless set
+COMPRESSION_LEVEL: Optional[int] = int(os.environ["COMPRESSION_LEVEL"]) if os.environ.get("COMPRESSION_LEVEL") else None
 
 MTA_REALTIME_BASE_URL: str = os.environ.get(
     "MTA_REALTIME_BASE_URL", f"https://api-endpoint.mta.info/Dataservice/mtagtfsfeeds/nyct%2Fgtfs",
@@ -111,6 +184,17 @@ except AssertionError:
     )
     REALTIME_FREQ, REALTIME_TIMEOUT, REALTIME_MAX_ATTEMPTS = 15, 3.2, 3
 
+# from the values actually used, if the ones above were substituted
+REALTIME_FETCH_DEADLINE: Num = to_num(
+    os.environ.get("REALTIME_FETCH_DEADLINE", str(REALTIME_TIMEOUT * REALTIME_MAX_ATTEMPTS))
+)
+
+
+if DIFF_BASELINES and DIFF_BASELINES[-1] >= REALTIME_DATA_DICT_CAP:
+    print(
+        "WARNING: DIFF_BASELINES beyond REALTIME_DATA_DICT_CAP - 1 are never retained and will be ignored",
+        file=sys.stderr,
+    )
 
 REDIS_EXP = REALTIME_FREQ * REALTIME_MAX_ATTEMPTS
 
@@ -139,6 +223,13 @@ log = logging.getLogger("parser")
 #####################################
 #        UTILITY FUNCTIONS          #
 #####################################
+def make_data_dirs() -> None:
+    """ Creates the directories the static & realtime data are written to
+    """
+    os.makedirs(f"{STATIC_PATH}/parsed", exist_ok=True)
+    os.makedirs(f"{REALTIME_PATH}/parsed", exist_ok=True)
+
+
 def checksum(fname):
     hash_md5 = hashlib.md5()
     with open(fname, "rb") as f:
@@ -161,19 +252,23 @@ def short_hash(input_: Any, type_hint: Type[SpecifiedHash]) -> SpecifiedHash:
         input_ = middleware.transform_route(input_)
     hash_int = hasher(str(input_))
     typed_hash = type_hint(ShortHash(hash_int))
-    return typed_hash
+    return interned(typed_hash)
 
 
-def trim_dict(dict_):
-    i = 0
-    while len(dict_) > REALTIME_DATA_DICT_CAP:
-        if i > 1000:
-            log.warning(
-                "could not trim specified dict to the %d most recent keys", REALTIME_DATA_DICT_CAP,
-            )
-            return
-        del dict_[min(dict_)]
-        i += 1
+_interned: Dict[Any, Any] = {}
+
+
+def interned(value: Any) -> Any:
+    """ Returns the first seen object equal to value, so that e.g. the trip hashes & arrival times repeated across
+    snapshots share one int object (CPython only does this for -5 to 256). For ints & tuples of them, not bools
+    """
+    try:
+        return _interned[value]
+    except KeyError:
+        if len(_interned) >= INTERN_CAP:
+            _interned.clear()
+        _interned[value] = value
+        return value
 
 
 #####################################
@@ -191,19 +286,42 @@ class StationArrival(NamedTuple):
     trip_hash: TripHash
 
 
-def dict_of_list_factory():
-    return defaultdict(list)
-
-
 def dict_of_dict_factory():
     return defaultdict(dict)
 
 
-def dict_of_dict_of_list_factory():
-    return defaultdict(lambda: defaultdict(list))
+def slotted(cls):
+    """ Rebuilds a dataclass with __slots__ for its fields, so its instances have no per-instance __dict__
+    (dataclass(slots=True) needs Python 3.10). Use it above @dataclass
+    """
+    inherited = {name for base in cls.__mro__[1:] for name in getattr(base, "__slots__", ())}
+    names = tuple(f.name for f in fields(cls) if f.name not in inherited)
+    cls_dict = {k: v for k, v in cls.__dict__.items() if k not in names + ("__dict__", "__weakref__")}
+    cls_dict["__slots__"] = names
+    if cls.__dataclass_params__.frozen:
+        # the default pickling of slotted objects sets their attributes, which frozen dataclasses refuse
+        cls_dict["__getstate__"] = _slotted_getstate
+        cls_dict["__setstate__"] = _slotted_setstate
+    return type(cls)(cls.__name__, cls.__bases__, cls_dict)
 
 
-@dataclass
+def _slotted_getstate(self):
+    return [getattr(self, f.name) for f in fields(self)]
+
+
+def _slotted_setstate(self, state):
+    for f, value in zip(fields(self), state):
+        object.__setattr__(self, f.name, value)
+
+
+def dataclass_dict(obj) -> Dict[str, Any]:
+    """ A dataclass's fields by name, like obj.__dict__ was before the data model was slotted
+    """
+    return {f.name: getattr(obj, f.name) for f in fields(obj)}
+
+
+@slotted
+@dataclass(frozen=True)
 class RouteInfo:
     desc: str
     color: int
@@ -211,7 +329,8 @@ class RouteInfo:
     stations: Set[StationHash]
 
 
-@dataclass
+@slotted
+@dataclass(frozen=True)
 class Station:
     id_: StationHash
     name: str
@@ -224,7 +343,8 @@ class Station:
     travel_times: Dict[StationHash, TravelTime] = field(default_factory=dict)
 
 
-@dataclass
+@slotted
+@dataclass(frozen=True)
 class Trip:
     id_: TripHash
     branch: Branch
@@ -234,9 +354,10 @@ class Trip:
     timestamp: Optional[int] = None  # in seconds
 
     def add_arrival(self, station: StationHash, arrival_time: ArrivalTime):
-        self.arrivals[station] = ArrivalTime(arrival_time)
+        self.arrivals[station] = interned(ArrivalTime(arrival_time))
 
 
+@slotted
 @dataclass
 class StaticData:
     name: str
@@ -251,40 +372,42 @@ class StaticData:
     )
 
 
+@slotted
 @dataclass
 class RealtimeData(StaticData):
     realtime_timestamp: int = 0
     trips: Dict[TripHash, Trip] = field(default_factory=dict)
 
 
-@dataclass
+@slotted
+@dataclass(frozen=True)
 class TripDiff:
     deleted: List[TripHash] = field(default_factory=list)
     added: List[Trip] = field(default_factory=list)
 
 
-@dataclass
+@slotted
+@dataclass(frozen=True)
 class ArrivalsDiff:
-    deleted: Dict[TripHash, List[StationHash]] = field(default_factory=dict_of_list_factory)
-    added: Dict[TripHash, Dict[StationHash, ArrivalTime]] = field(
-        default_factory=dict_of_list_factory
-    )
-    modified: Dict[TimeDiff, Dict[TripHash, List[StationHash]]] = field(
-        default_factory=dict_of_dict_of_list_factory
-    )
+    deleted: Dict[TripHash, List[StationHash]] = field(default_factory=dict)
+    added: Dict[TripHash, Dict[StationHash, ArrivalTime]] = field(default_factory=dict)
+    modified: Dict[TimeDiff, Dict[TripHash, List[StationHash]]] = field(default_factory=dict)
 
 
-@dataclass
+@slotted
+@dataclass(frozen=True)
 class StatusDiff:
     modified: Dict[TripHash, TripStatus] = field(default_factory=dict)
 
 
-@dataclass
+@slotted
+@dataclass(frozen=True)
 class BranchDiff:
     modified: Dict[TripHash, Branch] = field(default_factory=dict)
 
 
-@dataclass
+@slotted
+@dataclass(frozen=True)
 class DataDiff:
     realtime_timestamp: int
     trips: TripDiff
@@ -308,7 +431,7 @@ class StaticJSONEncoder(json.JSONEncoder):
         if isinstance(obj, set):
             return list(obj)
         if is_dataclass(obj):
-            custom_obj = {"_type": str(type(obj)), "value": obj.__dict__}
+            custom_obj = {"_type": str(type(obj)), "value": dataclass_dict(obj)}
             return custom_obj
         return json.JSONEncoder.default(self, obj)
 
@@ -360,7 +483,7 @@ class RealtimeJSONEncoder(json.JSONEncoder):
         if isinstance(obj, set):
             return list(obj)
         if is_dataclass(obj):
-            custom_obj = {"_type": str(type(obj)), "value": obj.__dict__}
+            custom_obj = {"_type": str(type(obj)), "value": dataclass_dict(obj)}
             return custom_obj
         return json.JSONEncoder.default(self, obj)
 
@@ -406,27 +529,25 @@ class RealtimeJSONDecoder(json.JSONDecoder):
             return obj
 
 
-class TimeLogger:
-    """ Convenient little way to log how long something takes.
+class LRUCache(OrderedDict):
+    """ A dict holding at most maxsize items, evicting the least recently used one when full
     """
 
-    def __init__(self):
-        self.times = []
-
-    def __enter__(self):
-        self.tlog()
-        return self
-
-    def tlog(self, block_name=""):
-        self.times.append((time.time(), block_name))
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        prev_time, _ = self.times.pop(0)
-        while len(self.times) > 0:
-            time_, block_name = self.times.pop(0)
-            block_time = time_ - prev_time
-            log.debug("%s took %s seconds", block_name, block_time)
-            prev_time = time_
+    def __init__(self, maxsize: int) -> None:
+        super().__init__()
+        self.maxsize = maxsize
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        self.move_to_end(key)
+        return self[key]
+
+    def __setitem__(self, key, value) -> None:
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
 
 
 #####################################
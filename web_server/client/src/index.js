@@ -8,14 +8,14 @@ import  { devLog,
           processData,
           dataReceivedMsg,
           requestFullMsg,
-          formatBytes
+          formatBytes,
+          decompressPayload
         } from './utils.js'
 import { ArrivalsByRoute } from './components/arrivalsByRoute.js'
 import { ArrivalsByStation } from './components/arrivalsByStation.js'
 
 const protobuf = require("protobufjs")
 const dateFormat = require('dateformat')
-const pako = require('pako')
 const crypto = require('crypto')
 
 
@@ -167,6 +167,9 @@ class Main extends React.Component {
             devLog(`this.state.lastSuccessfulTimestamp = ${this.state.lastSuccessfulTimestamp}, timestamp_from = ${parsed.timestamp_from}`)
           }
         }
+        else if (parsed.type === 'heartbeat') {
+          devLog(`heartbeat at ${parsed.timestamp}, data unchanged since ${parsed.data_timestamp}`)
+        }
       } else if (typeof data === 'object') {
         // received an object -- this should be either data_full or data_update
         if (data.size !== upcomingMessageBinaryLength) {
@@ -334,7 +337,7 @@ class Main extends React.Component {
   decodeZippedProto(compressedBlob) {
     var fileReader = new FileReader()
     fileReader.onload = (event) => {
-        const decompressed = pako.inflate(event.target.result)
+        const decompressed = decompressPayload(event.target.result)
         if (upcomingMessageType === DATA_FULL) this.loadFull(decompressed)
         else if (upcomingMessageType === DATA_UPDATE) this.loadUpdate(decompressed)
         else console.error("upcomingMessageType not valid")
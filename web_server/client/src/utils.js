@@ -1,5 +1,13 @@
 import Fuse from "fuse.js";
 const merge = require('lodash.merge');
+const pako = require('pako');
+const fzstd = require('fzstd');
+
+// payloads start with [CODEC_MAGIC, codec id] (see parser/codec.py); legacy ones are plain zlib
+const CODEC_MAGIC = 0xDA
+const CODEC_ZLIB = 0
+const CODEC_DEFLATE = 1
+const CODEC_ZSTD = 2
 
 export function devLog(entry) {
   if(process.env.NODE_ENV === 'development') {
@@ -18,6 +26,23 @@ export function formatBytes(bytes, decimals) {
   return parseFloat((bytes / Math.pow(k, i)).toFixed(dm)) + ' ' + sizes[i];
 }
 
+export function decompressPayload(buffer) {
+  const bytes = new Uint8Array(buffer)
+  if (bytes[0] !== CODEC_MAGIC) return pako.inflate(bytes)
+
+  const body = bytes.subarray(2)
+  switch (bytes[1]) {
+    case CODEC_ZLIB:
+      return pako.inflate(body)
+    case CODEC_DEFLATE:
+      return pako.inflateRaw(body)
+    case CODEC_ZSTD:
+      return fzstd.decompress(body)
+    default:
+      throw new Error(`unsupported payload codec ${bytes[1]}`)
+  }
+}
+
 export function sleep(ms) {
 	return new Promise(resolve => setTimeout(resolve, ms))
 }
@@ -17,12 +17,16 @@ const noDataError = '{"type": "error","error": "no_data"}'
 const realtimeFreq = process.env.REALTIME_FREQ || 15
 const realtimeDataDictCap = process.env.REALTIME_DATA_DICT_CAP || 20
 const clientIdExpiration = realtimeFreq * realtimeDataDictCap * 1000
+const lazyDiffs = (process.env.REALTIME_LAZY_DIFFS || 'false').toLowerCase() === 'true'
+const diffRequestTimeout = 2000
 
 
 /// /// DATA /// ///
 let dataFull = null
 let dataUpdates = []
 let latestTimestamp = 0
+// clients waiting on a lazily built diff, keyed by the timestamp the diff starts from
+let pendingDiffs = new Map()
 
 let clients = new Map()
 class Client {
@@ -78,6 +82,48 @@ function getRedisData () {
 getRedisData()
 
 
+// lazy diffs: ask the parser for a diff from a timestamp it didn't precompute one for
+function requestDiff (client) {
+  const timestampFrom = String(client.lastSuccessfulTimestamp)
+  if (pendingDiffs.has(timestampFrom)) {
+    pendingDiffs.get(timestampFrom).add(client)
+    return
+  }
+  pendingDiffs.set(timestampFrom, new Set([client]))
+  redis.rpush('realtime:diff_requests', timestampFrom)
+  // don't leave clients waiting if the parser never answers
+  setTimeout(resolvePendingDiff, diffRequestTimeout, timestampFrom, sendFull)
+}
+
+function getLazyDiff (timestampFrom, timestampTo) {
+  if (!pendingDiffs.has(timestampFrom)) return
+  if (timestampTo !== String(latestTimestamp)) {
+    // the diff is to data this server doesn't have yet (or anymore)
+    resolvePendingDiff(timestampFrom, sendFull)
+    return
+  }
+  redis.hgetBuffer('realtime:data_diffs', timestampFrom, (err, diff) => {
+    if (err || diff == null) {
+      resolvePendingDiff(timestampFrom, sendFull)
+    } else {
+      dataUpdates[timestampFrom] = diff
+      resolvePendingDiff(timestampFrom, sendUpdate)
+    }
+  })
+}
+
+function resolvePendingDiff (timestampFrom, send) {
+  const waiting = pendingDiffs.get(timestampFrom)
+  if (!waiting) return
+  pendingDiffs.delete(timestampFrom)
+  for (const client of waiting) {
+    if (client.ws != null && client.ws.readyState === WebSocket.OPEN) {
+      send(client)
+    }
+  }
+}
+
+
 // redisPubSub client for subscribe()
 const redisPubSub = new Redis({ host: redisHostname, port: redisPort })
 redisPubSub.on('connect', () => { console.info('redisPubSub client connected') })
@@ -85,6 +131,14 @@ redisPubSub.on('error', (err) => { console.error('redisPubSub error: ' + err) })
 redisPubSub.on('message', (channel, msg) => {
   if (channel === 'realtime_updates' && msg === 'new_data') {
     getRedisData()
+  } else if (channel === 'realtime_updates' && msg.startsWith('diff_ready:')) {
+    const [timestampFrom, timestampTo] = msg.slice('diff_ready:'.length).split(':')
+    getLazyDiff(timestampFrom, timestampTo)
+  } else if (channel === 'realtime_updates' && msg.startsWith('diff_unavailable:')) {
+    resolvePendingDiff(msg.slice('diff_unavailable:'.length), sendFull)
+  } else if (channel === 'realtime_updates' && msg.startsWith('heartbeat:')) {
+    // the parser checked the feeds but nothing changed, so there's no new data to fetch
+    heartbeatToAll(msg.slice('heartbeat:'.length))
   }
 })
 redisPubSub.subscribe('realtime_updates')
@@ -180,12 +234,26 @@ function sendUpdate (client) {
     client.ws.send(update)
   }
 }
+function heartbeatToAll (heartbeatTimestamp) {
+  const heartbeat = `{
+    "type": "heartbeat",
+    "timestamp": "${heartbeatTimestamp}",
+    "data_timestamp": "${latestTimestamp}"
+  }`
+  for (const client of clients.values()) {
+    if (client.ws != null && client.ws.readyState === WebSocket.OPEN) {
+      client.ws.send(heartbeat)
+    }
+  }
+}
 function pushToAll () {
   console.info(`Received new data w/ timestamp ${latestTimestamp}, pushing it to clients`)
   for (const [clientId, client] of clients.entries()) {
     if (client.ws != null && client.ws.readyState === WebSocket.OPEN) {
       if (client.lastSuccessfulTimestamp in dataUpdates) {
         sendUpdate(client)
+      } else if (lazyDiffs && client.lastSuccessfulTimestamp && client.lastSuccessfulTimestamp != latestTimestamp) {
+        requestDiff(client)
       } else {
         sendFull(client)
       }